@@ -0,0 +1,134 @@
+"""
+Web adapter CPU per message on its way from the chat server to a browser.
+
+Replays a mixed stream of chat, stored and notification events, read in
+64 KiB chunks, through three versions of the adapter's receive path and
+reports CPU time per message:
+
+- text: the original adapter reading v1 text and parsing it back into events
+  with regexes, substring checks and ``json.loads`` on a ``{...}`` slice
+- typed: v2 frames decoded into dicts and re-encoded for ``send_json``
+- passthrough: mux frame bodies forwarded to ``send_text`` undecoded
+
+Usage: python -m benchmarks.bench_adapter [--messages 100000]
+"""
+import argparse
+import json
+import re
+import time
+from datetime import datetime, UTC
+
+from src.p2p_chat.protocol import READ_SIZE, FrameDecoder, encode_frame, encode_tagged, render_v1, stored_event
+
+# The original adapter's parser, kept here for comparison
+MSG_PATTERN = re.compile(r'\[([^\]]+)\](?:\[([^\]]+)\])?\s+(.*)')
+STORED_MSG_PATTERN = re.compile(r'\[Stored\]\s+\[([^]]+)\](?:\[([^]]+)\])?\s+(.*)')
+
+
+def parse_server_message(message):
+    if message.startswith("[Stored]"):
+        match = STORED_MSG_PATTERN.match(message)
+        if match:
+            msg_type, timestamp, content = match.groups()
+            return {"type": "stored", "sender": msg_type, "timestamp": timestamp, "message": content}
+    else:
+        match = MSG_PATTERN.match(message)
+        if match:
+            sender, timestamp, content = match.groups()
+            return {"type": "chat", "sender": sender,
+                    "timestamp": timestamp or datetime.now(UTC).isoformat(), "message": content}
+    return {"type": "system", "message": message}
+
+
+def text_path(message):
+    if message.startswith("[Stored]"):
+        return json.dumps(parse_server_message(message))
+    if "[NOTIFICATION]" in message or "notification" in message.lower():
+        metadata_start = message.find('{')
+        metadata_end = message.rfind('}')
+        if metadata_start > 0 and metadata_end > metadata_start:
+            metadata = json.loads(message[metadata_start:metadata_end + 1])
+            clean_message = message[:metadata_start].strip()
+            sender = "System"
+            if "[" in clean_message and "]" in clean_message:
+                sender = clean_message[clean_message.find("[") + 1:clean_message.find("]")]
+                clean_message = clean_message[clean_message.find("]") + 1:].strip()
+            return json.dumps({"type": "notification", "sender": sender, "message": clean_message,
+                               "metadata": metadata, "timestamp": datetime.now(UTC).isoformat()})
+    return json.dumps(parse_server_message(message))
+
+
+def events(count):
+    timestamp = "2025-01-01T00:00:00+00:00"
+    stream = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            stream.append({"type": "chat", "sender": "alice", "destination": "bob", "timestamp": timestamp,
+                           "message": f"hey bob, message number {i}", "message_type": "chat", "metadata": {}})
+        elif kind == 1:
+            stream.append(stored_event({"sender": "carol", "destination": "bob", "timestamp": timestamp,
+                                        "message": f"left while you were away {i}", "type": "chat"}))
+        else:
+            stream.append({"type": "notification", "sender": "thermometer", "destination": "bob",
+                           "timestamp": timestamp, "message": f"Temperature update: {20 + i % 10}C",
+                           "message_type": "notification", "metadata": {"service": "thermometer", "reading": i}})
+    return stream
+
+
+def chunks(data):
+    return [data[i:i + READ_SIZE] for i in range(0, len(data), READ_SIZE)]
+
+
+def run_text(stream):
+    # One line per read, as the original adapter assumed
+    lines = [render_v1({**e, "type": "chat"} if e["type"] == "notification" else e).strip() for e in stream]
+    lines = [f"[NOTIFICATION] {line} {json.dumps(e['metadata'])}" if e["type"] == "notification" else line
+             for line, e in zip(lines, stream)]
+    sent = []
+    start = time.process_time()
+    for line in lines:
+        sent.append(text_path(line))
+    return time.process_time() - start, len(sent)
+
+
+def run_typed(stream):
+    data = chunks(b"".join(encode_frame(e) for e in stream))
+    sent = []
+    start = time.process_time()
+    decoder = FrameDecoder()
+    for chunk in data:
+        for event in decoder.feed(chunk):
+            if event["type"] != "login_success":
+                sent.append(json.dumps(event))
+    return time.process_time() - start, len(sent)
+
+
+def run_passthrough(stream):
+    data = chunks(b"".join(encode_tagged(1, e) for e in stream))
+    sessions = {1: []}
+    start = time.process_time()
+    decoder = FrameDecoder(tagged=True, raw=True)
+    for chunk in data:
+        for session_id, body in decoder.feed(chunk):
+            sessions[session_id].append(body.decode())
+    return time.process_time() - start, len(sessions[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=100000)
+    args = parser.parse_args()
+
+    stream = events(args.messages)
+    baseline = None
+    for name, run in (("text", run_text), ("typed", run_typed), ("passthrough", run_passthrough)):
+        elapsed, sent = run(stream)
+        assert sent == args.messages
+        per_message = elapsed / sent * 1e6
+        baseline = baseline or per_message
+        print(f"{name:<12} {per_message:6.2f} us/message  ({baseline / per_message:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
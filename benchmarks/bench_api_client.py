@@ -0,0 +1,126 @@
+"""
+Per-store latency of a fresh httpx client per call versus the shared pool.
+
+Runs the Message API under uvicorn in a child process on loopback (backed by
+in-memory storage so MongoDB isn't needed) and issues stores at a fixed
+rate, through ``api_client.get_client()`` and then the old way
+(``async with httpx.AsyncClient()`` per store).
+
+Usage: python -m benchmarks.bench_api_client [--rate 300] [--seconds 5]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import statistics
+import time
+from datetime import datetime, UTC
+
+import httpx
+import uvicorn
+
+import src.p2p_chat.api_client as api_client
+import src.p2p_chat.message_api as message_api
+from src.p2p_chat.storage import MemoryStorage
+
+
+def payload(i):
+    return {
+        "sender": "bench",
+        "destination": f"user{i % 100}",
+        "message": f"message {i}",
+        "timestamp": datetime.now(UTC).isoformat(),
+        "type": "chat",
+        "metadata": {},
+    }
+
+
+async def store_fresh(api_base, i):
+    async with httpx.AsyncClient() as client:
+        await client.post(f"{api_base}/messages/", json=payload(i))
+
+
+async def store_pooled(api_base, i):
+    await api_client.get_client().post(f"{api_base}/messages/", json=payload(i))
+
+
+def serve_api(port):
+    app = message_api.create_app(storage=MemoryStorage())
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+async def run_at_rate(store, api_base, rate, seconds):
+    latencies = []
+    errors = []
+
+    async def timed(i):
+        start = time.perf_counter()
+        try:
+            await store(api_base, i)
+        except httpx.HTTPError as e:
+            errors.append(e)
+            return
+        latencies.append(time.perf_counter() - start)
+
+    tasks = []
+    interval = 1 / rate
+    begin = time.perf_counter()
+    for i in range(int(rate * seconds)):
+        # Keep a steady arrival rate rather than a closed loop
+        delay = begin + i * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(timed(i)))
+    await asyncio.gather(*tasks)
+    return latencies, errors
+
+
+def summarize(name, result):
+    latencies, errors = result
+    latencies = sorted(latencies)
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    print(
+        f"{name:<10}{len(latencies):>8}{len(errors):>8}"
+        f"{statistics.mean(latencies) * 1000:>10.2f}{p(0.5):>10.2f}{p(0.99):>10.2f}"
+    )
+
+
+async def wait_for_api(api_base):
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(f"{api_base}/health")
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError("Message API did not start")
+
+
+async def run(rate, seconds, port):
+    api_base = f"http://127.0.0.1:{port}"
+    await wait_for_api(api_base)
+
+    print(f"{rate} stores/sec for {seconds}s")
+    print(f"{'client':<10}{'stores':>8}{'errors':>8}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    # Pooled first: the fresh-client run can leave the API with a backlog
+    summarize("pooled", await run_at_rate(store_pooled, api_base, rate, seconds))
+    await api_client.close_client()
+    summarize("fresh", await run_at_rate(store_fresh, api_base, rate, seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message API client latency")
+    parser.add_argument("--rate", type=int, default=300, help="Stores per second")
+    parser.add_argument("--seconds", type=float, default=5, help="Duration of each run")
+    parser.add_argument("--port", type=int, default=8765, help="Port for the temporary API")
+    args = parser.parse_args()
+
+    api = multiprocessing.Process(target=serve_api, args=(args.port,), daemon=True)
+    api.start()
+    try:
+        asyncio.run(run(args.rate, args.seconds, args.port))
+    finally:
+        api.terminate()
+
+
+if __name__ == "__main__":
+    main()
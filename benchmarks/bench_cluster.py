@@ -0,0 +1,92 @@
+"""
+Delivery latency within one cluster node versus across two nodes.
+
+Starts the Message API and two cluster nodes ("a" and "b") as child processes
+on loopback, logs in a sender on node a and one receiver on each node, then
+sends messages one at a time and times each from write to receipt.
+
+Usage: python -m benchmarks.bench_cluster [--messages 2000]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.bench_workers import free_port, login, serve_api, wait_for_port
+from src.p2p_chat.protocol import encode_frame
+
+LINK_SETTLE = 2.0  # Seconds for the nodes' links to connect
+WARMUP = 50  # Untimed messages per path
+
+
+def start_node(node, other, ports, links, api_base):
+    return subprocess.Popen(
+        [sys.executable, "-m", "src.p2p_chat.server", "--host", "127.0.0.1", "--port", str(ports[node]),
+         "--api-base", api_base, "--node-id", node, "--cluster-listen", f"127.0.0.1:{links[node]}",
+         "--peer", f"{other}=127.0.0.1:{links[other]}"],
+        stdout=subprocess.DEVNULL,
+    )
+
+
+async def time_deliveries(writer, reader, decoder, destination, count):
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        writer.write(encode_frame({"type": "chat", "destination": destination, "message": f"ping {i}"}))
+        await writer.drain()
+        while not any(f["type"] == "chat" for f in decoder.feed(await reader.read(65536))):
+            pass
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+async def run(ports, count):
+    _, tx_writer, _ = await login(ports["a"], "sender")
+    local = await login(ports["a"], "rx_local")
+    remote = await login(ports["b"], "rx_remote")
+    await asyncio.sleep(0.5)  # Let presence gossip settle
+
+    results = {}
+    for name, destination, (reader, _, decoder) in (("same node", "rx_local", local),
+                                                     ("cross node", "rx_remote", remote)):
+        await time_deliveries(tx_writer, reader, decoder, destination, WARMUP)
+        results[name] = await time_deliveries(tx_writer, reader, decoder, destination, count)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    api_port = free_port()
+    api = multiprocessing.Process(target=serve_api, args=(api_port,), daemon=True)
+    api.start()
+    asyncio.run(wait_for_port(api_port))
+    api_base = f"http://127.0.0.1:{api_port}"
+
+    ports = {"a": free_port(), "b": free_port()}
+    links = {"a": free_port(), "b": free_port()}
+    nodes = [start_node("a", "b", ports, links, api_base), start_node("b", "a", ports, links, api_base)]
+    try:
+        for port in ports.values():
+            asyncio.run(wait_for_port(port))
+        time.sleep(LINK_SETTLE)
+        results = asyncio.run(run(ports, args.messages))
+    finally:
+        for node in nodes:
+            node.terminate()
+            node.wait()
+        api.terminate()
+
+    for name, latencies in results.items():
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+        print(f"{name:<11} p50 {statistics.median(latencies):6.3f} ms   p99 {p99:6.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Cost of publishing one message to a large room.
+
+Builds a room of N members (default 10k) where a share are online with
+in-memory connections, then times ``server.publish``:
+
+- serialize-once: the current path, one encode per protocol version shared by
+  every member's queue, and one bulk store for offline members.
+- per-member: what a naive loop costs, encoding the event and issuing one
+  store call per offline member.
+
+Usage: python -m benchmarks.bench_fanout [--members 10000] [--online 0.8]
+"""
+import argparse
+import asyncio
+import time
+
+import src.p2p_chat.server as server
+
+
+class NullWriter:
+    """Accepts writes instantly, like a fast local reader."""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+store_calls = {"bulk": 0, "single": 0}
+
+
+async def count_bulk_store(sender, destinations, message, *args, **kwargs):
+    store_calls["bulk"] += 1
+
+
+async def count_single_store(sender, destination, message, *args, **kwargs):
+    store_calls["single"] += 1
+
+
+async def naive_publish(conn, room, request):
+    """Reference implementation: encode and store per member."""
+    event = {
+        "type": "chat",
+        "sender": conn.username,
+        "destination": "#" + room,
+        "room": room,
+        "timestamp": "now",
+        "message": request["message"],
+        "metadata": {"room": room},
+    }
+    for username in server.rooms[room]:
+        if username == conn.username:
+            continue
+        target = server.clients.get(username)
+        if target is not None:
+            target.send(event)
+        else:
+            await server.store_message(conn.username, username, request["message"])
+
+
+async def wait_for_flush(conns):
+    while any(conn.depth for conn in conns):
+        await asyncio.sleep(0)
+
+
+async def run(members, online_share, rounds):
+    server.store_messages = count_bulk_store
+    server.store_message = count_single_store
+    server.outbound_settings.update(queue_max=10 ** 9, high_watermark=10 ** 9)
+
+    online = int(members * online_share)
+    conns = []
+    for i in range(members):
+        name = f"user{i}"
+        server.join_room(name, "big")
+        if i < online:
+            # Mix of v1 and v2 clients, as in a real deployment
+            conn = server.ClientConnection(name, None, NullWriter(), version=2 if i % 4 else 1)
+            server.clients[name] = conn
+            conn.start()
+            conns.append(conn)
+    publisher = conns[0]
+    request = {"type": "chat", "destination": "#big", "message": "x" * 200}
+
+    print(f"room of {members} members, {online} online, {rounds} publishes")
+    print(f"{'strategy':<16}{'ms/publish':>12}{'us/member':>12}{'store calls':>13}")
+    for name, publish in (
+        ("serialize-once", lambda: server.publish(publisher, "big", request)),
+        ("per-member", lambda: naive_publish(publisher, "big", request)),
+    ):
+        store_calls.update(bulk=0, single=0)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            await publish()
+            await wait_for_flush(conns)
+        elapsed = (time.perf_counter() - start) / rounds
+        calls = (store_calls["bulk"] + store_calls["single"]) / rounds
+        print(f"{name:<16}{elapsed * 1000:>12.2f}{elapsed / members * 1e6:>12.2f}{calls:>13.0f}")
+
+    for conn in conns:
+        await conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Room fan-out cost")
+    parser.add_argument("--members", type=int, default=10000, help="Room size")
+    parser.add_argument("--online", type=float, default=0.8, help="Share of members online")
+    parser.add_argument("--rounds", type=int, default=20, help="Publishes to average over")
+    args = parser.parse_args()
+    asyncio.run(run(args.members, args.online, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
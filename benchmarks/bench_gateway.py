@@ -0,0 +1,223 @@
+"""
+Memory and file descriptors of the web adapter and chat server per web user.
+
+Logs N simulated browsers in through the web adapter and, once every one has
+its login_success, reports resident memory and open file descriptors of the
+adapter process and of the chat server process, the adapter's asyncio task
+count, how long the login storm took and how long one more login takes with
+N users online. Compared for the old adapter (one TCP connection and one listener
+task per browser) and the multiplexed one (sessions over a fixed pool of
+upstream connections, plus a writer task per browser). Every run uses fresh processes.
+
+The old adapter needs one descriptor per user in each process, so it only
+runs up to ``--old-users`` (keep it under ``ulimit -n``). Linux only: numbers
+come from /proc.
+
+Usage: python -m benchmarks.bench_gateway [--users 1000,10000,50000] [--old-users 1000,10000] [--upstreams 4]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+import src.p2p_chat.server as chat_server
+import src.p2p_chat.websocket_adapter as adapter
+from src.p2p_chat.presence import PresenceBatcher, Roster
+from src.p2p_chat.protocol import iter_frames, open_connection
+
+CONNECT_CONCURRENCY = 50  # Old adapter connections opened at once
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def usage(pid="self"):
+    """(resident MiB, open file descriptors) of a process."""
+    with open(f"/proc/{pid}/status") as f:
+        rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+    return rss / 1024, len(os.listdir(f"/proc/{pid}/fd"))
+
+
+def serve_chat(port):
+    async def no_mail(username, *args, **kwargs):
+        return []
+
+    async def no_events(*args, **kwargs):
+        pass
+
+    chat_server.get_stored_messages = no_mail  # Logins would otherwise each call the Message API
+    chat_server.watch_mailboxes = no_events
+    sys.stdout = open(os.devnull, "w")  # A line per login
+    asyncio.run(chat_server.run_server("127.0.0.1", port))
+
+
+class FakeBrowser:
+    """An idle browser: logs in, then only receives."""
+
+    def __init__(self, username, port):
+        self.scope = {"subprotocols": []}
+        self.login = {"type": "login", "username": username, "server_host": "127.0.0.1", "server_port": port}
+        self.logged_in = asyncio.Event()
+        self.leave = asyncio.Event()
+        self.received = 0
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def receive_json(self):
+        if self.login is not None:
+            login, self.login = self.login, None
+            return login
+        await self.leave.wait()
+        raise adapter.WebSocketDisconnect()
+
+    async def send_json(self, event):
+        await self.send_text(json.dumps(event))
+
+    async def send_text(self, text):
+        self.received += 1
+        if '"login_success"' in text:
+            self.logged_in.set()
+
+    async def close(self):
+        pass
+
+
+old_browsers = {}  # username -> FakeBrowser, for the old adapter's presence broadcasts
+old_tasks = set()
+
+
+async def old_send_to_all(event):
+    text = json.dumps(event)
+    for browser in list(old_browsers.values()):
+        await browser.send_text(text)
+
+
+def old_publish(event):
+    task = asyncio.create_task(old_send_to_all(event))
+    old_tasks.add(task)
+    task.add_done_callback(old_tasks.discard)
+
+
+old_roster = Roster()  # The old adapter's roster of its own web users
+old_batcher = PresenceBatcher(old_roster, old_publish)
+
+
+async def old_session(browser, port, username, connecting):
+    """The adapter before multiplexing: a v2 connection and a listener task per browser."""
+    async with connecting:  # Don't overrun the server's listen backlog
+        reader, writer = await open_connection("127.0.0.1", port, username)
+    old_browsers[username] = browser
+    old_roster.join(username)
+    page = old_roster.snapshot()
+    await browser.send_json({"type": "login_success", "online_users": page["users"]})
+    old_batcher.changed()
+
+    async def listen():
+        async for event in iter_frames(reader):
+            if event["type"] != "login_success":
+                await browser.send_json(event)
+
+    task = asyncio.create_task(listen())
+    await browser.leave.wait()
+    writer.close()
+    task.cancel()
+
+
+def run_adapter(mode, users, upstreams, port, server_pid, results):
+    sys.stdout = open(os.devnull, "w")
+
+    async def run():
+        adapter.upstream_connections = upstreams
+        idle = usage(), usage(server_pid)
+        browsers = [FakeBrowser(f"user{i}", port) for i in range(users)]
+        connecting = asyncio.Semaphore(CONNECT_CONCURRENCY)
+        tasks = []
+        for i, browser in enumerate(browsers):
+            if mode == "mux":
+                tasks.append(asyncio.create_task(adapter.websocket_endpoint(browser)))
+            else:
+                tasks.append(asyncio.create_task(old_session(browser, port, f"user{i}", connecting)))
+        started = time.perf_counter()
+        for browser in browsers:
+            await asyncio.wait_for(browser.logged_in.wait(), 300)
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(1)  # Let presence batches and welcome pages settle
+        extra = FakeBrowser("latecomer", port)
+        started = time.perf_counter()
+        if mode == "mux":
+            tasks.append(asyncio.create_task(adapter.websocket_endpoint(extra)))
+        else:
+            tasks.append(asyncio.create_task(old_session(extra, port, "latecomer", connecting)))
+        await asyncio.wait_for(extra.logged_in.wait(), 60)
+        latecomer = time.perf_counter() - started
+        browsers.append(extra)
+        await asyncio.sleep(0.5)
+        results.put({
+            "adapter": usage(), "server": usage(server_pid), "idle": idle,
+            "tasks": len(asyncio.all_tasks()), "login_seconds": elapsed, "latecomer": latecomer,
+        })
+        for browser in browsers:
+            browser.leave.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def measure(mode, users, upstreams):
+    port = free_port()
+    server = multiprocessing.Process(target=serve_chat, args=(port,), daemon=True)
+    server.start()
+    deadline = time.monotonic() + 15
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+    results = multiprocessing.Queue()
+    client = multiprocessing.Process(target=run_adapter, args=(mode, users, upstreams, port, server.pid, results))
+    client.start()
+    try:
+        return results.get()
+    finally:
+        client.terminate()
+        server.terminate()
+        client.join()
+        server.join()
+
+
+def report(mode, users, result):
+    (adapter_mb, adapter_fds), (server_mb, server_fds) = result["adapter"], result["server"]
+    (idle_adapter_mb, _), (idle_server_mb, _) = result["idle"]
+    print(f"{mode:<4} {users:>7,}  adapter {adapter_mb:7.1f} MiB {adapter_fds:>6} fds {result['tasks']:>7,} tasks"
+          f"  | server {server_mb:7.1f} MiB {server_fds:>6} fds"
+          f"  | {1024 * (adapter_mb - idle_adapter_mb + server_mb - idle_server_mb) / users:5.1f} KiB/user"
+          f"  all logins {result['login_seconds']:.1f}s, one more {1000 * result['latecomer']:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", default="1000,10000,50000", help="Comma-separated user counts (multiplexed)")
+    parser.add_argument("--old-users", default="1000,10000", help="Comma-separated user counts (old adapter)")
+    parser.add_argument("--upstreams", type=int, default=adapter.DEFAULT_UPSTREAM_CONNECTIONS)
+    args = parser.parse_args()
+
+    print(f"ulimit -n: {os.sysconf('SC_OPEN_MAX')}, upstream connections: {args.upstreams}")
+    for users in [int(n) for n in args.old_users.split(",") if n]:
+        report("old", users, measure("old", users, args.upstreams))
+    for users in [int(n) for n in args.users.split(",") if n]:
+        report("mux", users, measure("mux", users, args.upstreams))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Message API inserts per second: single posts, the batch endpoint, and group commit.
+
+Drives the app in-process over ASGI from ``--concurrency`` posting tasks. By
+default the in-memory engine sits behind a simulated database: a pool of
+``--db-connections`` connections where every insert call costs ``--rtt-ms``
+plus a little per document, which is what group commit saves. Pass
+``--mongo-url`` to measure against a real mongod instead (the
+``bench_ingest`` database is dropped first); ``bench_storage`` compares the
+engines themselves.
+
+Usage: python -m benchmarks.bench_ingest [--seconds 3] [--concurrency 64] [--mongo-url mongodb://localhost:27017]
+"""
+import argparse
+import asyncio
+import time
+
+from httpx import ASGITransport, AsyncClient
+
+import src.p2p_chat.message_api as message_api
+from src.p2p_chat.storage import MemoryStorage, MongoStorage
+
+PER_DOCUMENT = 0.000005  # Simulated server time per inserted document
+
+
+class SimulatedStorage(MemoryStorage):
+    """The in-memory engine behind a database with round trips and a connection pool."""
+
+    def __init__(self, rtt, connections):
+        super().__init__()
+        self.rtt = rtt
+        self.pool = asyncio.Semaphore(connections)
+
+    async def _round_trip(self, documents):
+        async with self.pool:
+            await asyncio.sleep(self.rtt + PER_DOCUMENT * documents)
+
+    async def insert_many(self, documents):
+        await self._round_trip(len(documents))
+        return await super().insert_many(documents)
+
+
+async def make_storage(args):
+    if args.mongo_url:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(args.mongo_url)
+        await client.drop_database("bench_ingest")
+        return MongoStorage(client["bench_ingest"]["messages"])
+    return SimulatedStorage(args.rtt_ms / 1000, args.db_connections)
+
+
+def message(worker, i):
+    return {"sender": "thermometer", "destination": f"user{worker}", "message": f"reading {i}", "type": "notification"}
+
+
+async def single(client, worker, i, batch_size):
+    await client.post("/messages/", json=message(worker, i))
+    return 1
+
+
+async def batch(client, worker, i, batch_size):
+    await client.post("/messages/batch", json={"messages": [message(worker, i + j) for j in range(batch_size)]})
+    return batch_size
+
+
+async def measure(label, post, args, group_size):
+    app = message_api.create_app(storage=await make_storage(args),
+                                 group_size=group_size, group_delay=args.group_delay)
+    inserted = 0
+    deadline = time.perf_counter() + args.seconds
+
+    async def worker(client, n):
+        nonlocal inserted
+        i = 0
+        while time.perf_counter() < deadline:
+            count = await post(client, n, i, args.batch_size)
+            inserted += count
+            i += count
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://api") as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client, n) for n in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+    print(f"{label:<26} {inserted:>9,} inserts  {inserted / elapsed:>10,.0f} inserts/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--concurrency", type=int, default=64, help="Concurrent posting tasks")
+    parser.add_argument("--batch-size", type=int, default=100, help="Messages per batch request")
+    parser.add_argument("--group-size", type=int, default=message_api.DEFAULT_GROUP_SIZE)
+    parser.add_argument("--group-delay", type=float, default=message_api.DEFAULT_GROUP_DELAY)
+    parser.add_argument("--rtt-ms", type=float, default=1.0, help="Simulated round trip per insert call")
+    parser.add_argument("--db-connections", type=int, default=4, help="Simulated connection pool size")
+    parser.add_argument("--mongo-url", help="Measure against this mongod instead of the simulation")
+    args = parser.parse_args()
+
+    target = args.mongo_url or f"simulated db (rtt {args.rtt_ms} ms, {args.db_connections} connections)"
+    print(f"{target}, {args.concurrency} concurrent posters")
+    asyncio.run(measure("single posts, no grouping", single, args, group_size=1))
+    asyncio.run(measure(f"batch endpoint x{args.batch_size}", batch, args, group_size=1))
+    asyncio.run(measure("single posts, group commit", single, args, group_size=args.group_size))
+
+
+if __name__ == "__main__":
+    main()
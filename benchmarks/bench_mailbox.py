@@ -0,0 +1,99 @@
+"""
+Peak memory of delivering a large offline mailbox on login.
+
+Compares fetching the whole mailbox at once (the old ``GET /messages/{user}``)
+with paged claim/ack delivery through ``server.deliver_stored_messages``. The Message
+API is replaced by a generator of notification documents, so only the chat
+server's side is measured; the API side is bounded by the same page size.
+
+Usage: python -m benchmarks.bench_mailbox [--messages 100000]
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+import src.p2p_chat.server as server
+from src.p2p_chat.protocol import stored_event
+
+
+class NullWriter:
+    """A client that reads everything immediately."""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+    async def drain(self):
+        await asyncio.sleep(0)
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+def document(i):
+    return {
+        "_id": f"{i:012d}",
+        "sender": "thermometer",
+        "destination": "bob",
+        "timestamp": "2025-01-01T00:00:00+00:00",
+        "message": f"Temperature update: {20 + i % 10}°C",
+        "type": "notification",
+        "metadata": {"service": "thermometer", "reading": i},
+    }
+
+
+async def whole_mailbox(count):
+    writer = NullWriter()
+    conn = server.ClientConnection("bob", None, writer, version=2)
+    stored_msgs = [document(i) for i in range(count)]
+    writer.write(b"".join(conn.encode(stored_event(msg)) for msg in stored_msgs))
+    return writer.bytes
+
+
+async def paged_mailbox(count):
+    acked = 0
+
+    async def fake_get_stored_messages(username, api_base, limit=server.MAILBOX_PAGE_SIZE):
+        return [document(i) for i in range(acked, min(acked + limit, count))]
+
+    async def fake_ack_stored_messages(username, ids, api_base):
+        nonlocal acked
+        acked += len(ids)
+
+    server.get_stored_messages = fake_get_stored_messages
+    server.ack_stored_messages = fake_ack_stored_messages
+    writer = NullWriter()
+    conn = server.ClientConnection("bob", None, writer, version=2)
+    conn.start()
+    await server.deliver_stored_messages(conn)
+    await conn.close()
+    return writer.bytes
+
+
+def measure(label, deliver, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    sent = asyncio.run(deliver(count))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<15} {count:>8,} msgs  {sent / 1e6:7.1f} MB sent  peak {peak / 1e6:8.1f} MB  {elapsed:6.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=100000)
+    args = parser.parse_args()
+    for count in (args.messages // 10, args.messages):
+        measure("whole mailbox", whole_mailbox, count)
+        measure("paged", paged_mailbox, count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+OpenAI bot throughput against a stub completions endpoint, by worker count.
+
+Runs a stand-in for the completions endpoint under uvicorn in a child
+process; every call takes ``--latency`` seconds. A number of users each send
+the bot a few prompts at once, and the bot's request pool answers them (its
+replies are collected in memory instead of going through a chat server).
+Reports completions per second and how long one user's ``help`` waits, for
+each pool size. One worker is how the bot behaved before the pool: every
+request waited for the one in front of it.
+
+With ``--limit N`` the stub allows N calls per second, reports what is left
+in OpenAI's ``x-ratelimit-*`` headers and answers 429 (with ``retry-after``)
+beyond that; the 429s it sent are reported too.
+
+Every prompt is different unless ``--distinct N`` is given: then users ask
+N questions between them, the popular ones far more often (Zipf-like), in
+varying case and punctuation. That is run with and without the response
+cache, reporting API calls made and the mean wait for a reply.
+
+Usage: python -m benchmarks.bench_openai [--users 16] [--prompts 4] [--latency 0.25] [--workers 1,2,4,8,16,32] [--limit 0] [--distinct 0]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import random
+import socket
+import time
+from collections import deque
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+import src.p2p_chat.openai as openai_bot
+
+
+def stub_app(latency, limit):
+    app = FastAPI()
+    started = deque()  # When calls in the last second were let through
+    counts = {"calls": 0, "refused": 0}
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        headers = {}
+        if limit:
+            now = time.monotonic()
+            while started and now - started[0] > 1.0:
+                started.popleft()
+            reset_ms = int(1000 * (1.0 - (now - started[0]))) if started else 0
+            headers = {"x-ratelimit-limit-requests": str(limit),
+                       "x-ratelimit-remaining-requests": str(max(0, limit - len(started) - 1)),
+                       "x-ratelimit-reset-requests": f"{reset_ms}ms"}
+            if len(started) >= limit:
+                counts["refused"] += 1
+                return JSONResponse({"error": "rate limited"}, 429, {**headers, "retry-after-ms": str(reset_ms + 1)})
+            started.append(now)
+        counts["calls"] += 1
+        await asyncio.sleep(latency)
+        return JSONResponse({"choices": [{"message": {"content": f"re: {body['messages'][-1]['content']}"}}]},
+                            headers=headers)
+
+    @app.get("/counts")
+    async def get_counts():
+        result = dict(counts)
+        counts.update(calls=0, refused=0)
+        return result
+
+    return app
+
+
+def serve_stub(port, latency, limit):
+    uvicorn.run(stub_app(latency, limit), host="127.0.0.1", port=port, log_level="warning")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def questions(users, prompts, distinct, seed=3):
+    """What each user asks, in order."""
+    if not distinct:
+        return [[f"user{u} question {i}" for i in range(prompts)] for u in range(users)]
+    rng = random.Random(seed)
+    weights = [1 / rank for rank in range(1, distinct + 1)]
+    spellings = [str, lambda q: q + "?", lambda q: q.upper() + "!", lambda q: f"  {q} ", lambda q: q.capitalize() + "."]
+    asked = []
+    for u in range(users):
+        picks = rng.choices(range(distinct), weights, k=prompts)
+        asked.append([rng.choice(spellings)(f"tell me about topic {q}") for q in picks])
+    return asked
+
+
+async def run(url, workers, asked, cache=None):
+    total = sum(map(len, asked))
+    bot = openai_bot.OpenAIChatbot(workers=workers, queue_max=total + 1, api_url=url, cache=cache)
+    waits = []
+    helped = asyncio.Event()
+    started = time.perf_counter()
+
+    async def deliver(destination, message):
+        if message.startswith("OpenAI Chatbot"):
+            helped.set()
+        else:
+            waits.append(time.perf_counter() - started)
+        return True
+
+    bot.direct_send_message = deliver
+    bot.requests.start()
+    for i in range(max(map(len, asked))):
+        for u, prompts in enumerate(asked):
+            if i < len(prompts):
+                bot.requests.submit(f"user{u}", prompts[i])
+    bot.requests.submit("newcomer", "help")
+    await helped.wait()
+    help_wait = time.perf_counter() - started
+    await bot.requests.join()
+    elapsed = time.perf_counter() - started
+    await bot.requests.close()
+    await bot.close()
+    assert len(waits) == total
+    return elapsed, help_wait, sum(waits) / total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--prompts", type=int, default=4, help="Prompts each user sends")
+    parser.add_argument("--latency", type=float, default=0.25, help="Seconds per completion")
+    parser.add_argument("--workers", default="1,2,4,8,16,32")
+    parser.add_argument("--limit", type=int, default=0, help="Calls per second the stub allows (0: no limit)")
+    parser.add_argument("--distinct", type=int, default=0, help="Different questions users ask (0: all different)")
+    args = parser.parse_args()
+
+    openai_bot.OPENAI_API_KEY = openai_bot.OPENAI_API_KEY or "bench"
+    port = free_port()
+    stub = multiprocessing.Process(target=serve_stub, args=(port, args.latency, args.limit), daemon=True)
+    stub.start()
+    deadline = time.monotonic() + 15
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+    url = f"http://127.0.0.1:{port}/v1/chat/completions"
+    total = args.users * args.prompts
+    asked = questions(args.users, args.prompts, args.distinct)
+    caches = [("cache", None), ("no cache", False)] if args.distinct else [("", None)]
+    limit = f", stub allows {args.limit}/s" if args.limit else ""
+    print(f"{args.users} users x {args.prompts} prompts, {1000 * args.latency:.0f} ms per completion{limit}")
+    try:
+        for workers in [int(n) for n in args.workers.split(",")]:
+            for name, cache in caches:
+                elapsed, help_wait, mean_wait = asyncio.run(run(url, workers, asked, cache))
+                counts = httpx.get(f"http://127.0.0.1:{port}/counts").json()
+                print(f"workers {workers:>3} {name:<8}  {total / elapsed:7.1f} replies/s  {elapsed:6.1f}s total"
+                      f"  mean reply after {mean_wait:5.2f}s  help after {help_wait:5.2f}s"
+                      f"  {counts['calls']:>4} API calls  {counts['refused']} refused with 429")
+    finally:
+        stub.terminate()
+        stub.join()
+
+
+if __name__ == "__main__":
+    main()
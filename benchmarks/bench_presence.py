@@ -0,0 +1,134 @@
+"""
+Presence cost of a reconnect storm: full user lists versus versioned deltas.
+
+N users are online through the web adapter; all of them drop (say, an adapter
+restart) and then reconnect, spread over ``--storm-seconds``. Reported time is CPU time spent on presence.
+Measured for the old approach (every join/leave pushes the whole user list to
+every other browser, every login rebuilds the full list) and for the roster
+(first page on login, batched deltas serialized once and sent to every
+watcher). Browsers are fakes that serialize what they're sent, like
+Starlette's ``send_json``.
+
+The old approach is quadratic, so it runs at a smaller N by default.
+
+Usage: python -m benchmarks.bench_presence [--users 5000] [--old-users 300]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from src.p2p_chat.presence import PresenceBatcher, Roster
+
+
+class FakeBrowser:
+    def __init__(self, stats):
+        self.stats = stats
+
+    async def send_json(self, event):
+        self.stats["messages"] += 1
+        self.stats["bytes"] += len(json.dumps(event))
+
+    async def send_text(self, text):
+        self.stats["messages"] += 1
+        self.stats["bytes"] += len(text)
+
+
+async def old_storm(users):
+    stats = {"messages": 0, "bytes": 0}
+    browsers = {}
+
+    async def login(name):
+        browsers[name] = FakeBrowser(stats)
+        online = list(browsers.keys())
+        await browsers[name].send_json({"type": "login_success", "online_users": online})
+        for user, conn in browsers.items():
+            if user != name:
+                await conn.send_json({"type": "user_joined", "username": name, "online_users": online})
+
+    async def logout(name):
+        del browsers[name]
+        online = list(browsers.keys())
+        for conn in browsers.values():
+            await conn.send_json({"type": "user_left", "username": name, "online_users": online})
+
+    names = [f"user{i}" for i in range(users)]
+    for name in names:
+        await login(name)
+    stats.update(messages=0, bytes=0)
+    start = time.process_time()
+    for name in names:
+        await logout(name)
+    for name in names:
+        await login(name)
+    return time.process_time() - start, stats
+
+
+async def new_storm(users, window, storm_seconds):
+    stats = {"messages": 0, "bytes": 0}
+    browsers = {}
+    roster = Roster()
+    pending = []
+
+    def publish(event):
+        text = json.dumps(event)
+        pending.append(asyncio.gather(*(conn.send_text(text) for conn in list(browsers.values()))))
+
+    batcher = PresenceBatcher(roster, publish, window=window)
+
+    async def login(name):
+        browsers[name] = FakeBrowser(stats)
+        roster.join(name)
+        page = roster.snapshot()
+        await browsers[name].send_json({
+            "type": "login_success", "online_users": page["users"], "online_count": page["count"],
+            "presence_version": page["version"], "next": page["next"],
+        })
+        batcher.changed()
+
+    async def logout(name):
+        del browsers[name]
+        roster.leave(name)
+        batcher.changed()
+
+    names = [f"user{i}" for i in range(users)]
+    for name in names:
+        await login(name)
+    batcher.flush()
+    await asyncio.gather(*pending)
+    pending.clear()
+    stats.update(messages=0, bytes=0)
+
+    start = time.process_time()
+    for step in (logout, login):
+        for i, name in enumerate(names):
+            await step(name)
+            if i % 100 == 99:
+                await asyncio.sleep(storm_seconds * 50 / users)  # Let batch windows fire
+    await asyncio.sleep(window)
+    await asyncio.gather(*pending)
+    return time.process_time() - start, stats
+
+
+def report(label, users, elapsed, stats):
+    print(f"{label:<22} users={users:<6} {elapsed:8.3f} s CPU  {stats['messages']:>12,} msgs  "
+          f"{stats['bytes'] / 1e6:>10,.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--old-users", type=int, default=300, help="N for the full-list approach")
+    parser.add_argument("--window", type=float, default=0.05, help="Presence batch window in seconds")
+    parser.add_argument("--storm-seconds", type=float, default=2.0, help="How long the reconnects take")
+    args = parser.parse_args()
+
+    elapsed, stats = asyncio.run(old_storm(args.old_users))
+    report("full list per event", args.old_users, elapsed, stats)
+    for users in sorted({args.old_users, args.users}):
+        elapsed, stats = asyncio.run(new_storm(users, args.window, args.storm_seconds))
+        report("roster + deltas", users, elapsed, stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Throughput of the v1 text protocol versus the framed v2 protocol.
+
+Starts an in-process chat server with storage stubbed out, logs in a sender
+and a receiver, and measures delivered messages per second:
+
+- v1: the sender must wait for each message to arrive before sending the next,
+  since v1 has no framing and back-to-back writes merge into one read.
+- v2 lock-step: same pattern over frames, for a like-for-like comparison.
+- v2 pipelined: the sender writes frames in batches without waiting.
+
+Usage: python -m benchmarks.bench_protocol [--messages N] [--batch N]
+"""
+import argparse
+import asyncio
+import time
+
+import src.p2p_chat.server as server
+from src.p2p_chat.protocol import FrameDecoder, encode_frame, open_connection
+
+
+async def _no_store(*args, **kwargs):
+    pass
+
+
+async def _no_mail(*args, **kwargs):
+    return []
+
+
+async def v1_login(host, port, username):
+    reader, writer = await asyncio.open_connection(host, port)
+    await reader.readuntil(b": ")
+    writer.write(username.encode() + b"\n")
+    await writer.drain()
+    await reader.readline()  # Welcome line
+    return reader, writer
+
+
+async def v2_login(host, port, username):
+    reader, writer = await open_connection(host, port, username)
+    decoder = FrameDecoder()
+    while not decoder.feed(await reader.read(65536)):
+        pass
+    return reader, writer, decoder
+
+
+async def bench_v1(host, port, count):
+    rx_reader, rx_writer = await v1_login(host, port, "rx_v1")
+    _, tx_writer = await v1_login(host, port, "tx_v1")
+    start = time.perf_counter()
+    for i in range(count):
+        tx_writer.write(f"rx_v1: message {i}\n".encode())
+        await tx_writer.drain()
+        await rx_reader.readline()
+    elapsed = time.perf_counter() - start
+    for writer in (rx_writer, tx_writer):
+        writer.close()
+    return count / elapsed
+
+
+async def bench_v2(host, port, count, batch):
+    rx_reader, rx_writer, decoder = await v2_login(host, port, f"rx_v2_{batch}")
+    _, tx_writer, _ = await v2_login(host, port, f"tx_v2_{batch}")
+    frame = {"type": "chat", "destination": f"rx_v2_{batch}", "message": ""}
+    start = time.perf_counter()
+    sent = received = 0
+    while sent < count:
+        n = min(batch, count - sent)
+        tx_writer.write(b"".join(
+            encode_frame({**frame, "message": f"message {sent + i}"}) for i in range(n)
+        ))
+        await tx_writer.drain()
+        sent += n
+        while received < sent:
+            received += len(decoder.feed(await rx_reader.read(65536)))
+    elapsed = time.perf_counter() - start
+    for writer in (rx_writer, tx_writer):
+        writer.close()
+    return count / elapsed
+
+
+async def run(count, batch):
+    server.store_message = _no_store
+    server.get_stored_messages = _no_mail
+    chat_server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    host, port = chat_server.sockets[0].getsockname()[:2]
+
+    results = [
+        ("v1 (lock-step)", await bench_v1(host, port, count)),
+        ("v2 (lock-step)", await bench_v2(host, port, count, 1)),
+        (f"v2 (pipelined x{batch})", await bench_v2(host, port, count, batch)),
+    ]
+    print(f"{'protocol':<24}{'msgs/sec':>12}")
+    for name, rate in results:
+        print(f"{name:<24}{rate:>12,.0f}")
+
+    chat_server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="v1 vs v2 protocol throughput")
+    parser.add_argument("--messages", type=int, default=20000, help="Messages per run")
+    parser.add_argument("--batch", type=int, default=64, help="Frames per pipelined write")
+    args = parser.parse_args()
+    asyncio.run(run(args.messages, args.batch))
+
+
+if __name__ == "__main__":
+    main()
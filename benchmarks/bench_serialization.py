@@ -0,0 +1,105 @@
+"""
+Requests/sec and CPU per message for a 1k-message mailbox fetch.
+
+Serves ``GET /messages/{user}?limit=1000`` in-process over ASGI from a
+mailbox that never drains, with ObjectId ids as MongoDB returns them, and
+decodes each reply the way the chat server would. Compared:
+
+- the old endpoint: a Python loop stringifying ``_id`` and FastAPI's
+  default ``jsonable_encoder`` + ``json.dumps`` response
+- the current endpoint with stdlib JSON (orjson not installed)
+- the current endpoint with orjson
+- the current endpoint with MessagePack (``Accept: application/msgpack``)
+
+Usage: python -m benchmarks.bench_serialization [--messages 1000] [--seconds 3]
+"""
+import argparse
+import asyncio
+import time
+
+from bson import ObjectId
+from fastapi import FastAPI
+from httpx import ASGITransport, AsyncClient
+
+import src.p2p_chat.codec as codec
+import src.p2p_chat.message_api as message_api
+
+
+def mailbox(count):
+    return [
+        {"_id": ObjectId(), "sender": "thermometer", "destination": "bob",
+         "message": f"Temperature update: {20 + i % 10}°C", "timestamp": "2025-01-01T00:00:00+00:00",
+         "type": "notification", "metadata": {"service": "thermometer", "reading": i}}
+        for i in range(count)
+    ]
+
+
+class FixedMailbox:
+    """A storage engine whose mailbox refills itself, so every fetch is the same."""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def setup(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def take(self, destination, limit, after=None, now=None):
+        return [dict(doc) for doc in self.docs[:limit]], False
+
+
+def old_app(docs):
+    app = FastAPI()
+
+    @app.get("/messages/{username}")
+    async def get_messages(username: str, limit: int = 500):
+        raw_messages = [dict(doc) for doc in docs[:limit]]
+        messages = []
+        for msg in raw_messages:
+            msg["_id"] = str(msg["_id"])
+            messages.append(msg)
+        return {"messages": messages, "next": None}
+
+    return app
+
+
+async def measure(label, app, count, seconds, accept=codec.JSON):
+    requests = 0
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://api") as client:
+        cpu, start = time.process_time(), time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            response = await client.get("/messages/bob", params={"limit": count}, headers={"Accept": accept})
+            reply = codec.decode(response.content, response.headers["content-type"])
+            assert len(reply["messages"]) == count
+            requests += 1
+        cpu, elapsed = time.process_time() - cpu, time.perf_counter() - start
+    print(f"{label:<22} {requests / elapsed:>8,.1f} req/s  {cpu / (requests * count) * 1e6:>7.2f} us CPU/msg  "
+          f"{len(response.content) / 1e3:>6.0f} KB/reply")
+
+
+async def run(args):
+    docs = mailbox(args.messages)
+    print(f"{args.messages:,}-message mailbox fetch, client decode included")
+    await measure("old endpoint", old_app(docs), args.messages, args.seconds)
+    app = message_api.create_app(storage=FixedMailbox(docs))
+    orjson = codec.orjson
+    codec.orjson = None
+    await measure("stdlib json", app, args.messages, args.seconds)
+    codec.orjson = orjson
+    if orjson is not None:
+        await measure("orjson", app, args.messages, args.seconds)
+    if codec.msgpack_available():
+        await measure("msgpack", app, args.messages, args.seconds, accept=codec.MSGPACK)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--seconds", type=float, default=3)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Page loads per second and bytes per page load for the web UI's index page.
+
+Runs the web adapter under uvicorn in a child process on loopback and has
+concurrent clients fetch ``GET /`` for a few seconds, against:
+
+- old: the original handler, which reads ``static/index.html`` from disk on
+  every request and sends it uncompressed with no validators
+- first visit: the in-memory assets, with the browser's ``Accept-Encoding``
+- revisit: the same, with the ``If-None-Match`` a browser sends from its cache
+
+Usage: python -m benchmarks.bench_static [--clients 50] [--seconds 5]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import time
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import HTMLResponse
+
+import src.p2p_chat.static_assets as static_assets
+import src.p2p_chat.websocket_adapter as adapter
+
+BROWSER_ENCODINGS = "gzip, deflate, br, zstd"
+
+
+def old_app():
+    """The adapter's page handler before assets were cached."""
+    app = FastAPI()
+
+    @app.get("/")
+    async def get_html():
+        with open(adapter.static_path / "index.html", "r") as f:
+            return HTMLResponse(content=f.read())
+
+    return app
+
+
+def serve(mode, port):
+    app = old_app() if mode == "old" else adapter.app
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def load_pages(port, headers, clients, seconds):
+    """(page loads, bytes received) from ``clients`` keep-alive connections.
+
+    A bare HTTP/1.1 client, so that on a small machine the benchmark spends
+    its CPU in the server rather than in an HTTP library.
+    """
+    request = "GET / HTTP/1.1\r\nHost: web\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+    request = request.encode()
+    loads = 0
+    received = 0
+    deadline = time.perf_counter() + seconds
+
+    async def client_loop():
+        nonlocal loads, received
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        while time.perf_counter() < deadline:
+            writer.write(request)
+            head = await reader.readuntil(b"\r\n\r\n")
+            status = int(head.split(b" ", 2)[1])
+            assert status in (200, 304), status
+            length = 0
+            for line in head.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":", 1)[1])
+            await reader.readexactly(length)
+            loads += 1
+            received += len(head) + length
+        writer.close()
+
+    await asyncio.gather(*(client_loop() for _ in range(clients)))
+    return loads, received
+
+
+def measure(mode, headers, clients, seconds):
+    port = free_port()
+    server = multiprocessing.Process(target=serve, args=(mode, port), daemon=True)
+    server.start()
+    url = f"http://127.0.0.1:{port}/"
+    try:
+        deadline = time.monotonic() + 15
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        etag = httpx.get(url).headers.get("etag")
+        if headers.pop("If-None-Match", None) is not None:
+            headers["If-None-Match"] = etag
+        return asyncio.run(load_pages(port, headers, clients, seconds))
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    args = parser.parse_args()
+
+    size = (adapter.static_path / "index.html").stat().st_size
+    print(f"index.html: {size:,} bytes, brotli {'available' if static_assets.brotli else 'not installed'}")
+    runs = [
+        ("old", "old", {"Accept-Encoding": BROWSER_ENCODINGS}),
+        ("first visit", "new", {"Accept-Encoding": BROWSER_ENCODINGS}),
+        ("first visit (gzip only)", "new", {"Accept-Encoding": "gzip"}),
+        ("revisit", "new", {"Accept-Encoding": BROWSER_ENCODINGS, "If-None-Match": True}),
+    ]
+    for name, mode, headers in runs:
+        loads, received = measure(mode, dict(headers), args.clients, args.seconds)
+        print(f"{name:<24} {loads / args.seconds:8,.0f} pages/s  {received / loads:8,.0f} bytes/page")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Insert and fetch throughput of the Message API storage engines.
+
+Runs the same workload against each engine: ``--messages`` notifications
+spread over ``--users`` mailboxes, stored one at a time and then in batches
+(like ``POST /messages/`` and ``POST /messages/batch``), and every mailbox
+drained through claim + ack pages (the chat server's login path). MongoDB is
+included when ``--mongo-url`` is given; its ``bench_storage`` database is
+dropped first. Finally the log engine is filled with ``--restart-messages``
+and reopened, to time the index rebuild.
+
+Usage: python -m benchmarks.bench_storage [--messages 20000] [--users 100] [--restart-messages 1000000] [--mongo-url mongodb://localhost:27017]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from src.p2p_chat.logstore import LogStorage
+from src.p2p_chat.storage import MemoryStorage, MongoStorage, SQLiteStorage
+
+
+def document(i, users):
+    return {
+        "sender": "thermometer",
+        "destination": f"user{i % users}",
+        "message": f"Temperature update: {20 + i % 10}°C",
+        "timestamp": "2025-01-01T00:00:00+00:00",
+        "type": "notification",
+        "metadata": {"service": "thermometer", "reading": i},
+    }
+
+
+async def drain(storage, users, page):
+    fetched = 0
+    for u in range(users):
+        while True:
+            _, messages = await storage.claim(f"user{u}", page, lease=30)
+            if not messages:
+                break
+            fetched += len(messages)
+            await storage.ack(f"user{u}", [msg["_id"] for msg in messages])
+    return fetched
+
+
+async def measure(name, storage, args):
+    await storage.setup()
+    rates = []
+
+    start = time.perf_counter()
+    for i in range(args.messages):
+        await storage.insert_many([document(i, args.users)])
+    rates.append(args.messages / (time.perf_counter() - start))
+    start = time.perf_counter()
+    rates.append(await drain(storage, args.users, args.page) / (time.perf_counter() - start))
+
+    start = time.perf_counter()
+    for i in range(0, args.messages, args.batch_size):
+        await storage.insert_many([document(j, args.users) for j in range(i, min(i + args.batch_size, args.messages))])
+    rates.append(args.messages / (time.perf_counter() - start))
+    start = time.perf_counter()
+    rates.append(await drain(storage, args.users, args.page) / (time.perf_counter() - start))
+
+    await storage.close()
+    print(f"{name:<8}" + "".join(f"{rate:>16,.0f}" for rate in rates))
+
+
+async def run(args):
+    print(f"{args.messages:,} messages over {args.users} mailboxes, claim/ack pages of {args.page}")
+    print(f"{'engine':<8}{'single ins/s':>16}{'fetch msg/s':>16}{'batch ins/s':>16}{'fetch msg/s':>16}")
+    await measure("memory", MemoryStorage(), args)
+    with tempfile.TemporaryDirectory() as tmp:
+        await measure("sqlite", SQLiteStorage(os.path.join(tmp, "messages.db")), args)
+        await measure("log", LogStorage(os.path.join(tmp, "log")), args)
+    if args.mongo_url:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(args.mongo_url)
+        await client.drop_database("bench_storage")
+        await measure("mongo", MongoStorage(client["bench_storage"]["messages"]), args)
+    else:
+        print("mongo    (skipped, pass --mongo-url)")
+    if args.restart_messages:
+        await restart(args)
+
+
+async def restart(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = LogStorage(tmp)
+        for i in range(0, args.restart_messages, 1000):
+            await storage.insert_many([document(j, args.users) for j in range(i, min(i + 1000, args.restart_messages))])
+        await storage.close()
+        size = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp))
+
+        start = time.perf_counter()
+        storage = LogStorage(tmp)
+        elapsed = time.perf_counter() - start
+        assert sum([await storage.count(f"user{u}") for u in range(args.users)]) == args.restart_messages
+        await storage.close()
+    print(f"log restart: {args.restart_messages:,} messages, {size / 1e6:,.0f} MB on disk, index rebuilt in {elapsed:.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=100, help="Mailboxes the messages are spread over")
+    parser.add_argument("--batch-size", type=int, default=100, help="Messages per batch insert")
+    parser.add_argument("--page", type=int, default=500, help="Messages per claim")
+    parser.add_argument("--restart-messages", type=int, default=1000000, help="Log size for the restart test (0 skips it)")
+    parser.add_argument("--mongo-url", help="Also measure MongoDB at this URL")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Latency of ``GET /messages/{username}/summary`` as a mailbox grows.
+
+Fills one mailbox to each of ``--sizes`` messages (from three senders, two
+message types) and times ``summary()`` on every engine. Summaries come from
+counters, so the latency should not grow with the mailbox. For contrast the
+SQLite row also times the GROUP BY scan a summary would otherwise need.
+MongoDB is included when ``--mongo-url`` is given; its ``bench_summary``
+database is dropped first.
+
+Usage: python -m benchmarks.bench_summary [--sizes 10,1000,100000,1000000] [--calls 200] [--mongo-url mongodb://localhost:27017]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from src.p2p_chat.logstore import LogStorage
+from src.p2p_chat.storage import MemoryStorage, MongoStorage, SQLiteStorage
+
+SENDERS = ("thermometer", "alice", "openai_bot")
+BATCH = 5000
+
+SCAN = ("SELECT sender, type, COUNT(*), MAX(timestamp) FROM messages "
+        "WHERE destination = ? GROUP BY sender, type")
+
+
+def document(i):
+    return {
+        "sender": SENDERS[i % len(SENDERS)],
+        "destination": "bob",
+        "message": f"message {i}",
+        "timestamp": f"2025-01-01T00:00:00.{i:07d}",
+        "type": "notification" if i % 2 else "chat",
+        "metadata": {},
+    }
+
+
+async def latency(call, calls):
+    """Median seconds per call."""
+    times = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        await call()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+async def measure(name, storage, args, scan=None):
+    await storage.setup()
+    stored, row, scan_row = 0, [], []
+    for size in args.sizes:
+        while stored < size:
+            count = min(BATCH, size - stored)
+            await storage.insert_many([document(i) for i in range(stored, stored + count)])
+            stored += count
+        assert (await storage.summary("bob"))["total"] == size
+        row.append(await latency(lambda: storage.summary("bob"), args.calls))
+        if scan is not None:
+            scan_row.append(await latency(lambda: storage._run(lambda: storage.db.execute(SCAN, ("bob",)).fetchall()),
+                                          max(args.calls // 20, 3)))
+    await storage.close()
+    print(f"{name:<16}" + "".join(f"{t * 1e6:>14,.0f}" for t in row))
+    if scan_row:
+        print(f"{name + ' GROUP BY':<16}" + "".join(f"{t * 1e6:>14,.0f}" for t in scan_row))
+
+
+async def run(args):
+    print(f"Median summary latency in microseconds, {args.calls} calls per size")
+    print(f"{'engine':<16}" + "".join(f"{size:>14,}" for size in args.sizes))
+    await measure("memory", MemoryStorage(), args)
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite = SQLiteStorage(os.path.join(tmp, "messages.db"))
+        await measure("sqlite", sqlite, args, scan=True)
+        await measure("log", LogStorage(os.path.join(tmp, "log")), args)
+    if args.mongo_url:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(args.mongo_url)
+        await client.drop_database("bench_summary")
+        await measure("mongo", MongoStorage(client["bench_summary"]["messages"]), args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=lambda text: [int(n) for n in text.split(",")], default=[10, 1000, 100000, 1000000])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--mongo-url")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Delivered messages per second for ``p2p-chat-server --workers N``.
+
+Starts the Message API (in-memory storage) and the chat server as child
+processes, then drives it from several load-generator processes. Each one logs
+in pairs of users and streams pipelined v2 frames from one to the other; with
+SO_REUSEPORT the two ends of a pair usually land on different workers, so most
+traffic goes through cross-worker forwarding.
+
+Throughput can only scale up to the number of cores left over after the load
+generators, so compare runs on a machine with a few spare cores.
+
+Usage: python -m benchmarks.bench_workers [--workers 1,2,4] [--clients 4] [--pairs 8] [--seconds 5]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import uvicorn
+
+import src.p2p_chat.message_api as message_api
+from src.p2p_chat.storage import MemoryStorage
+from src.p2p_chat.protocol import FrameDecoder, encode_frame, open_connection
+
+BATCH = 32  # Frames pipelined per write
+
+
+def serve_api(port):
+    app = message_api.create_app(storage=MemoryStorage())
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def login(port, username):
+    reader, writer = await open_connection("127.0.0.1", port, username)
+    decoder = FrameDecoder()
+    while not any(f["type"] == "login_success" for f in decoder.feed(await reader.read(65536))):
+        pass
+    return reader, writer, decoder
+
+
+async def drive_pair(port, name, seconds, counts):
+    rx_reader, rx_writer, decoder = await login(port, f"rx_{name}")
+    _, tx_writer, _ = await login(port, f"tx_{name}")
+    frame = encode_frame({"type": "chat", "destination": f"rx_{name}", "message": "x" * 64})
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        tx_writer.write(frame * BATCH)
+        await tx_writer.drain()
+        received = 0
+        while received < BATCH:
+            received += sum(f["type"] == "chat" for f in decoder.feed(await rx_reader.read(65536)))
+        counts.append(received)
+    for writer in (rx_writer, tx_writer):
+        writer.close()
+
+
+def load_generator(port, client_id, pairs, seconds, results):
+    counts = []
+
+    async def run():
+        await asyncio.gather(*(
+            drive_pair(port, f"{client_id}_{i}", seconds, counts) for i in range(pairs)
+        ))
+
+    asyncio.run(run())
+    results.put(sum(counts))
+
+
+def measure(workers, args, api_base):
+    port = free_port()
+    chat = subprocess.Popen(
+        [sys.executable, "-m", "src.p2p_chat.server", "--host", "127.0.0.1", "--port", str(port),
+         "--api-base", api_base, "--workers", str(workers)],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        asyncio.run(wait_for_port(port))
+        time.sleep(0.5)  # Let every worker bind before connections arrive
+        results = multiprocessing.Queue()
+        generators = [
+            multiprocessing.Process(target=load_generator, args=(port, c, args.pairs, args.seconds, results))
+            for c in range(args.clients)
+        ]
+        for g in generators:
+            g.start()
+        total = sum(results.get() for _ in generators)
+        for g in generators:
+            g.join()
+        return total / args.seconds
+    finally:
+        chat.terminate()
+        chat.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts to compare")
+    parser.add_argument("--clients", type=int, default=4, help="Load-generator processes")
+    parser.add_argument("--pairs", type=int, default=8, help="Sender/receiver pairs per load generator")
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    api_port = free_port()
+    api = multiprocessing.Process(target=serve_api, args=(api_port,), daemon=True)
+    api.start()
+    asyncio.run(wait_for_port(api_port))
+    api_base = f"http://127.0.0.1:{api_port}"
+
+    print(f"{os.cpu_count()} CPUs, {args.clients} load generators x {args.pairs} pairs")
+    baseline = None
+    try:
+        for workers in [int(w) for w in args.workers.split(",")]:
+            rate = measure(workers, args, api_base)
+            baseline = baseline or rate
+            print(f"workers={workers:<3} {rate:>10,.0f} msgs/s  ({rate / baseline:.2f}x)")
+    finally:
+        api.terminate()
+
+
+if __name__ == "__main__":
+    main()
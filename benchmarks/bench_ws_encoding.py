@@ -0,0 +1,118 @@
+"""
+Bytes on the wire and adapter CPU for each browser encoding.
+
+Takes a mixed stream of events as the web adapter receives them from the
+chat server (chat, thermometer notifications with a ``temps`` array,
+presence deltas and roster pages), turns each one into a browser frame the
+way the adapter does, and writes it through wsproto (the WebSocket library
+uvicorn uses here) with and without permessage-deflate. Reports WebSocket
+bytes per message and adapter CPU per 10k messages for:
+
+- json: the JSON body forwarded as a text frame, as before
+- msgpack: the body re-encoded as MessagePack in a binary frame
+
+Every frame is read back by a wsproto client to check that it decodes.
+
+Usage: python -m benchmarks.bench_ws_encoding [--messages 10000]
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime, UTC
+
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import AcceptConnection, BytesMessage, Request, TextMessage
+from wsproto.extensions import PerMessageDeflate
+
+from src.p2p_chat import codec
+from src.p2p_chat.protocol import encode_frame
+from src.p2p_chat.websocket_adapter import SUBPROTOCOL_JSON, SUBPROTOCOL_MSGPACK
+
+
+def event_stream(count, seed=7):
+    """Upstream bodies (JSON bytes, as framed by the chat server) in a realistic mix."""
+    rng = random.Random(seed)
+    users = [f"user{i}" for i in range(500)]
+    bodies = []
+    for i in range(count):
+        now = datetime.now(UTC).isoformat()
+        kind = rng.random()
+        if kind < 0.5:
+            event = {"type": "chat", "sender": rng.choice(users), "timestamp": now,
+                     "message": " ".join(rng.choice(["hi", "ok", "see you at 3", "lunch?", "thanks!"]) for _ in range(3))}
+        elif kind < 0.85:
+            event = {"type": "notification", "sender": "thermometer1", "timestamp": now,
+                     "message": "Temperature update",
+                     "metadata": {"sensor": "lab-1", "unit": "C",
+                                  "temps": [round(rng.uniform(18, 26), 2) for _ in range(24)]}}
+        elif kind < 0.98:
+            event = {"type": "presence", "version": i, "joined": rng.sample(users, 5), "left": rng.sample(users, 3)}
+        else:
+            page = sorted(rng.sample(users, 100))
+            event = {"type": "roster", "users": page, "count": 500, "version": i, "next": page[-1]}
+        # The adapter gets exactly what encode_frame carries after the length prefix
+        bodies.append(encode_frame(event)[4:])
+    return bodies
+
+
+def connect(subprotocol, deflate):
+    """A negotiated (server, client) pair of wsproto connections."""
+    client = WSConnection(ConnectionType.CLIENT)
+    server = WSConnection(ConnectionType.SERVER)
+    extensions = [PerMessageDeflate()] if deflate else []
+    server.receive_data(client.send(Request(host="web", target="/ws", subprotocols=[subprotocol],
+                                            extensions=[PerMessageDeflate()] if deflate else [])))
+    request = next(server.events())
+    client.receive_data(server.send(AcceptConnection(subprotocol=subprotocol, extensions=extensions)))
+    accepted = next(client.events())
+    assert accepted.subprotocol == subprotocol
+    assert bool(accepted.extensions) == deflate, accepted.extensions
+    return server, client
+
+
+def to_json(body):
+    return TextMessage(data=body.decode())
+
+
+def to_msgpack(body):
+    return BytesMessage(data=codec.pack(codec.loads_json(body)))
+
+
+def measure(bodies, encode, subprotocol, deflate):
+    server, client = connect(subprotocol, deflate)
+    wire = []
+    start = time.process_time()
+    for body in bodies:
+        wire.append(server.send(encode(body)))
+    cpu = time.process_time() - start
+
+    # Check the browser end gets the events back
+    for body, frame in zip(bodies[:200], wire):
+        client.receive_data(frame)
+        message = next(client.events())
+        data = json.loads(message.data) if subprotocol == SUBPROTOCOL_JSON else codec.unpack(message.data)
+        assert data == json.loads(body)
+    return sum(len(frame) for frame in wire), cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=10000)
+    args = parser.parse_args()
+
+    bodies = event_stream(args.messages)
+    print(f"{args.messages:,} events, {sum(map(len, bodies)) / len(bodies):.0f} bytes of JSON each on average"
+          f" (orjson {'on' if codec.orjson else 'off'})")
+    encodings = [("json", to_json, SUBPROTOCOL_JSON)]
+    if codec.msgpack_available():
+        encodings.append(("msgpack", to_msgpack, SUBPROTOCOL_MSGPACK))
+    for name, encode, subprotocol in encodings:
+        for deflate in (False, True):
+            wire, cpu = measure(bodies, encode, subprotocol, deflate)
+            label = name + (" + deflate" if deflate else "")
+            print(f"{label:<18} {wire / len(bodies):7.1f} bytes/msg  {1000 * cpu * 10000 / len(bodies):7.1f} ms CPU per 10k")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Shared, pooled HTTP client for Message API traffic.
+
+Every process talks to a single Message API, so instead of opening a new
+``httpx.AsyncClient`` (and a new TCP connection) per request we keep one
+long-lived client per event loop with keep-alive connections.  Call
+``close_client()`` on shutdown to release the pool.
+
+``call()`` also negotiates the body format: every request offers MessagePack
+in ``Accept``, and once an API has answered in it, request bodies to that API
+are sent as MessagePack as well.
+"""
+import asyncio
+import importlib.util
+import httpx
+
+from . import codec
+
+DEFAULT_MAX_CONNECTIONS = 100  # Total sockets the pool may open
+DEFAULT_MAX_KEEPALIVE = 20  # Idle sockets kept around for reuse
+DEFAULT_KEEPALIVE_EXPIRY = 30.0  # Seconds an idle socket is kept
+DEFAULT_TIMEOUT = 10.0  # Read/write/pool timeout in seconds
+DEFAULT_CONNECT_TIMEOUT = 5.0
+EVENT_READ_TIMEOUT = 60.0  # Seconds an event stream may stay silent; the API pings every 15
+
+settings = {
+    "max_connections": DEFAULT_MAX_CONNECTIONS,
+    "max_keepalive": DEFAULT_MAX_KEEPALIVE,
+    "keepalive_expiry": DEFAULT_KEEPALIVE_EXPIRY,
+    "timeout": DEFAULT_TIMEOUT,
+    "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+    "http2": False,
+    "msgpack": True,
+}
+
+_client = None
+_client_loop = None
+_msgpack_apis = set()  # (scheme, host, port) of APIs that have answered in MessagePack
+
+
+def configure(**options):
+    """Update pool settings. Takes effect the next time a client is created."""
+    unknown = set(options) - set(settings)
+    if unknown:
+        raise ValueError(f"Unknown API client options: {', '.join(sorted(unknown))}")
+    settings.update(options)
+
+
+def http2_available():
+    return importlib.util.find_spec("h2") is not None
+
+
+def build_client(**overrides):
+    """Create a new client using the configured pool settings."""
+    options = {**settings, **overrides}
+    http2 = options["http2"]
+    if http2 and not http2_available():
+        print("[API CLIENT] HTTP/2 requested but the 'h2' package is not installed; using HTTP/1.1")
+        http2 = False
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=options["max_connections"],
+            max_keepalive_connections=options["max_keepalive"],
+            keepalive_expiry=options["keepalive_expiry"],
+        ),
+        timeout=httpx.Timeout(options["timeout"], connect=options["connect_timeout"]),
+        http2=http2,
+    )
+
+
+def get_client():
+    """Return the process-wide client, creating it on first use.
+
+    Pooled connections belong to the loop that opened them, so a new client is
+    created if the running loop has changed (e.g. between test cases).
+    """
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = build_client()
+        _client_loop = loop
+    return _client
+
+
+async def call(method, url, payload=None, params=None, check=False):
+    """Send a request to the Message API and return its decoded reply.
+
+    With ``check`` an error status raises ``httpx.HTTPStatusError``.
+    """
+    api = httpx.URL(url)
+    api = (api.scheme, api.host, api.port)
+    msgpack = settings["msgpack"] and codec.msgpack_available()
+    headers = {"Accept": f"{codec.MSGPACK}, {codec.JSON};q=0.9" if msgpack else codec.JSON}
+    content = None
+    if payload is not None:
+        content_type = codec.MSGPACK if msgpack and api in _msgpack_apis else codec.JSON
+        headers["Content-Type"] = content_type
+        content = codec.encode(payload, content_type)
+
+    response = await get_client().request(method, url, content=content, params=params, headers=headers)
+    if check:
+        response.raise_for_status()
+    content_type = response.headers.get("content-type")
+    if codec.is_msgpack(content_type):
+        _msgpack_apis.add(api)
+    return codec.decode(response.content, content_type)
+
+
+async def post(url, payload=None, params=None, check=False):
+    return await call("POST", url, payload, params, check)
+
+
+async def events(url):
+    """Follow a server-sent event stream, yielding (event, data) pairs.
+
+    Raises ``httpx.HTTPStatusError`` if the stream can't be opened and
+    ``httpx.ReadTimeout`` if it goes quiet for too long.
+    """
+    timeout = httpx.Timeout(EVENT_READ_TIMEOUT, connect=settings["connect_timeout"])
+    async with get_client().stream("GET", url, timeout=timeout, headers={"Accept": "text/event-stream"}) as response:
+        response.raise_for_status()
+        event, data = "message", []
+        async for line in response.aiter_lines():
+            if not line:
+                if data:
+                    yield event, codec.loads_json("\n".join(data))
+                event, data = "message", []
+            elif line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data.append(line[5:].strip())
+
+
+async def close_client():
+    """Close the shared client and its pooled connections."""
+    global _client, _client_loop
+    client, _client, _client_loop = _client, None, None
+    if client is not None and not client.is_closed:
+        await client.aclose()
+
+
+def add_arguments(parser):
+    """Add the API client pool options to an argparse parser."""
+    group = parser.add_argument_group('Message API client')
+    group.add_argument('--api-max-connections', type=int, default=DEFAULT_MAX_CONNECTIONS,
+                       help='Maximum pooled connections to the Message API')
+    group.add_argument('--api-max-keepalive', type=int, default=DEFAULT_MAX_KEEPALIVE,
+                       help='Idle keep-alive connections to retain')
+    group.add_argument('--api-timeout', type=float, default=DEFAULT_TIMEOUT,
+                       help='Message API request timeout in seconds')
+    group.add_argument('--api-http2', action='store_true',
+                       help='Use HTTP/2 to the Message API when available (requires h2 and TLS)')
+    group.add_argument('--api-json', action='store_true',
+                       help='Always use JSON with the Message API instead of negotiating MessagePack')
+
+
+def configure_from_args(args):
+    """Apply options added by ``add_arguments``."""
+    configure(
+        max_connections=args.api_max_connections,
+        max_keepalive=args.api_max_keepalive,
+        timeout=args.api_timeout,
+        http2=args.api_http2,
+        msgpack=not args.api_json,
+    )
@@ -1,6 +1,8 @@
 import asyncio
 import argparse
 
+from .protocol import USERNAME_PROMPT, encode_frame, hello_line, iter_frames, parse_v1_request, render_v1
+
 DEFAULT_HOST = '127.0.0.1'  # Server IP
 DEFAULT_PORT = 5000  # Server Port
 
@@ -8,38 +10,34 @@ async def handle_client(host=DEFAULT_HOST, port=DEFAULT_PORT):
     """Connects to the server and enables private messaging."""
     reader, writer = await asyncio.open_connection(host, port)
 
-    # Receive and set username
-    username_prompt = await reader.read(1024)
+    # Receive and set username, asking the server for framed (v2) mode
+    username_prompt = await reader.readuntil(USERNAME_PROMPT.encode())
     print(username_prompt.decode(), end=" ")
     username = input()
-    writer.write(username.encode() + b'\n')
+    writer.write(hello_line(username))
     await writer.drain()
 
     print("Type 'TO_USER: message' to send a message. Type '!check' to view stored messages. Type 'exit' to disconnect.")
 
     async def receive():
         """Handles incoming messages from the server."""
-        while True:
-            try:
-                data = await reader.read(1024)
-                if not data:
-                    break
-                print(f"\n{data.decode()}", end=" ")
-            except:
-                break
+        try:
+            async for event in iter_frames(reader):
+                print(f"\n{render_v1(event)}", end=" ")
+        except:
+            pass
 
     async def send():
         """Handles sending messages to the server."""
         while True:
             message = await asyncio.to_thread(input, "You: ")
-            if message.lower() == "exit":
-                writer.write("exit".encode())
-                await writer.drain()
+            request = parse_v1_request(message)
+            writer.write(encode_frame(request))
+            await writer.drain()
+            if request["type"] == "exit":
                 writer.close()
                 await writer.wait_closed()
                 break
-            writer.write(message.encode())
-            await writer.drain()
 
     # Run send and receive tasks concurrently
     await asyncio.gather(receive(), send())
@@ -58,4 +56,4 @@ def main_entry():
     main(args.host, args.port)
 
 if __name__ == "__main__":
-    main_entry()
\ No newline at end of file
+    main_entry()
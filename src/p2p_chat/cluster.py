@@ -0,0 +1,256 @@
+"""
+Cluster mode: several chat servers on different hosts acting as one.
+
+Start each node with a unique ``--node-id``, the address other nodes reach it
+on (``--cluster-listen``) and every other node (``--peer ID=HOST:PORT``).
+Nodes keep a persistent TCP link to each other, forming a full mesh:
+
+- every node gossips its own logins, logouts and room changes, so each one
+  holds a full username -> node directory and can forward live messages
+  straight to the node holding the recipient, batched per link;
+- username claims are arbitrated by a registry node chosen by hashing the
+  username, which makes duplicate logins on two nodes fail just like on one.
+  While the registry node can't be reached, logins for its names are refused.
+
+When a node's link drops its users are treated as offline, so messages to
+them are stored through the Message API as before, and the room memberships
+only it told us about are dropped.
+"""
+import asyncio
+import itertools
+import zlib
+
+from . import server as chat_server
+from .protocol import iter_frames
+from .workers import PeerLink, deliver_forwarded
+
+DEFAULT_CLUSTER_PORT = 5100  # Node-to-node links
+LINK_RETRY = 1.0  # Seconds between reconnect attempts to a peer
+CLAIM_TIMEOUT = 2.0  # Give up waiting on the registry node after this long
+
+
+def parse_address(address, default_port=DEFAULT_CLUSTER_PORT):
+    host, _, port = address.rpartition(":")
+    if not host:
+        return port, default_port
+    return host, int(port)
+
+
+def parse_peer(spec):
+    """Parse ``ID=HOST:PORT`` into ``(id, (host, port))``."""
+    node_id, sep, address = spec.partition("=")
+    if not sep or not node_id:
+        raise ValueError(f"Peers look like ID=HOST:PORT, got {spec!r}")
+    return node_id, parse_address(address)
+
+
+class ClusterRouter:
+    """Routes messages to users held by other nodes of the cluster."""
+
+    def __init__(self, node_id, listen, peers, api_base=chat_server.DEFAULT_API_BASE):
+        self.node_id = node_id
+        self.listen = listen  # (host, port) for inbound node links
+        self.peer_addresses = dict(peers)  # node id -> (host, port)
+        self.api_base = api_base
+        self.nodes = sorted([node_id, *self.peer_addresses])
+        self.directory = {}  # username -> node id, for users on other nodes
+        self.registrations = {}  # username -> node id, for names this node arbitrates
+        self.live = set()  # Peers with an open inbound link
+        self.links = {}  # node id -> PeerLink
+        self.learned_rooms = {}  # node id -> {(room, username)} memberships only that node told us about
+        self.claims = {}  # request id -> future
+        self.claim_ids = itertools.count()
+
+    async def start(self):
+        host, port = self.listen
+        self.listener = await asyncio.start_server(self._handle_node, host, port)
+        for node, (host, port) in self.peer_addresses.items():
+            link = self.links[node] = PeerLink(
+                f"node {node}",
+                lambda host=host, port=port: asyncio.open_connection(host, port),
+                greeting=self._greeting,
+                retry=LINK_RETRY,
+            )
+            link.start()
+        print(f"[CLUSTER] Node {self.node_id} listening on {self.listen[0]}:{self.listen[1]}, "
+              f"peers: {', '.join(self.peer_addresses) or 'none'}")
+
+    def _greeting(self):
+        return [
+            {"type": "hello", "node": self.node_id},
+            {
+                "type": "snapshot",
+                "users": list(chat_server.clients),
+                "rooms": {room: sorted(members) for room, members in chat_server.rooms.items()},
+            },
+        ]
+
+    def _gossip(self, frame):
+        for link in self.links.values():
+            if link.connected:
+                link.send(frame)
+
+    def _reachable(self, node):
+        link = self.links.get(node)
+        return link is not None and link.connected and node in self.live
+
+    def registry_for(self, username):
+        return self.nodes[zlib.crc32(username.encode()) % len(self.nodes)]
+
+    def _register(self, username, node):
+        holder = self.registrations.get(username) or self.directory.get(username)
+        if holder is not None and holder != node and (holder == self.node_id or holder in self.live):
+            return False
+        self.registrations[username] = node
+        return True
+
+    async def claim(self, username):
+        """Reserve ``username`` cluster-wide and announce the login."""
+        ok = await self._claim(username)
+        if ok:
+            self._gossip({"type": "presence", "username": username, "node": self.node_id})
+        return ok
+
+    async def _claim(self, username):
+        if username in self.directory:
+            return False
+        registry = self.registry_for(username)
+        if registry == self.node_id:
+            return self._register(username, self.node_id)
+        if not self._reachable(registry):
+            # Without the registry two nodes could both accept the name, so refuse it until it is back
+            print(f"[CLUSTER] Registry node {registry} is unreachable; refusing {username}")
+            return False
+
+        request_id = next(self.claim_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.claims[request_id] = future
+        self.links[registry].send({"type": "claim", "id": request_id, "username": username, "node": self.node_id})
+        try:
+            return await asyncio.wait_for(future, CLAIM_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"[CLUSTER] Registry node {registry} didn't answer for {username}; refusing the login")
+            return False
+        finally:
+            self.claims.pop(request_id, None)
+
+    def release(self, username):
+        if self.registrations.get(username) == self.node_id:
+            del self.registrations[username]
+        self._gossip({"type": "presence", "username": username, "node": None})
+
+    def room_changed(self, op, username, room):
+        self._gossip({"type": op, "username": username, "room": room})
+
+    def forward(self, username, event):
+        """Send an event to a user on another node. False if they're not online there."""
+        return not self.forward_many([username], event)
+
+    def forward_many(self, usernames, event):
+        """Forward one event to many users, one frame per node.
+
+        Returns the users that aren't online on any reachable node.
+        """
+        by_node = {}
+        offline = []
+        for username in usernames:
+            node = self.directory.get(username)
+            if node is None or not self._reachable(node):
+                offline.append(username)
+            else:
+                by_node.setdefault(node, []).append(username)
+        for node, targets in by_node.items():
+            self.links[node].send({"type": "deliver", "usernames": targets, "event": event})
+        return offline
+
+    def broadcast(self, event):
+        self._gossip({"type": "broadcast", "event": event})
+
+    def _forget(self, node):
+        for username in [u for u, n in self.directory.items() if n == node]:
+            del self.directory[username]
+            chat_server.roster.leave(username)
+        for username in [u for u, n in self.registrations.items() if n == node]:
+            del self.registrations[username]
+        for room, username in self.learned_rooms.pop(node, ()):
+            if username not in chat_server.clients:
+                chat_server.leave_room(username, room, propagate=False)
+
+    def _learn_room(self, node, room, username):
+        if username not in chat_server.rooms.get(room, ()):
+            chat_server.join_room(username, room, propagate=False)
+            self.learned_rooms.setdefault(node, set()).add((room, username))
+
+    async def _handle_node(self, reader, writer):
+        node = None
+        try:
+            async for frame in iter_frames(reader):
+                kind = frame["type"]
+                if kind in ("deliver", "broadcast"):
+                    deliver_forwarded(frame, self.api_base)
+                elif kind == "hello":
+                    node = frame["node"]
+                    self.live.add(node)
+                    print(f"[CLUSTER] Node {node} connected")
+                elif kind == "snapshot":
+                    self._forget(node)
+                    for username in frame["users"]:
+                        self.directory[username] = node
+                        chat_server.roster.join(username)
+                        if self.registry_for(username) == self.node_id:
+                            self.registrations[username] = node
+                    for room, members in frame["rooms"].items():
+                        for username in members:
+                            self._learn_room(node, room, username)
+                elif kind == "presence":
+                    username = frame["username"]
+                    if frame["node"] is None:
+                        if self.directory.get(username) == node:
+                            del self.directory[username]
+                            chat_server.roster.leave(username)
+                        if self.registrations.get(username) == node:
+                            del self.registrations[username]
+                    else:
+                        self.directory[username] = frame["node"]
+                        chat_server.roster.join(username)
+                elif kind == "claim":
+                    ok = (frame["username"] not in chat_server.clients
+                          and self._register(frame["username"], frame["node"]))
+                    if frame["node"] in self.links:
+                        self.links[frame["node"]].send({"type": "claimed", "id": frame["id"], "ok": ok})
+                elif kind == "claimed":
+                    future = self.claims.get(frame["id"])
+                    if future is not None and not future.done():
+                        future.set_result(frame["ok"])
+                elif kind == "join":
+                    self._learn_room(node, frame["room"], frame["username"])
+                elif kind == "leave":
+                    chat_server.leave_room(frame["username"], frame["room"], propagate=False)
+                    for learned in self.learned_rooms.values():
+                        learned.discard((frame["room"], frame["username"]))
+        except Exception as e:
+            print(f"[CLUSTER] Link from node {node} failed: {e}")
+        finally:
+            if node is not None:
+                print(f"[CLUSTER] Node {node} disconnected")
+                self.live.discard(node)
+                self._forget(node)
+            writer.close()
+
+    async def close(self):
+        for link in self.links.values():
+            await link.close()
+        self.listener.close()
+
+
+async def run_node(node_id, listen, peers, host=chat_server.DEFAULT_HOST, port=chat_server.DEFAULT_PORT,
+                   api_base=chat_server.DEFAULT_API_BASE, outbound_settings=None):
+    """Run this process as one node of a cluster."""
+    if outbound_settings is not None:
+        chat_server.outbound_settings.update(outbound_settings)
+    router = chat_server.router = ClusterRouter(node_id, listen, peers, api_base)
+    await router.start()
+    try:
+        await chat_server.run_server(host, port, api_base)
+    finally:
+        await router.close()
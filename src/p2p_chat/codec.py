@@ -0,0 +1,68 @@
+"""
+Body encodings shared by the Message API and its clients.
+
+JSON goes through orjson when it is installed (falling back to the standard
+library), and MessagePack is offered as ``application/msgpack`` when the
+``msgpack`` package is available. Both encoders turn values they don't know,
+such as MongoDB ObjectIds, into strings, so documents can be sent as they
+come out of the database.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+
+def msgpack_available():
+    return msgpack is not None
+
+
+def dumps_json(obj):
+    """Serialize to JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=str).encode()
+
+
+def loads_json(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def pack(obj):
+    """Serialize to MessagePack bytes."""
+    return msgpack.packb(obj, default=str)
+
+
+def unpack(data):
+    return msgpack.unpackb(data)
+
+
+def wants_msgpack(accept):
+    """True if an ``Accept`` header asks for MessagePack and we can produce it."""
+    return msgpack is not None and MSGPACK in (accept or "")
+
+
+def is_msgpack(content_type):
+    return (content_type or "").split(";")[0].strip() == MSGPACK
+
+
+def encode(obj, content_type):
+    return pack(obj) if is_msgpack(content_type) else dumps_json(obj)
+
+
+def decode(data, content_type):
+    if not data:
+        return None
+    return unpack(data) if is_msgpack(content_type) else loads_json(data)
@@ -0,0 +1,486 @@
+"""
+Log-structured mailbox storage for the Message API (``--storage log``).
+
+Messages are appended to segment files, one active segment per shard, and a
+destination always maps to the same shard. Each record is a fixed header
+followed by the destination and the JSON body:
+
+    crc32 | kind | destination length | body length | message id | destination | body
+
+Messages that expire are written as a different kind whose body starts with
+the expiry time, so the expiry queue can be rebuilt without parsing JSON.
+Acks, expiry and trimming append small tombstone records instead of
+rewriting anything. The
+in-memory index (destination -> id -> location) is rebuilt on startup by
+walking the record headers, so only the destination bytes of each record are
+read; bodies are only touched when a mailbox is fetched, straight out of the
+mmap'd segment. A background task compacts sealed segments once most of
+their bytes are acked, copying the survivors forward and deleting the file;
+the reading, syncing and deleting happen in a worker thread.
+
+Claims live only in memory: after a restart, claimed but unacked messages are
+simply offered again. The latest message per coalesce key is only tracked in
+memory too, so readings stored before a restart are not replaced by later
+ones; they still expire. Records reach the OS on every batch, so they survive
+a crash of the API process but not of the machine.
+
+Unread counters (``summary``) are kept for every mailbox as messages come
+and go. After a restart a mailbox's counters are rebuilt from its bodies the
+first time its summary is asked for, then kept up to date again.
+"""
+import asyncio
+import heapq
+import json
+import mmap
+import os
+import struct
+import time
+import uuid
+import zlib
+from collections import defaultdict
+
+from .summary import Tally, empty_summary
+
+DEFAULT_LOG_DIR = "mailbox-log"
+DEFAULT_SHARDS = 4
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024  # Bytes before the active segment is sealed
+COMPACT_INTERVAL = 30.0  # Seconds between compaction passes
+COMPACT_THRESHOLD = 0.5  # Compact sealed segments with less than this share of live bytes
+VERIFY_TAIL = 4 * 1024 * 1024  # Bytes at the end of an active segment whose checksums are checked on startup
+
+HEADER = struct.Struct("<IBHIQ")
+EXPIRY = struct.Struct("<d")
+MESSAGE, ACK, EXPIRING_MESSAGE = 0, 1, 2
+
+
+def encode_record(kind, msg_id, destination, body=b""):
+    crc = zlib.crc32(body, zlib.crc32(destination))
+    return HEADER.pack(crc, kind, len(destination), len(body), msg_id) + destination + body
+
+class Segment:
+    """One append-only segment file, read through a read-only mmap."""
+
+    def __init__(self, path, seq):
+        self.path = path
+        self.seq = seq
+        self.file = open(path, "ab")
+        self.size = self.file.tell()
+        self.live = 0  # Bytes of unacked messages and of tombstones still needed
+        self.dead_ids = set()  # Acked messages whose record is still in this file
+        self.map = None
+
+    def append(self, data):
+        offset = self.size
+        self.file.write(data)
+        self.size += len(data)
+        return offset
+
+    def flush(self):
+        self.file.flush()
+
+    def view(self):
+        """The mapped file, remapped if it has grown since the last read."""
+        if self.map is None or len(self.map) < self.size:
+            if self.map is not None:
+                self.map.close()
+            with open(self.path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def records(self, verify_from=None):
+        """Yield (kind, destination bytes, id, offset, length) for every whole record.
+
+        Checksums are checked for records from ``verify_from`` on. The file is
+        truncated at the first torn or corrupt record.
+        """
+        if self.size == 0:
+            return
+        view, size, unpack, header = self.view(), self.size, HEADER.unpack_from, HEADER.size
+        verify_from = size if verify_from is None else verify_from
+        pos = 0
+        while pos + header <= size:
+            crc, kind, dest_len, body_len, msg_id = unpack(view, pos)
+            start = pos + header
+            end = start + dest_len + body_len
+            if end > size or (pos >= verify_from and zlib.crc32(view[start:end]) != crc):
+                break
+            yield kind, view[start:start + dest_len], msg_id, pos, end - pos
+            pos = end
+        if pos < self.size:
+            print(f"Truncating {self.size - pos} bytes of torn records from {self.path}")
+            self.truncate(pos)
+
+    def truncate(self, size):
+        self.close()
+        os.truncate(self.path, size)
+        self.file = open(self.path, "ab")
+        self.size = size
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+class LogStorage:
+    """Mailboxes in sharded append-only segment files with an in-memory index."""
+
+    def __init__(self, path=DEFAULT_LOG_DIR, shards=DEFAULT_SHARDS, segment_size=DEFAULT_SEGMENT_SIZE,
+                 compact_interval=COMPACT_INTERVAL):
+        self.path = path
+        self.shards = shards
+        self.segment_size = segment_size
+        self.compact_interval = compact_interval
+        self.segments = {shard: [] for shard in range(shards)}  # Oldest first; the last one is active
+        self.index = defaultdict(dict)  # destination -> {id: (segment, offset, record length)}, oldest first
+        self.claims = {}  # id -> claimed until
+        self.dead = {}  # Acked id -> [segment holding its record, segment holding its tombstone, tombstone size]
+        self.expiry = []  # Heap of (expires_at, id, destination); ids may already be gone
+        self.latest = {}  # (destination, sender, coalesce key) -> id of the newest such message
+        self.tallies = {}  # destination -> Tally
+        self.untallied = set()  # Destinations with messages from before the restart and no Tally yet
+        self.next_id = 1
+        self.compactor = None
+        os.makedirs(path, exist_ok=True)
+        self._rebuild()
+
+    # ----------------------
+    # Startup
+    # ----------------------
+    def _rebuild(self):
+        start = time.perf_counter()
+        found = defaultdict(list)
+        for name in os.listdir(self.path):
+            if name.endswith(".seg"):
+                shard, seq = (int(part) for part in name[:-4].split("-"))
+                found[shard].append(seq)
+
+        records = 0
+        mailboxes = {}  # Destination bytes -> index entry, so names are decoded once
+        for shard in range(self.shards):
+            seqs = sorted(found.get(shard, [])) or [0]
+            for i, seq in enumerate(seqs):
+                segment = Segment(self._segment_path(shard, seq), seq)
+                self.segments[shard].append(segment)
+                # Only the active segment can end in a half-written record
+                verify_from = segment.size - VERIFY_TAIL if i == len(seqs) - 1 else None
+                view = segment.view() if segment.size else None
+                for kind, raw, msg_id, offset, length in segment.records(verify_from):
+                    records += 1
+                    if msg_id >= self.next_id:
+                        self.next_id = msg_id + 1
+                    mailbox = mailboxes.get(raw)
+                    if mailbox is None:
+                        mailbox = mailboxes[raw] = self.index[raw.decode()]
+                    if kind != ACK:
+                        # A copy left behind by an interrupted compaction: the later one wins
+                        stale = mailbox.get(msg_id)
+                        if stale is not None:
+                            stale[0].live -= length
+                        mailbox[msg_id] = (segment, offset, length)
+                        segment.live += length
+                        if kind == EXPIRING_MESSAGE:
+                            expires_at = EXPIRY.unpack_from(view, offset + HEADER.size + len(raw))[0]
+                            self.expiry.append((expires_at, msg_id, raw.decode()))
+                    else:
+                        owner = self._forget(raw.decode(), msg_id)
+                        if owner is not None:
+                            self._bury(msg_id, owner, segment, length)
+                        if not mailbox:
+                            del mailboxes[raw]
+                            self.index.pop(raw.decode(), None)
+        heapq.heapify(self.expiry)
+        self.untallied = set(self.index)
+        if records:
+            print(f"Rebuilt mailbox index from {records:,} records in {time.perf_counter() - start:.2f}s")
+
+    def _segment_path(self, shard, seq):
+        return os.path.join(self.path, f"{shard:02d}-{seq:010d}.seg")
+
+    def _shard(self, destination):
+        return zlib.crc32(destination.encode()) % self.shards
+
+    def _active(self, shard):
+        segment = self.segments[shard][-1]
+        if segment.size >= self.segment_size:
+            segment.flush()
+            segment = Segment(self._segment_path(shard, segment.seq + 1), segment.seq + 1)
+            self.segments[shard].append(segment)
+        return segment
+
+    def _forget(self, destination, msg_id):
+        """Drop an acked message from the index; its record becomes garbage."""
+        mailbox = self.index.get(destination)
+        entry = mailbox.pop(msg_id, None) if mailbox else None
+        if entry is None:
+            return None
+        tally = self.tallies.get(destination)
+        if tally is not None:
+            tally.remove_message(self._message(msg_id, entry, len(destination.encode())))
+        if not mailbox:
+            del self.index[destination]
+            self.tallies.pop(destination, None)
+            self.untallied.discard(destination)
+        self.claims.pop(msg_id, None)
+        segment, _, length = entry
+        segment.live -= length
+        segment.dead_ids.add(msg_id)
+        return segment
+
+    def _bury(self, msg_id, owner, tombstone_segment, length):
+        """Note where an acked message's tombstone is; it stays live until the record is gone."""
+        self.dead[msg_id] = [owner, tombstone_segment, length]
+        tombstone_segment.live += length
+
+    # ----------------------
+    # Engine interface
+    # ----------------------
+    async def setup(self):
+        if self.compactor is None:
+            self.compactor = asyncio.create_task(self._compact_forever())
+
+    async def close(self):
+        if self.compactor is not None:
+            self.compactor.cancel()
+            try:
+                await self.compactor
+            except asyncio.CancelledError:
+                pass
+            self.compactor = None
+        for segments in self.segments.values():
+            for segment in segments:
+                segment.close()
+
+    async def insert_many(self, documents):
+        ids = []
+        touched = set()
+        superseded = defaultdict(list)
+        for document in documents:
+            msg_id = self.next_id
+            self.next_id += 1
+            destination = document["destination"].encode()
+            expires_at = document.get("expires_at")
+            body = json.dumps({k: v for k, v in document.items() if k != "expires_at"}, separators=(",", ":")).encode()
+            if expires_at is None:
+                record = encode_record(MESSAGE, msg_id, destination, body)
+            else:
+                record = encode_record(EXPIRING_MESSAGE, msg_id, destination, EXPIRY.pack(expires_at) + body)
+                heapq.heappush(self.expiry, (expires_at, msg_id, document["destination"]))
+            segment = self._active(self._shard(document["destination"]))
+            offset = segment.append(record)
+            segment.live += len(record)
+            touched.add(segment)
+            self.index[document["destination"]][msg_id] = (segment, offset, len(record))
+            ids.append(str(msg_id))
+            if document["destination"] not in self.untallied:
+                tally = self.tallies.get(document["destination"])
+                if tally is None:
+                    tally = self.tallies[document["destination"]] = Tally()
+                tally.add_message(document)
+
+            key = (document.get("metadata") or {}).get("coalesce")
+            if key is not None:
+                previous = self.latest.get((document["destination"], document["sender"], key))
+                self.latest[(document["destination"], document["sender"], key)] = msg_id
+                if previous is not None:
+                    superseded[document["destination"]].append(previous)
+        for segment in touched:
+            segment.flush()
+        now = time.time()
+        for destination, old_ids in superseded.items():
+            # Claimed readings are on their way to the reader already
+            self._tombstone(destination, [i for i in old_ids if self.claims.get(i, 0) <= now])
+        return ids
+
+    @staticmethod
+    def _message(msg_id, entry, dest_len):
+        segment, offset, length = entry
+        view = segment.view()
+        start = offset + HEADER.size + dest_len
+        if view[offset + 4] == EXPIRING_MESSAGE:  # The kind byte, after the crc
+            start += EXPIRY.size
+        msg = json.loads(view[start:offset + length])
+        msg["_id"] = str(msg_id)
+        return msg
+
+    def _visible(self, destination, now, after=0):
+        claims = self.claims
+        for msg_id, entry in self.index.get(destination, {}).items():
+            if msg_id > after and claims.get(msg_id, 0) <= now:
+                yield msg_id, entry
+
+    async def take(self, destination, limit, after=None, now=None):
+        now = time.time() if now is None else now
+        page = []
+        for item in self._visible(destination, now, int(after) if after else 0):
+            page.append(item)
+            if len(page) > limit:
+                break
+        more = len(page) > limit
+        dest_len = len(destination.encode())
+        messages = [self._message(msg_id, entry, dest_len) for msg_id, entry in page[:limit]]
+        await self.ack(destination, [msg["_id"] for msg in messages])
+        return messages, more
+
+    async def claim(self, destination, limit, lease, now=None):
+        now = time.time() if now is None else now
+        claim = uuid.uuid4().hex
+        dest_len = len(destination.encode())
+        messages = []
+        for msg_id, entry in self._visible(destination, now):
+            self.claims[msg_id] = now + lease
+            messages.append(self._message(msg_id, entry, dest_len))
+            if len(messages) == limit:
+                break
+        return (claim if messages else None), messages
+
+    async def ack(self, destination, ids):
+        return self._tombstone(destination, [int(i) for i in ids if i.isdigit()])
+
+    async def trim(self, destination, cap, kind=None):
+        mailbox = self.index.get(destination, {})
+        if kind is None:
+            excess = len(mailbox) - cap
+        else:
+            excess = (await self.summary(destination))["by_type"].get(kind, 0) - cap
+        if excess <= 0:
+            return 0
+        oldest = []
+        dest_len = len(destination.encode())
+        for msg_id, entry in mailbox.items():
+            if kind is None or self._message(msg_id, entry, dest_len).get("type", "chat") == kind:
+                oldest.append(msg_id)
+                if len(oldest) == excess:
+                    break
+        return self._tombstone(destination, oldest)
+
+    async def expire(self, now):
+        due = defaultdict(list)
+        while self.expiry and self.expiry[0][0] <= now:
+            _, msg_id, destination = heapq.heappop(self.expiry)
+            due[destination].append(msg_id)
+        return sum(self._tombstone(destination, ids) for destination, ids in due.items())
+
+    def _tombstone(self, destination, ids):
+        """Drop messages from a mailbox and log that they are gone; returns how many were there."""
+        if not ids:
+            return 0
+        encoded = destination.encode()
+        segment = self._active(self._shard(destination))
+        tombstones = []
+        for msg_id in ids:
+            owner = self._forget(destination, msg_id)
+            if owner is not None:
+                tombstones.append(encode_record(ACK, msg_id, encoded))
+                self._bury(msg_id, owner, segment, len(tombstones[-1]))
+        if tombstones:
+            segment.append(b"".join(tombstones))
+            segment.flush()
+        return len(tombstones)
+
+    async def count(self, destination):
+        return len(self.index.get(destination, {}))
+
+    async def summary(self, destination):
+        if destination in self.untallied:
+            tally = self.tallies[destination] = Tally()
+            dest_len = len(destination.encode())
+            for msg_id, entry in self.index[destination].items():
+                tally.add_message(self._message(msg_id, entry, dest_len))
+            self.untallied.discard(destination)
+        tally = self.tallies.get(destination)
+        return tally.summary() if tally is not None else empty_summary()
+
+    # ----------------------
+    # Compaction
+    # ----------------------
+    async def _compact_forever(self):
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            await self.compact()
+
+    async def compact(self):
+        """Rewrite sealed segments that are mostly acked; returns how many were removed."""
+        removed = 0
+        for shard, segments in self.segments.items():
+            for segment in list(segments[:-1]):
+                if segment.live < segment.size * COMPACT_THRESHOLD:
+                    await self._compact_segment(shard, segment)
+                    removed += 1
+        return removed
+
+    async def _compact_segment(self, shard, segment):
+        """Copy a sealed segment's surviving records forward, then delete it.
+
+        Reading the old file, syncing the copies and removing the file happen
+        in a worker thread. Only the appends run on the event loop, since they
+        share the active segment with inserts and must stay in log order.
+        """
+        segment.view()  # Mapped here, so the worker thread only reads it
+        records = await asyncio.to_thread(self._survivors, segment)
+
+        # Checked again: acks may have come in while the thread was reading
+        moved = set()
+        for kind, raw, msg_id, data in records:
+            length = len(data)
+            if kind != ACK:
+                mailbox = self.index.get(raw.decode())
+                entry = mailbox.get(msg_id) if mailbox else None
+                if entry is None or entry[0] is not segment:
+                    continue
+                target = self._active(shard)
+                mailbox[msg_id] = (target, target.append(data), length)
+                target.live += length
+            else:
+                grave = self.dead.get(msg_id)
+                if grave is None or grave[0] is segment or grave[1] is not segment:
+                    continue
+                target = self._active(shard)
+                target.append(data)
+                grave[1] = target
+                target.live += length
+            moved.add(target)
+        for target in moved:
+            target.flush()
+        # The copies must be on disk before the only other copy is deleted
+        await asyncio.to_thread(self._sync, moved)
+
+        # Records acked here are gone for good, so their tombstones elsewhere are garbage now
+        for msg_id in segment.dead_ids:
+            grave = self.dead.pop(msg_id, None)
+            if grave is not None and grave[1] is not segment:
+                grave[1].live -= grave[2]
+        self.segments[shard].remove(segment)
+        await asyncio.to_thread(self._discard, segment)
+
+    def _survivors(self, segment):
+        """(kind, destination bytes, id, record bytes) for every record that looks live.
+
+        Runs in a worker thread and only reads the index; the caller checks
+        each record again before keeping it.
+        """
+        view = segment.view()
+        records = []
+        for kind, raw, msg_id, offset, length in segment.records():
+            if kind != ACK:
+                mailbox = self.index.get(raw.decode())
+                entry = mailbox.get(msg_id) if mailbox else None
+                if entry is None or entry[0] is not segment:
+                    continue
+            else:
+                # Keep a tombstone only while its message's record is still in another file
+                grave = self.dead.get(msg_id)
+                if grave is None or grave[0] is segment or grave[1] is not segment:
+                    continue
+            records.append((kind, bytes(raw), msg_id, view[offset:offset + length]))
+        return records
+
+    @staticmethod
+    def _sync(segments):
+        for segment in segments:
+            os.fsync(segment.file.fileno())
+
+    @staticmethod
+    def _discard(segment):
+        segment.close()
+        os.remove(segment.path)
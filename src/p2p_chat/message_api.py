@@ -1,50 +1,301 @@
-from fastapi import FastAPI
-from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
 from datetime import datetime, UTC
-from motor.motor_asyncio import AsyncIOMotorClient
+import asyncio
 import uvicorn
-import os
 import argparse
+import time
 from dotenv import load_dotenv
+from . import codec
+from .notify import Notifier
+from .retention import SWEEP_INTERVAL, Retention, parse_caps, parse_retention
+from .storage import STORAGE_KINDS, BatchInsertError, MongoStorage, open_storage
 load_dotenv()
 
+DEFAULT_PAGE_LIMIT = 500  # Messages returned per mailbox fetch
+MAX_PAGE_LIMIT = 5000
+DEFAULT_LEASE = 30.0  # Seconds claimed messages stay hidden waiting for an ack
+MAX_LEASE = 600.0
+DEFAULT_GROUP_SIZE = 256  # Single posts buffered before a group commit is forced
+DEFAULT_GROUP_DELAY = 0.002  # Seconds the first buffered post waits for company
+MAX_WAIT = 120.0  # Longest a claim may wait for mail (long-poll)
+SSE_PING = 15.0  # Seconds between keep-alive comments on idle event streams
+SHUTDOWN_GRACE = 5.0  # Seconds open event streams get before the server stops anyway
+
 # Pydantic message model
 class Message(BaseModel):
     sender: str
     destination: str
     message: str
-    timestamp: str = datetime.now(UTC).isoformat()
+    timestamp: str = Field(default_factory=lambda: datetime.now(UTC).isoformat())
     type: str = "chat"  # can be "chat", "command", "notification", or "subscription"
     metadata: dict = {}  # optional metadata for special message types
 
-def create_app(mongo_url=None):
-    """Create and configure the FastAPI application."""
-    app = FastAPI(title="P2P Chat Message API")
+class MessageBatch(BaseModel):
+    messages: list[Message]
+
+class Ack(BaseModel):
+    ids: list[str]
+
+class FastJSONResponse(Response):
+    """JSON through orjson when available; ObjectIds are written as strings."""
+    media_type = codec.JSON
+
+    def render(self, content):
+        return codec.dumps_json(content)
+
+class MsgPackResponse(Response):
+    media_type = codec.MSGPACK
+
+    def render(self, content):
+        return codec.pack(content)
+
+def reply(request, content):
+    """Answer in MessagePack if the client asked for it, JSON otherwise."""
+    if codec.wants_msgpack(request.headers.get("accept")):
+        return MsgPackResponse(content)
+    return FastJSONResponse(content)
+
+def sse(event, data):
+    """One server-sent event."""
+    return b"event: " + event.encode() + b"\ndata: " + codec.dumps_json(data) + b"\n\n"
+
+async def event_stream(sub, describe):
+    """Stream ``mail`` events for a subscription, with pings while it is quiet.
+
+    A ``ready`` event first tells the reader the subscription is in place.
+    """
+    try:
+        yield sse("ready", {})
+        while True:
+            destinations = await sub.next(SSE_PING)
+            yield sse("mail", await describe(destinations)) if destinations else b": ping\n\n"
+    finally:
+        sub.close()
+
+def body(model):
+    """Dependency that validates a JSON or MessagePack request body as ``model``.
+
+    JSON goes straight from bytes to the model through pydantic's own parser,
+    skipping the intermediate dicts FastAPI would build.
+    """
+    async def parse(request: Request):
+        raw = await request.body()
+        try:
+            if codec.is_msgpack(request.headers.get("content-type")):
+                if not codec.msgpack_available():
+                    raise HTTPException(415, "MessagePack is not supported by this server")
+                try:
+                    return model.model_validate(codec.unpack(raw))
+                except ValueError as e:
+                    if isinstance(e, ValidationError):
+                        raise
+                    raise HTTPException(400, f"Invalid MessagePack body: {e}")
+            return model.model_validate_json(raw)
+        except ValidationError as e:
+            raise RequestValidationError(e.errors(include_url=False))
+    return parse
+
+class GroupCommit:
+    """Buffer single inserts and write them with one unordered ``insert_many``.
+
+    A group is flushed once ``max_size`` documents are waiting or ``delay``
+    seconds after the first one arrived. Every caller awaits its own future,
+    which resolves to the message's id or raises that document's error.
+    """
+
+    def __init__(self, storage, max_size=DEFAULT_GROUP_SIZE, delay=DEFAULT_GROUP_DELAY):
+        self.storage = storage
+        self.max_size = max_size
+        self.delay = delay
+        self.pending = []  # (document, future)
+        self.timer = None
+        self.tasks = set()
+
+    async def insert(self, document):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((document, future))
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.delay, self.flush)
+        return await future
+
+    def flush(self):
+        """Start writing whatever is buffered."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        group, self.pending = self.pending, []
+        task = asyncio.create_task(self._write(group))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def close(self):
+        """Flush the buffer and wait for every write in flight."""
+        self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+
+    async def _write(self, group):
+        ids, failed = [None] * len(group), {}
+        try:
+            ids = await self.storage.insert_many([doc for doc, _ in group])
+        except BatchInsertError as e:
+            ids = e.ids
+            failed = {i: RuntimeError(reason) for i, reason in e.failed.items()}
+        except Exception as e:
+            failed = {i: e for i in range(len(group))}
+
+        for i, (_, future) in enumerate(group):
+            if future.done():
+                continue  # The caller went away
+            if i in failed:
+                future.set_exception(failed[i])
+            else:
+                future.set_result(ids[i])
+
+def create_app(mongo_url=None, collection=None, group_size=DEFAULT_GROUP_SIZE, group_delay=DEFAULT_GROUP_DELAY,
+               storage=None, notifier=None, retention=None, mailbox_caps=None,
+               sweep_interval=SWEEP_INTERVAL):
+    """Create and configure the FastAPI application.
+    
+    ``storage`` is any engine from ``storage.py``; by default the app connects
+    to MongoDB at ``mongo_url``, or wraps ``collection`` if one is handed in.
+    ``notifier`` wakes mailbox readers after inserts. ``retention`` maps
+    message types to the seconds they are kept and ``mailbox_caps`` to the
+    messages kept per mailbox; both default to none (see ``retention.py``).
+    """
+    if storage is None:
+        storage = MongoStorage(collection) if collection is not None else open_storage("mongo", mongo_url)
+    notifier = notifier or Notifier()
+    bounds = Retention(storage, retention, mailbox_caps, sweep_interval)
     
-    # Connect to MongoDB
-    mongo_url = mongo_url or os.getenv("MONGO_URL", "mongodb://localhost:27017")
-    client = AsyncIOMotorClient(mongo_url)
-    db = client["messaging_db"]
-    collection = db["messages"]
+    # Single posts share insert_many round trips unless group commit is off
+    group = GroupCommit(storage, group_size, group_delay) if group_size > 1 else None
+    
+    @asynccontextmanager
+    async def lifespan(app):
+        await storage.setup()
+        bounds.start()
+        # Inserts made by other API instances, where the engine can see them
+        watcher = asyncio.create_task(storage.watch(notifier.notify)) if hasattr(storage, "watch") else None
+        yield
+        if watcher is not None:
+            watcher.cancel()
+        if group is not None:
+            await group.close()
+        await bounds.close()
+        await storage.close()
+    
+    app = FastAPI(title="P2P Chat Message API", lifespan=lifespan, default_response_class=FastJSONResponse)
     
     @app.post("/messages/")
-    async def store_message(msg: Message):
-        await collection.insert_one(msg.dict())
-        return {"status": "stored"}
+    async def store_message(request: Request, msg: Message = Depends(body(Message))):
+        document = bounds.stamp(msg.model_dump())
+        if group is not None:
+            await group.insert(document)
+        else:
+            await storage.insert_many([document])
+        notifier.notify([msg.destination])
+        bounds.touch([(msg.destination, msg.type)])
+        return reply(request, {"status": "stored"})
+    
+    @app.post("/messages/batch")
+    async def store_messages(request: Request, batch: MessageBatch = Depends(body(MessageBatch))):
+        """Store many messages in one round trip (e.g. a room fan-out)."""
+        if batch.messages:
+            now = time.time()
+            await storage.insert_many([bounds.stamp(msg.model_dump(), now) for msg in batch.messages])
+            destinations = {msg.destination for msg in batch.messages}
+            notifier.notify(destinations)
+            bounds.touch({(msg.destination, msg.type) for msg in batch.messages})
+        return reply(request, {"status": "stored", "count": len(batch.messages)})
     
     @app.get("/messages/{username}")
-    async def get_messages(username: str):
-        cursor = collection.find({"destination": username})
-        raw_messages = await cursor.to_list(length=None)
+    async def get_messages(request: Request, username: str,
+                           limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+                           after: str | None = None):
+        """Return (and remove) the oldest ``limit`` messages after the ``after`` id.
+
+        ``next`` is the cursor for the following page, or None once the
+        mailbox is empty, so a large mailbox never has to fit in memory.
+        """
+        messages, more = await storage.take(username, limit, after)
+        return reply(request, {"messages": messages, "next": str(messages[-1]["_id"]) if more else None})
+    
+    @app.post("/messages/{username}/claim")
+    async def claim_messages(request: Request, username: str,
+                             limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+                             lease: float = Query(DEFAULT_LEASE, gt=0, le=MAX_LEASE),
+                             wait: float = Query(0, ge=0, le=MAX_WAIT)):
+        """Claim the oldest ``limit`` unclaimed messages for ``lease`` seconds.
+        
+        Claimed messages are hidden from other fetches until they are acked
+        (deleted) or the lease runs out, when they become visible again. With
+        ``wait`` an empty mailbox holds the request (long-poll) until mail
+        arrives or ``wait`` seconds pass.
+        """
+        now = time.time()
+        if wait:
+            # Subscribed before looking, so mail stored in between still wakes us
+            with notifier.subscribe(username) as sub:
+                claim, messages = await storage.claim(username, limit, lease, now)
+                if claim is None and await sub.next(wait):
+                    now = time.time()
+                    claim, messages = await storage.claim(username, limit, lease, now)
+        else:
+            claim, messages = await storage.claim(username, limit, lease, now)
+        if claim is None:
+            return reply(request, {"claim": None, "messages": []})
+        return reply(request, {"claim": claim, "lease_expires": now + lease, "messages": messages})
+    
+    @app.post("/messages/{username}/ack")
+    async def ack_messages(request: Request, username: str, ack: Ack = Depends(body(Ack))):
+        """Delete delivered messages by id."""
+        return reply(request, {"status": "acked", "count": await storage.ack(username, ack.ids)})
+    
+    @app.get("/messages/{username}/count")
+    async def count_messages(request: Request, username: str):
+        """Number of messages waiting for a user, claimed or not."""
+        return reply(request, {"username": username, "count": await storage.count(username)})
+    
+    @app.get("/messages/{username}/summary")
+    async def mailbox_summary(request: Request, username: str):
+        """Unread counts, in total and by sender and type, and the newest timestamp.
+        
+        Read-only and served from counters the engine keeps, so it is cheap
+        enough to poll for badges or to check before fetching.
+        """
+        return reply(request, {"username": username, **await storage.summary(username)})
+    
+    @app.get("/messages/{username}/events")
+    async def mailbox_events(username: str):
+        """Server-sent events: ``mail`` with the mailbox summary whenever messages arrive.
+        
+        The first event comes straight away if mail is already waiting.
+        """
+        sub = notifier.subscribe(username)
+        if (await storage.summary(username))["total"]:
+            sub.add(username)
         
-        # Convert ObjectId to string
-        messages = []
-        for msg in raw_messages:
-            msg["_id"] = str(msg["_id"])  # make ObjectId serializable
-            messages.append(msg)
+        async def describe(destinations):
+            return {"username": username, **await storage.summary(username)}
+        return StreamingResponse(event_stream(sub, describe), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
     
-        await collection.delete_many({"destination": username})
-        return {"messages": messages}
+    @app.get("/events")
+    async def all_events():
+        """Server-sent events naming every destination that got mail; used by chat servers."""
+        async def describe(destinations):
+            return {"destinations": sorted(destinations)}
+        return StreamingResponse(event_stream(notifier.subscribe(), describe), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
     
     @app.get("/health")
     async def health_check():
@@ -53,20 +304,46 @@ def create_app(mongo_url=None):
     
     return app
 
-def main(host="0.0.0.0", port=8000, mongo_url=None):
+def main(host="0.0.0.0", port=8000, mongo_url=None, group_size=DEFAULT_GROUP_SIZE, group_delay=DEFAULT_GROUP_DELAY,
+         storage="mongo", sqlite_path=None, log_dir=None, retention=None, mailbox_caps=None,
+         sweep_interval=SWEEP_INTERVAL):
     """Run the API server."""
-    app = create_app(mongo_url)
-    uvicorn.run(app, host=host, port=port)
+    app = create_app(group_size=group_size, group_delay=group_delay,
+                     storage=open_storage(storage, mongo_url, sqlite_path, log_dir),
+                     retention=retention, mailbox_caps=mailbox_caps, sweep_interval=sweep_interval)
+    uvicorn.run(app, host=host, port=port, timeout_graceful_shutdown=SHUTDOWN_GRACE)
 
 def main_entry():
     """Entry point for console script."""
     parser = argparse.ArgumentParser(description='P2P Chat Message API')
     parser.add_argument('--host', default="127.0.0.1", help='API host')
     parser.add_argument('--port', type=int, default=8000, help='API port')
+    parser.add_argument('--storage', choices=STORAGE_KINDS, default="mongo",
+                        help='Where offline messages are kept (memory is lost on restart)')
     parser.add_argument('--mongo-url', help='MongoDB connection URL')
+    parser.add_argument('--sqlite-path', help='SQLite database file for --storage sqlite (default: messages.db)')
+    parser.add_argument('--log-dir', help='Segment directory for --storage log (default: mailbox-log)')
+    parser.add_argument('--group-size', type=int, default=DEFAULT_GROUP_SIZE,
+                        help='Single posts written per group commit (1 disables group commit)')
+    parser.add_argument('--group-delay', type=float, default=DEFAULT_GROUP_DELAY,
+                        help='Seconds a single post may wait for others to share its insert')
+    parser.add_argument('--retention', action='append', default=[], metavar='TYPE=DURATION',
+                        help='Keep messages of TYPE for DURATION (e.g. notification=6h, chat=30d, 0 = forever); '
+                             'repeat per type. Messages are kept until read by default')
+    parser.add_argument('--mailbox-cap', action='append', default=[], metavar='TYPE=COUNT',
+                        help='Keep at most COUNT messages of TYPE per destination, dropping the oldest '
+                             '(e.g. notification=1000); repeat per type. No cap by default')
+    parser.add_argument('--sweep-interval', type=float, default=SWEEP_INTERVAL,
+                        help='Seconds between expiry sweeps')
     args = parser.parse_args()
+    try:
+        retention = parse_retention(args.retention)
+        mailbox_caps = parse_caps(args.mailbox_cap)
+    except ValueError as e:
+        parser.error(str(e))
     
-    main(args.host, args.port, args.mongo_url)
+    main(args.host, args.port, args.mongo_url, args.group_size, args.group_delay, args.storage, args.sqlite_path,
+         args.log_dir, retention, mailbox_caps, args.sweep_interval)
 
 if __name__ == "__main__":
     main_entry()
\ No newline at end of file
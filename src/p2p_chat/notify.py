@@ -0,0 +1,84 @@
+"""
+Wake-ups for mailbox readers when new messages are stored.
+
+The Message API calls ``Notifier.notify`` after every insert, and (with the
+Mongo engine) for every insert a change stream reports, so writes made by
+other API instances wake readers too. Readers hold a ``Subscription`` for
+one destination or for all of them, and collect the destinations that got
+mail since they last looked. Notifications carry no messages: a woken reader
+still claims its mailbox as usual, so a missed or duplicate wake-up costs a
+round trip, never a message.
+"""
+import asyncio
+from collections import defaultdict
+
+
+class Subscription:
+    """Destinations with new mail, collected until the holder looks."""
+
+    def __init__(self, notifier, destination=None):
+        self.notifier = notifier
+        self.destination = destination  # None for every destination
+        self.pending = set()
+        self.event = asyncio.Event()
+
+    def add(self, destination):
+        self.pending.add(destination)
+        self.event.set()
+
+    async def next(self, timeout=None):
+        """Wait for mail; returns the destinations that got some (empty on timeout)."""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return set()
+        self.event.clear()
+        pending, self.pending = self.pending, set()
+        return pending
+
+    def close(self):
+        self.notifier.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Notifier:
+    """In-process fan-out of "mail arrived for X" to subscriptions."""
+
+    def __init__(self):
+        self.waiters = defaultdict(set)  # destination -> subscriptions
+        self.everyone = set()  # Subscriptions to all destinations
+
+    def subscribe(self, destination=None):
+        """Subscribe to one destination, or to all of them if ``destination`` is None."""
+        sub = Subscription(self, destination)
+        if destination is None:
+            self.everyone.add(sub)
+        else:
+            self.waiters[destination].add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        if sub.destination is None:
+            self.everyone.discard(sub)
+            return
+        waiters = self.waiters.get(sub.destination)
+        if waiters is not None:
+            waiters.discard(sub)
+            if not waiters:
+                del self.waiters[sub.destination]
+
+    def notify(self, destinations):
+        for destination in set(destinations):
+            for sub in self.waiters.get(destination, ()):
+                sub.add(destination)
+            for sub in self.everyone:
+                sub.add(destination)
+
+    @property
+    def subscribers(self):
+        return len(self.everyone) + sum(len(subs) for subs in self.waiters.values())
@@ -5,10 +5,19 @@ from datetime import datetime, UTC
 import os
 import json
 import random
+import hashlib
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Literal
 from dotenv import load_dotenv
 import time
 
+from . import api_client
+from .protocol import encode_frame, iter_frames, open_connection
+from .ratelimit import RateLimiter, backoff, retry_after
+from .retention import parse_duration
+
 # Load environment variables
 load_dotenv()
 
@@ -17,6 +26,15 @@ DEFAULT_PORT = 5000  # Chat server port
 DEFAULT_USERNAME = "openai"  # Bot username
 DEFAULT_API_BASE = "http://127.0.0.1:8000"  # Message API base URL
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")  # OpenAI API key
+OPENAI_API_URL = os.getenv("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions")  # Completions endpoint
+DEFAULT_WORKERS = 8  # Requests handled at once, across all users
+DEFAULT_QUEUE_MAX = 1000  # Requests waiting for a worker before new ones are turned away
+OPENAI_TIMEOUT = 30.0  # Seconds a completion may take
+MAX_ATTEMPTS = 4  # Tries per completion through 429s, 5xx and dropped connections
+DEFAULT_CACHE_ENTRIES = 1000  # Responses kept in memory (0 turns the cache off)
+DEFAULT_CACHE_BYTES = 8 * 1024 * 1024  # Memory for cached response text
+DEFAULT_CACHE_TTL = 3600.0  # Seconds a cached response is reused
+DEFAULT_DISK_CACHE_ENTRIES = 100000  # Responses kept in the on-disk tier
 
 # Bot personalities
 PERSONALITIES = {
@@ -37,11 +55,234 @@ PERSONALITIES = {
 # Default personality rotation
 DEFAULT_PERSONALITY_ROTATION = ["happy", "angry", "spanish"]
 
+class RequestPool:
+    """Runs the bot's requests on a fixed number of workers.
+
+    Different users' requests run concurrently, at most ``workers`` at a
+    time; each user's requests run one after another, in the order they
+    came. At most ``queue_max`` requests wait for a worker.
+    """
+
+    def __init__(self, handler, workers=DEFAULT_WORKERS, queue_max=DEFAULT_QUEUE_MAX):
+        self.handler = handler  # async handler(user, request)
+        self.size = workers
+        self.queue_max = queue_max
+        self.pending = {}  # user -> deque of requests not started yet, while the user has any queued or running
+        self.ready = asyncio.Queue()  # Users with a request to start and none running
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.waiting = 0
+        self.in_flight = 0
+        self.done = 0
+        self.workers = []
+
+    def start(self):
+        self.workers = [asyncio.create_task(self._work()) for _ in range(self.size)]
+
+    def submit(self, user, request):
+        """Queue a request for ``user``. Returns False if too many are waiting."""
+        if self.waiting >= self.queue_max:
+            return False
+        self.waiting += 1
+        self.idle.clear()
+        queue = self.pending.get(user)
+        if queue is None:
+            self.pending[user] = deque([request])
+            self.ready.put_nowait(user)
+        else:
+            queue.append(request)  # Its worker picks this up after the one before
+        return True
+
+    async def _work(self):
+        while True:
+            user = await self.ready.get()
+            queue = self.pending[user]
+            request = queue.popleft()
+            self.waiting -= 1
+            self.in_flight += 1
+            try:
+                await self.handler(user, request)
+            except Exception as e:
+                print(f"[OPENAI] Error handling message from {user}: {e}")
+            finally:
+                self.in_flight -= 1
+                self.done += 1
+                if queue:
+                    self.ready.put_nowait(user)  # Behind users who are already waiting
+                else:
+                    del self.pending[user]
+                    if not self.pending:
+                        self.idle.set()
+
+    def stats(self):
+        return {"waiting": self.waiting, "in_flight": self.in_flight, "users": len(self.pending),
+                "done": self.done, "workers": self.size}
+
+    async def join(self):
+        """Wait until every queued request has been handled."""
+        await self.idle.wait()
+
+    async def close(self):
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+class CompletionError(Exception):
+    """A completion failed; the message is what to tell the user."""
+
+def normalize_prompt(text):
+    """Fold case, whitespace and trailing punctuation, so "Hi!" and " hi" ask the same thing."""
+    return " ".join(text.casefold().split()).strip(" .!?")
+
+class ResponseCache:
+    """Completions by (model, personality prompt, normalized user text).
+
+    An LRU in memory, bounded by entry count and by bytes of text, whose
+    entries expire after ``ttl`` seconds. With ``path``, responses are also
+    kept in a SQLite file, so they outlive restarts and the memory bound.
+    Identical prompts that arrive while one is being answered wait for that
+    answer instead of making their own call. Failures are never cached.
+    """
+
+    def __init__(self, entries=DEFAULT_CACHE_ENTRIES, max_bytes=DEFAULT_CACHE_BYTES, ttl=DEFAULT_CACHE_TTL,
+                 path=None, disk_entries=DEFAULT_DISK_CACHE_ENTRIES):
+        self.max_entries = entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_entries = disk_entries
+        self.entries = OrderedDict()  # key -> (expires_at, response, size), least recently used first
+        self.bytes = 0
+        self.in_flight = {}  # key -> Future of a completion being generated
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expired = 0
+        self.db = None
+        self.disk_writes = 0
+        if path is not None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses "
+                            "(key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_expiry ON responses (expires_at)")
+
+    @staticmethod
+    def key(model, system_prompt, user_message):
+        parts = json.dumps([model, system_prompt, normalize_prompt(user_message)], ensure_ascii=False)
+        return hashlib.sha256(parts.encode()).hexdigest()
+
+    async def get_or_generate(self, key, generate):
+        """The cached response for ``key``, or ``await generate()`` (once, however many ask)."""
+        response = self._get(key)
+        if response is not None:
+            self.hits += 1
+            return response
+        pending = self.in_flight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        pending = self.in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            response = await self._disk_get(key)
+            if response is not None:
+                self.disk_hits += 1
+                self._put(key, response)
+            else:
+                self.misses += 1
+                response = await generate()
+                self._put(key, response)
+                await self._disk_put(key, response)
+            pending.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            # Waiters get a plain failure: cancelling them would also cancel a pool worker
+            pending.set_exception(CompletionError("Sorry, I couldn't generate a response right now."))
+            pending.exception()
+            raise
+        except Exception as e:
+            pending.set_exception(e)
+            pending.exception()  # Retrieved, even if nobody else was waiting
+            raise
+        finally:
+            del self.in_flight[key]
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, response, size = entry
+        if time.monotonic() >= expires_at:
+            self.expired += 1
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return response
+
+    def _put(self, key, response):
+        size = len(response.encode())
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, response, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        self.bytes -= self.entries.pop(key)[2]
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _disk_get(self, key):
+        if self.db is None:
+            return None
+        row = await self._run(lambda: self.db.execute(
+            "SELECT response FROM responses WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone())
+        return row[0] if row else None
+
+    def _store(self, key, response):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, response, time.time() + self.ttl))
+            self.disk_writes += 1
+            if self.disk_writes % 100 == 0:
+                # Everything expires after the same TTL, so the soonest to expire are the oldest
+                self.db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+                self.db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                                "ORDER BY expires_at DESC LIMIT -1 OFFSET ?)", (self.disk_entries,))
+
+    async def _disk_put(self, key, response):
+        if self.db is not None:
+            try:
+                await self._run(self._store, key, response)
+            except sqlite3.Error as e:
+                print(f"[OPENAI ERROR] Failed to save a response to the disk cache: {e}")
+
+    def stats(self):
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "coalesced": self.coalesced,
+                "evictions": self.evictions, "expired": self.expired, "entries": len(self.entries),
+                "bytes": self.bytes}
+
+    async def close(self):
+        if self.db is not None:
+            await self._run(self.db.close)
+            self.executor.shutdown()
+            self.db = None
+
 class OpenAIChatbot:
     def __init__(self, username=DEFAULT_USERNAME, api_base=DEFAULT_API_BASE, 
-                 model="gpt-4o", personality="happy", rotation=None):
+                 model="gpt-4o", personality="happy", rotation=None,
+                 workers=DEFAULT_WORKERS, queue_max=DEFAULT_QUEUE_MAX, api_url=None, cache=None):
         self.username = username
         self.api_base = api_base
+        self.api_url = api_url or OPENAI_API_URL
         self.model = model
         self.active_personality = personality
         self.personality_rotation = rotation or DEFAULT_PERSONALITY_ROTATION
@@ -50,8 +291,10 @@ class OpenAIChatbot:
         self.running = True
         self.writer = None
         self.reader = None
-        self.rate_limit_time = 0.1  # Seconds to wait between API calls
-        self.last_api_call = 0
+        self.client = None  # One pooled (HTTP/2 when h2 is installed) client for every completion
+        self.limiter = RateLimiter(max_concurrency=workers)
+        self.requests = RequestPool(self.handle_command, workers, queue_max)
+        self.cache = ResponseCache() if cache is None else cache  # False for no cache
         
         if not OPENAI_API_KEY:
             raise ValueError("OPENAI_API_KEY environment variable not set")
@@ -59,44 +302,82 @@ class OpenAIChatbot:
         print(f"[OPENAI] Initialized with personality: {self.active_personality}")
         print(f"[OPENAI] Using model: {self.model}")
         
+    def get_client(self):
+        if self.client is None or self.client.is_closed:
+            self.client = api_client.build_client(http2=True, timeout=OPENAI_TIMEOUT, connect_timeout=OPENAI_TIMEOUT,
+                                                  max_connections=self.limiter.max_concurrency,
+                                                  max_keepalive=self.limiter.max_concurrency)
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+        if self.cache:
+            await self.cache.close()
+
     async def generate_response(self, user_message, personality=None):
         """Generate a response using OpenAI API based on the given personality."""
-        personality = personality or self.active_personality
-        
-        # Basic rate limiting
-        now = time.time()
-        if now - self.last_api_call < self.rate_limit_time:
-            await asyncio.sleep(self.rate_limit_time)
-        
+        system_prompt = PERSONALITIES[personality or self.active_personality]["prompt"]
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                self.last_api_call = time.time()
-                response = await client.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {OPENAI_API_KEY}"
-                    },
-                    json={
-                        "model": self.model,
-                        "messages": [
-                            {"role": "system", "content": PERSONALITIES[personality]["prompt"]},
-                            {"role": "user", "content": user_message}
-                        ],
-                        "max_tokens": 500
-                    }
+            if not self.cache:
+                return await self.complete(system_prompt, user_message)
+            key = ResponseCache.key(self.model, system_prompt, user_message)
+            return await self.cache.get_or_generate(key, lambda: self.complete(system_prompt, user_message))
+        except CompletionError as e:
+            return str(e)
+
+    async def complete(self, system_prompt, user_message):
+        """One completion from the API. Raises CompletionError if there is none to give."""
+        request = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message}
+            ],
+            "max_tokens": 500
+        }
+        
+        for attempt in range(MAX_ATTEMPTS):
+            # Paced by the limiter, which follows the rate-limit headers of earlier replies
+            await self.limiter.acquire()
+            response = None
+            try:
+                response = await self.get_client().post(
+                    self.api_url,
+                    headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+                    json=request,
                 )
-                
-                if response.status_code != 200:
-                    print(f"[OPENAI ERROR] API returned status {response.status_code}: {response.text}")
-                    return f"Sorry, I encountered an error (status {response.status_code})"
-                
-                result = response.json()
-                return result["choices"][0]["message"]["content"]
-                
-        except Exception as e:
-            print(f"[OPENAI ERROR] {e}")
-            return "Sorry, I couldn't generate a response right now."
+            except httpx.TransportError as e:
+                print(f"[OPENAI ERROR] {e!r}")
+            except Exception as e:
+                print(f"[OPENAI ERROR] {e}")
+                raise CompletionError("Sorry, I couldn't generate a response right now.")
+            finally:
+                if response is None:
+                    self.limiter.release()
+                else:
+                    self.limiter.release(response.status_code, response.headers)
+            
+            if response is not None and response.status_code == 200:
+                try:
+                    return response.json()["choices"][0]["message"]["content"]
+                except (ValueError, KeyError, IndexError) as e:
+                    print(f"[OPENAI ERROR] Unexpected reply: {e!r}")
+                    raise CompletionError("Sorry, I couldn't generate a response right now.")
+            
+            if response is not None and response.status_code != 429 and response.status_code < 500:
+                print(f"[OPENAI ERROR] API returned status {response.status_code}: {response.text}")
+                raise CompletionError(f"Sorry, I encountered an error (status {response.status_code})")
+            
+            if attempt + 1 < MAX_ATTEMPTS:
+                # A retry-after pauses the limiter for every request; otherwise back off with jitter
+                if response is None or retry_after(response.headers) is None:
+                    await asyncio.sleep(backoff(attempt))
+        
+        status = response.status_code if response is not None else "no reply"
+        print(f"[OPENAI ERROR] Giving up after {MAX_ATTEMPTS} attempts ({status})")
+        raise CompletionError("Sorry, I'm getting too many requests right now. Please try again in a minute.")
     
     async def direct_send_message(self, destination, message):
         """Send a message directly to a user if they're online."""
@@ -105,9 +386,7 @@ class OpenAIChatbot:
             return False
             
         try:
-            timestamp = datetime.now(UTC).isoformat()
-            command = f"{destination}: {message}"
-            self.writer.write(command.encode())
+            self.writer.write(encode_frame({"type": "chat", "destination": destination, "message": message}))
             await self.writer.drain()
             return True
         except Exception as e:
@@ -119,16 +398,15 @@ class OpenAIChatbot:
         metadata = metadata or {}
         
         try:
-            async with httpx.AsyncClient() as client:
-                await client.post(f"{self.api_base}/messages/", json={
-                    "sender": self.username,
-                    "destination": destination,
-                    "message": message,
-                    "timestamp": datetime.now(UTC).isoformat(),
-                    "type": msg_type,
-                    "metadata": metadata
-                })
-                return True
+            await api_client.post(f"{self.api_base}/messages/", {
+                "sender": self.username,
+                "destination": destination,
+                "message": message,
+                "timestamp": datetime.now(UTC).isoformat(),
+                "type": msg_type,
+                "metadata": metadata
+            })
+            return True
         except Exception as e:
             print(f"[OPENAI ERROR] Failed to store message: {e}")
             return False
@@ -152,6 +430,7 @@ class OpenAIChatbot:
                 "- personality X: Change my personality to X (happy, angry, spanish)\n"
                 "- rotate: Rotate to the next personality\n"
                 "- info or help: Show this help message\n"
+                "- status: Show how many requests are waiting\n"
                 f"Current personality: {self.active_personality} - {PERSONALITIES[self.active_personality]['description']}"
             )
             # Try direct send first, fall back to storage
@@ -201,45 +480,49 @@ class OpenAIChatbot:
         """Handle incoming messages from the chat server."""
         self.reader = reader
         self.writer = writer
+        self.requests.start()
         
-        while self.running:
-            try:
-                data = await reader.read(1024)
-                if not data:
+        try:
+            async for event in iter_frames(reader):
+                if not self.running:
                     break
+                print(f"[OPENAI] Received event: {event}")
+
+                # Only chat messages sent to the bot are prompts or commands. Broadcasts and
+                # room messages would cost a completion each, and bots could answer each other
+                if event.get("type") != "chat" or event.get("destination") != self.username \
+                        or event.get("sender") == self.username:
+                    continue
 
-                msg = data.decode(errors="ignore").strip()
-                print(f"[OPENAI] Received message: {msg}")
+                sender = event["sender"]
+                content = event.get("message", "").strip()
+                print(f"[OPENAI] Parsed sender: {sender}, content: '{content}'")
 
-                # Check if this is a HTTP/WebSocket message (browser connection)
-                if msg.startswith("GET /") or "HTTP/1.1" in msg or "websocket" in msg.lower() or "Sec-WebSocket-Key:" in msg:
-                    print(f"[OPENAI] Ignoring HTTP/WebSocket message")
+                # Answered at once: it is about the queue itself
+                if content.lower() == "status":
+                    stats = self.requests.stats()
+                    limits = self.limiter.stats()
+                    await self.direct_send_message(sender, (
+                        f"{stats['in_flight']} requests in progress, {stats['waiting']} waiting "
+                        f"({stats['users']} users, {stats['workers']} workers); "
+                        f"up to {limits['ceiling']} calls at once, {limits['throttled']} throttled so far"))
+                    if self.cache:
+                        cached = self.cache.stats()
+                        await self.direct_send_message(sender, (
+                            f"Cache: {cached['hits'] + cached['disk_hits']} hits ({cached['disk_hits']} from disk), "
+                            f"{cached['misses']} misses, {cached['coalesced']} shared with a request in flight, "
+                            f"{cached['evictions']} evicted, {cached['entries']} responses in memory"))
                     continue
 
-                # Expect format: [username][timestamp] message
-                if msg.startswith("[") and "]" in msg:
-                    try:
-                        sender = msg.split("]")[0][1:]  # extract between first [ ]
-                        
-                        # Extract message content - this is complicated by the fact that
-                        # there might be timestamps or other bracketed content
-                        parts = msg.split("]")
-                        if len(parts) >= 3:  # Has sender and timestamp
-                            content = "]".join(parts[2:]).strip()
-                        else:  # Just has sender
-                            content = "]".join(parts[1:]).strip()
-                        
-                        print(f"[OPENAI] Parsed sender: {sender}, content: '{content}'")
-                        
-                        # Process the message
-                        await self.handle_command(sender, content)
-                    except Exception as e:
-                        print(f"[OPENAI] Error parsing message: {e}")
-                        continue
+                # Handled by the worker pool, so a slow completion only holds up its own user
+                if not self.requests.submit(sender, content):
+                    print(f"[OPENAI] Queue full; turning away a request from {sender}")
+                    await self.direct_send_message(sender, "I'm swamped right now, please try again in a minute.")
 
-            except Exception as e:
-                print(f"[OPENAI ERROR] {e}")
-                break
+        except Exception as e:
+            print(f"[OPENAI ERROR] {e}")
+        finally:
+            await self.requests.close()
                 
         self.reader = None
         self.writer = None
@@ -247,25 +530,14 @@ class OpenAIChatbot:
     async def run(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
         """Connect to the chat server and start handling messages."""
         try:
-            reader, writer = await asyncio.open_connection(host, port)
-            
-            # Read username prompt and send username
-            username_prompt = await reader.read(1024)
-            print(f"[OPENAI] Received prompt: {username_prompt.decode()}")
-            
-            writer.write(self.username.encode() + b"\n")
-            await writer.drain()
+            reader, writer = await open_connection(host, port, self.username)
             
             print(f"[OPENAI] Connected to chat server as '{self.username}'")
             
-            # Skip the welcome message
-            welcome_msg = await reader.read(1024)
-            print(f"[OPENAI] Received welcome: {welcome_msg.decode()}")
-            
             # Send a startup message to the chat server
             startup_msg = "OpenAI Chatbot is online! Send me a direct message or use the 'help' command to learn more."
             print(f"[OPENAI] Sending startup message: {startup_msg}")
-            writer.write(f"TO_ALL: {startup_msg}".encode())
+            writer.write(encode_frame({"type": "chat", "destination": "TO_ALL", "message": startup_msg}))
             await writer.drain()
             
             # Start handling incoming messages
@@ -282,21 +554,35 @@ class OpenAIChatbot:
                 self.writer = None
 
 async def main_async(host=DEFAULT_HOST, port=DEFAULT_PORT, username=DEFAULT_USERNAME, 
-                    api_base=DEFAULT_API_BASE, model="gpt-4o", personality="happy"):
+                    api_base=DEFAULT_API_BASE, model="gpt-4o", personality="happy",
+                    workers=DEFAULT_WORKERS, queue_max=DEFAULT_QUEUE_MAX,
+                    cache_size=DEFAULT_CACHE_ENTRIES, cache_ttl=DEFAULT_CACHE_TTL, cache_path=None):
     """Run the OpenAI chatbot service."""
-    chatbot = OpenAIChatbot(username, api_base, model, personality)
-    await chatbot.run(host, port)
+    cache = ResponseCache(cache_size, ttl=cache_ttl, path=cache_path) if cache_size else False
+    chatbot = OpenAIChatbot(username, api_base, model, personality, workers=workers, queue_max=queue_max,
+                            cache=cache)
+    try:
+        await chatbot.run(host, port)
+    finally:
+        await chatbot.close()
+        await api_client.close_client()
 
 def main(host=DEFAULT_HOST, port=DEFAULT_PORT, username=DEFAULT_USERNAME, 
-         api_base=DEFAULT_API_BASE, model="gpt-4o", personality="happy"):
+         api_base=DEFAULT_API_BASE, model="gpt-4o", personality="happy",
+         workers=DEFAULT_WORKERS, queue_max=DEFAULT_QUEUE_MAX,
+         cache_size=DEFAULT_CACHE_ENTRIES, cache_ttl=DEFAULT_CACHE_TTL, cache_path=None):
     """Main function to run the OpenAI chatbot service."""
     print(f"Starting OpenAI chatbot service as '{username}'")
     print(f"Connecting to chat server at {host}:{port}")
     print(f"Using API at {api_base}")
     print(f"Using model: {model}")
     print(f"Initial personality: {personality}")
+    print(f"Workers: {workers}")
+    print(f"Response cache: {cache_size} entries for {cache_ttl:g}s" + (f", on disk in {cache_path}" if cache_path else "")
+          if cache_size else "Response cache: off")
     
-    asyncio.run(main_async(host, port, username, api_base, model, personality))
+    asyncio.run(main_async(host, port, username, api_base, model, personality, workers, queue_max,
+                           cache_size, cache_ttl, cache_path))
 
 def main_entry():
     """Entry point for console script."""
@@ -309,9 +595,22 @@ def main_entry():
     parser.add_argument('--personality', default="happy", 
                       choices=list(PERSONALITIES.keys()), 
                       help='Bot personality')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Requests handled at once; each user still gets answers in order')
+    parser.add_argument('--queue-max', type=int, default=DEFAULT_QUEUE_MAX,
+                        help='Requests waiting for a worker before new ones are turned away')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_ENTRIES,
+                        help='Responses kept in memory for repeated prompts (0 turns the cache off)')
+    parser.add_argument('--cache-ttl', type=parse_duration, default=DEFAULT_CACHE_TTL,
+                        help='How long a cached response is reused, e.g. 90, 30m or 6h')
+    parser.add_argument('--cache-path', default=None,
+                        help='SQLite file that keeps cached responses across restarts')
+    api_client.add_arguments(parser)
     args = parser.parse_args()
+    api_client.configure_from_args(args)
     
-    main(args.host, args.port, args.username, args.api_base, args.model, args.personality)
+    main(args.host, args.port, args.username, args.api_base, args.model, args.personality,
+         args.workers, args.queue_max, args.cache_size, args.cache_ttl, args.cache_path)
 
 if __name__ == "__main__":
     main_entry()
\ No newline at end of file
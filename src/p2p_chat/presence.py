@@ -0,0 +1,135 @@
+"""
+Versioned presence roster.
+
+Every login or logout bumps the roster version and is kept in a bounded change
+log, so anyone who has seen version V can catch up with just the users that
+joined or left since, instead of re-reading the whole list. Full snapshots are
+paginated by username. ``PresenceBatcher`` collects changes for a short window
+and publishes them as one delta, which keeps reconnect storms from turning
+into one message per login per watcher.
+"""
+import asyncio
+import bisect
+from collections import deque
+
+DEFAULT_HISTORY = 10000  # Changes kept for delta catch-up
+DEFAULT_PAGE_SIZE = 500  # Usernames per snapshot page
+DEFAULT_BATCH_WINDOW = 0.05  # Seconds presence changes are collected before publishing
+
+
+class Roster:
+    """The set of online users, with a version number and change log."""
+
+    def __init__(self, history=DEFAULT_HISTORY):
+        self.version = 0
+        self.users = []  # Sorted usernames
+        self.log = deque(maxlen=history)  # (version, username, joined)
+        self._text = None  # Cached ", ".join(users) for v1 clients
+        self.on_change = None  # Called after every join or leave
+
+    def __contains__(self, username):
+        i = bisect.bisect_left(self.users, username)
+        return i < len(self.users) and self.users[i] == username
+
+    def __len__(self):
+        return len(self.users)
+
+    def join(self, username):
+        """Mark a user online. Returns False if they already were."""
+        i = bisect.bisect_left(self.users, username)
+        if i < len(self.users) and self.users[i] == username:
+            return False
+        self.users.insert(i, username)
+        self._record(username, True)
+        return True
+
+    def leave(self, username):
+        """Mark a user offline. Returns False if they weren't online."""
+        i = bisect.bisect_left(self.users, username)
+        if i == len(self.users) or self.users[i] != username:
+            return False
+        del self.users[i]
+        self._record(username, False)
+        return True
+
+    def _record(self, username, joined):
+        self.version += 1
+        self.log.append((self.version, username, joined))
+        self._text = None
+        if self.on_change is not None:
+            self.on_change()
+
+    def text(self):
+        if self._text is None:
+            self._text = ", ".join(self.users)
+        return self._text
+
+    def snapshot(self, after=None, limit=DEFAULT_PAGE_SIZE):
+        """One page of online users, sorted, starting after the ``after`` cursor."""
+        start = bisect.bisect_right(self.users, after) if after else 0
+        page = self.users[start:start + limit]
+        more = start + limit < len(self.users)
+        return {
+            "version": self.version,
+            "count": len(self.users),
+            "users": page,
+            "next": page[-1] if more else None,
+        }
+
+    def delta(self, since):
+        """Users that joined or left after version ``since``.
+
+        Returns None when the change log no longer reaches back that far; the
+        caller should take a fresh snapshot instead.
+        """
+        if since >= self.version:
+            return {"version": self.version, "joined": [], "left": []}
+        if not self.log or self.log[0][0] > since + 1:
+            return None
+        start = since + 1 - self.log[0][0]
+        return collapse(self.version, [self.log[i] for i in range(start, len(self.log))])
+
+
+def collapse(version, changes):
+    """Reduce (version, username, joined) changes to each user's final state."""
+    final = {}
+    for _, username, joined in changes:
+        if final.get(username) is not None and final[username] != joined:
+            del final[username]  # Joined and left again (or the reverse) within the range
+        else:
+            final[username] = joined
+    return {
+        "version": version,
+        "joined": [u for u, joined in final.items() if joined],
+        "left": [u for u, joined in final.items() if not joined],
+    }
+
+
+class PresenceBatcher:
+    """Publishes roster changes at most once per ``window`` seconds.
+
+    ``publish`` is called with one delta event covering everything that
+    changed during the window; a user who logs out and back in within it
+    doesn't show up at all.
+    """
+
+    def __init__(self, roster, publish, window=DEFAULT_BATCH_WINDOW):
+        self.roster = roster
+        self.publish = publish
+        self.window = window
+        self.published = roster.version
+        self._timer = None
+
+    def changed(self):
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        self._timer = None
+        delta = self.roster.delta(self.published)
+        self.published = self.roster.version
+        if delta is None:
+            # Too much changed to describe as a delta; send the full state instead
+            delta = {"version": self.roster.version, "joined": list(self.roster.users), "left": [], "reset": True}
+        if delta["joined"] or delta["left"] or delta.get("reset"):
+            self.publish({"type": "presence", **delta})
@@ -0,0 +1,247 @@
+"""
+Wire protocol helpers shared by the chat server and its clients.
+
+v1 is the original plain-text protocol: one ``TO_USER: message`` per line and
+human readable lines coming back.  v2 is negotiated by answering the username
+prompt with ``P2P/2 <username>`` and then exchanging length-prefixed frames:
+a 4-byte big-endian body length followed by a UTF-8 JSON object carrying
+``type``, ``sender``, ``destination``, ``message``, ``timestamp`` and
+``metadata``.  Frames can be pipelined freely; the receiver splits them no
+matter how TCP merges or fragments the stream.
+
+Gateways that carry many users (the web adapter) answer with
+``P2P/MUX <gateway>`` instead and multiplex sessions over one connection.
+Every frame then has a 4-byte session id between the length header and the
+JSON body. A gateway opens session N by sending ``{"type": "open",
+"username": ...}`` on it and ends it with ``{"type": "exit"}``; everything in
+between is an ordinary v2 request for that user. The server tags each event
+with the session it is for, already serialized the way the browser wants it,
+so a gateway can pass frame bodies through without decoding them. Session 0
+is the link's control channel: the server reports ``{"type": "opened",
+"session": N}`` once a login succeeded and ``{"type": "closed", "session": N,
+"message": ...}`` when it ends a session itself (the username was taken, say).
+"""
+import asyncio
+import json
+import struct
+
+V2_HELLO = "P2P/2"  # Sent instead of a bare username to switch to framed mode
+MUX_HELLO = "P2P/MUX"  # Sent by gateways multiplexing many users over one connection
+MUX = "mux"  # Protocol version parse_hello reports for MUX_HELLO
+USERNAME_PROMPT = "Enter your username: "
+HEADER = struct.Struct("!I")
+SESSION = struct.Struct("!I")  # Session id at the start of every mux frame body
+CONTROL = 0  # Mux session id of the link's own control frames
+MAX_FRAME_SIZE = 1024 * 1024  # Refuse frames larger than 1 MiB
+READ_SIZE = 64 * 1024  # Bytes to pull from the socket per read
+
+
+class ProtocolError(Exception):
+    """Raised when a peer sends a frame we cannot decode."""
+
+
+def encode_body(body):
+    """Prefix an already serialized JSON body with its length header."""
+    return HEADER.pack(len(body)) + body
+
+
+def encode_frame(event):
+    """Serialize an event dict into a single v2 frame."""
+    return encode_body(json.dumps(event, separators=(",", ":")).encode())
+
+
+def tag_frame(session, frame):
+    """Turn an encoded v2 frame into a mux frame for ``session`` without re-serializing it."""
+    return HEADER.pack(len(frame) - HEADER.size + SESSION.size) + SESSION.pack(session) + frame[HEADER.size:]
+
+
+def encode_tagged(session, event):
+    """Serialize an event dict into a mux frame for ``session``."""
+    body = json.dumps(event, separators=(",", ":")).encode()
+    return HEADER.pack(SESSION.size + len(body)) + SESSION.pack(session) + body
+
+
+class FrameDecoder:
+    """Incrementally splits a byte stream into v2 frames.
+
+    Feed it whatever ``reader.read()`` returned; it hands back every complete
+    frame in the buffer and keeps any trailing partial frame for next time.
+    With ``tagged`` set it reads mux frames and hands back (session, frame).
+    With ``raw`` set frames are the undecoded JSON bodies, as bytes.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, tagged=False, raw=False):
+        self.max_frame_size = max_frame_size
+        self.tagged = tagged
+        self.decode = bytes if raw else json.loads
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+        frames = []
+        offset = 0
+        buffer = self._buffer
+        while len(buffer) - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(buffer, offset)
+            if length > self.max_frame_size:
+                raise ProtocolError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+            end = offset + HEADER.size + length
+            if end > len(buffer):
+                break
+            start = offset + HEADER.size
+            try:
+                if self.tagged:
+                    if length < SESSION.size:
+                        raise ValueError("no session id")
+                    (session,) = SESSION.unpack_from(buffer, start)
+                    frames.append((session, self.decode(buffer[start + SESSION.size:end])))
+                else:
+                    frames.append(self.decode(buffer[start:end]))
+            except ValueError as e:
+                raise ProtocolError(f"Invalid frame body: {e}") from e
+            offset = end
+        if offset:
+            del buffer[:offset]
+        return frames
+
+
+class LineDecoder:
+    """Incrementally splits a v1 byte stream into requests, one per line.
+
+    Older clients write each request without a newline, so until a
+    connection has sent one every read is taken as a whole request. After
+    that, like ``FrameDecoder``, it keeps a trailing partial line until the
+    rest of it arrives, so a line split across two reads is still one
+    request. ``finish`` hands back the last line of a client that
+    disconnected without ending it (a bare ``exit``, say).
+    """
+
+    def __init__(self, max_line_size=MAX_FRAME_SIZE):
+        self.max_line_size = max_line_size
+        self.framed = False  # Set once the client has ended a line
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+        end = self._buffer.rfind(b"\n")
+        if end < 0:
+            if not self.framed:
+                return self.finish()
+            if len(self._buffer) > self.max_line_size:
+                raise ProtocolError(f"Line exceeds limit of {self.max_line_size} bytes")
+            return []
+        self.framed = True
+        lines = self._buffer[:end].decode(errors="replace").splitlines()
+        del self._buffer[:end + 1]
+        return [parse_v1_request(line) for line in lines if line.strip()]
+
+    def finish(self):
+        line = self._buffer.decode(errors="replace")
+        self._buffer.clear()
+        return [parse_v1_request(line)] if line.strip() else []
+
+
+async def iter_frames(reader, decoder=None, read_size=READ_SIZE):
+    """Yield decoded frames from a stream reader until EOF."""
+    decoder = decoder or FrameDecoder()
+    while True:
+        data = await reader.read(read_size)
+        if not data:
+            return
+        for frame in decoder.feed(data):
+            yield frame
+
+
+def hello_line(username):
+    """The login line a v2 client sends in reply to the username prompt."""
+    return f"{V2_HELLO} {username}\n".encode()
+
+
+def mux_hello_line(gateway):
+    """The login line a gateway sends to multiplex sessions over its connection."""
+    return f"{MUX_HELLO} {gateway}\n".encode()
+
+
+def parse_hello(line):
+    """Return ``(version, username)`` for the first line a client sent.
+
+    For a gateway the version is ``MUX`` and the name is the gateway's.
+    """
+    if line.startswith(V2_HELLO + " "):
+        return 2, line[len(V2_HELLO) + 1:].strip()
+    if line.startswith(MUX_HELLO + " "):
+        return MUX, line[len(MUX_HELLO) + 1:].strip()
+    return 1, line.strip()
+
+
+async def open_connection(host, port, username):
+    """Connect to the chat server and log in using the v2 framed protocol."""
+    reader, writer = await asyncio.open_connection(host, port)
+    await reader.readuntil(USERNAME_PROMPT.encode())
+    writer.write(hello_line(username))
+    await writer.drain()
+    return reader, writer
+
+
+async def open_gateway(host, port, gateway):
+    """Connect to the chat server as a gateway that multiplexes sessions."""
+    reader, writer = await asyncio.open_connection(host, port)
+    await reader.readuntil(USERNAME_PROMPT.encode())
+    writer.write(mux_hello_line(gateway))
+    await writer.drain()
+    return reader, writer
+
+
+def parse_v1_request(text):
+    """Turn one line of v1 text into the same request dict a v2 frame carries."""
+    message = text.strip()
+    if message.lower() == "exit":
+        return {"type": "exit"}
+    if message.startswith("!") and ":" not in message:
+        # Server commands such as !check and !stats
+        command, _, argument = message[1:].partition(" ")
+        request = {"type": command.lower()}
+        if argument.strip():
+            request["message"] = argument.strip()
+        return request
+    if ":" in message:
+        target_user, msg_content = message.split(":", 1)
+        return {"type": "chat", "destination": target_user.strip(), "message": msg_content.strip()}
+    return {"type": "invalid", "message": message}
+
+
+def stored_event(msg):
+    """Build a ``stored`` event from a message document returned by the API."""
+    return {
+        "type": "stored",
+        "sender": msg.get("sender"),
+        "destination": msg.get("destination"),
+        "timestamp": msg.get("timestamp"),
+        "message": msg.get("message", ""),
+        "message_type": msg.get("type", "chat"),
+        "metadata": msg.get("metadata") or {},
+    }
+
+
+def render_v1(event):
+    """Render an event as the text line a v1 client expects."""
+    kind = event.get("type")
+    if kind == "login_success":
+        return f"Connected! Users online: {', '.join(event.get('online_users', []))}\n"
+    if kind == "roster":
+        more = f" (more after '{event['next']}')" if event.get("next") else ""
+        return f"Users online ({event['count']}): {', '.join(event['users'])}{more}\n"
+    if kind == "presence":
+        changes = [f"{label}: {', '.join(event[key])}" for key, label in (("joined", "Joined"), ("left", "Left")) if event.get(key)]
+        return f"{'; '.join(changes) or 'No presence changes'} (version {event['version']})\n"
+    if kind == "chat":
+        room = f"[#{event['room']}]" if event.get("room") else ""
+        return f"{room}[{event['sender']}][{event['timestamp']}] {event['message']}\n"
+    if kind == "stored":
+        metadata = event.get("metadata")
+        suffix = f"Metadata: {metadata}" if metadata else ""
+        return (
+            f"[Stored] [{event.get('message_type', 'chat').upper()}][{event['timestamp']}]"
+            f"[{event['sender']}] {event['message']} {suffix}\n"
+        )
+    return f"{event.get('message', '')}\n"
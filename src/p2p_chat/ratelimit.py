@@ -0,0 +1,156 @@
+"""
+Client-side rate limiting for a provider that reports its own limits.
+
+``RateLimiter`` combines a token bucket (requests per second, with a burst)
+and a ceiling on concurrent calls. It starts from the configured values and
+then follows what the provider says in its replies:
+
+- ``x-ratelimit-remaining-requests`` / ``x-ratelimit-reset-requests`` set how
+  many calls are left and how fast they come back; at zero, calls wait for
+  the reset
+- ``x-ratelimit-remaining-tokens`` / ``x-ratelimit-reset-tokens`` pause calls
+  until the reset once fewer than ``token_reserve`` tokens are left
+- ``retry-after`` (or ``retry-after-ms``) on a 429 or 5xx pauses every call
+
+The concurrency ceiling adapts: it is halved on a 429 or 5xx and grows back
+by about one per ceiling's worth of successful calls, up to the maximum.
+``backoff`` gives the wait before a retry, with full jitter.
+"""
+import asyncio
+import random
+import re
+import time
+
+DEFAULT_RATE = 50.0  # Requests per second before the provider has said anything
+DEFAULT_BURST = 10  # Requests that may start back to back
+DEFAULT_TOKEN_RESERVE = 1000  # Tokens to keep in hand: a prompt plus max_tokens of reply
+BACKOFF_BASE = 0.5  # First retry waits up to this many seconds
+BACKOFF_MAX = 20.0
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(text):
+    """Seconds in a reset duration such as ``20ms``, ``1s`` or ``6m0s`` (plain numbers are seconds)."""
+    if text is None:
+        return None
+    text = text.strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(text)
+    if not parts:
+        return None
+    return sum(float(value) * UNITS[unit] for value, unit in parts)
+
+
+def retry_after(headers):
+    """Seconds a reply asks us to wait, if it says."""
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass  # An HTTP date; fall back to backoff
+    return None
+
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """Wait before retry number ``attempt`` (from 0): random up to base * 2**attempt."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def header_int(headers, name):
+    try:
+        return int(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """Token bucket plus an adaptive concurrency ceiling, steered by rate-limit headers."""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, max_concurrency=8, min_concurrency=1,
+                 token_reserve=DEFAULT_TOKEN_RESERVE):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.ceiling = float(max_concurrency)
+        self.token_reserve = token_reserve
+        self.in_flight = 0
+        self.paused_until = 0.0  # Nothing starts before this (monotonic) time
+        self.released = asyncio.Event()
+        self.throttled = 0  # 429s and 5xx seen
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Wait for a request slot. Pair with ``release``."""
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+            elif self.in_flight >= int(self.ceiling):
+                self.released.clear()
+                await self.released.wait()
+            elif self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+            else:
+                self.tokens -= 1
+                self.in_flight += 1
+                return
+
+    def release(self, status=None, headers=None):
+        """Finish a request; ``status`` is None if it never got a reply."""
+        self.in_flight -= 1
+        self.released.set()
+        if headers is not None:
+            self.update(headers)
+        if status == 429 or (status is not None and status >= 500):
+            self.throttled += 1
+            self.ceiling = max(self.min_concurrency, self.ceiling / 2)
+            wait = retry_after(headers or {})
+            if wait:
+                self.pause(wait)
+        elif status is not None and status < 400:
+            self.ceiling = min(self.max_concurrency, self.ceiling + 1 / self.ceiling)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update(self, headers):
+        """Take in the provider's view of our limits."""
+        now = time.monotonic()
+        self._refill(now)
+        limit = header_int(headers, "x-ratelimit-limit-requests")
+        remaining = header_int(headers, "x-ratelimit-remaining-requests")
+        reset = parse_reset(headers.get("x-ratelimit-reset-requests"))
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            self.tokens = min(self.tokens, remaining)
+            if limit and reset and remaining < limit:
+                self.rate = (limit - remaining) / reset  # Calls come back at this pace
+            if remaining == 0 and reset:
+                self.pause(reset)
+
+        remaining_tokens = header_int(headers, "x-ratelimit-remaining-tokens")
+        reset_tokens = parse_reset(headers.get("x-ratelimit-reset-tokens"))
+        if remaining_tokens is not None and remaining_tokens < self.token_reserve and reset_tokens:
+            self.pause(reset_tokens)
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "ceiling": int(self.ceiling), "rate": round(self.rate, 2),
+                "throttled": self.throttled}
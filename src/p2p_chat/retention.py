@@ -0,0 +1,137 @@
+"""
+Bounds on how much mail the Message API keeps.
+
+- Retention per message ``type``: messages get an ``expires_at`` stamp when
+  they are stored and are swept every ``sweep_interval`` seconds. MongoDB
+  also has a TTL index, a day behind, for anything no sweep got to.
+- A cap per destination and message ``type``: once a mailbox holds more than
+  the cap of a type, its oldest messages of that type are dropped. Trimming
+  runs in the background, so a mailbox can overshoot the cap for a moment,
+  and each busy mailbox is trimmed once per pass however many inserts
+  touched it.
+
+Both are off unless configured, so nothing stored is ever deleted by surprise.
+- Coalescing is chosen by the sender: a message whose ``metadata`` has a
+  ``coalesce`` key replaces older unclaimed messages in the same mailbox from
+  the same sender with the same key (engines do this in ``insert_many``), so
+  only the latest reading of superseded telemetry is kept.
+"""
+import asyncio
+import re
+import time
+
+DEFAULT_RETENTION = {}  # Seconds kept per message type; types not listed never expire
+DEFAULT_MAILBOX_CAPS = {}  # Messages kept per destination, by message type; types not listed are never trimmed
+SWEEP_INTERVAL = 60.0  # Seconds between expiry sweeps
+
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_duration(text):
+    """Seconds in a duration like ``90``, ``30m``, ``6h`` or ``7d``."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*", text)
+    if not match:
+        raise ValueError(f"invalid duration {text!r}; expected e.g. 90, 30m, 6h or 7d")
+    return float(match.group(1)) * UNITS[match.group(2) or "s"]
+
+
+def parse_retention(specs, base=DEFAULT_RETENTION):
+    """Apply ``TYPE=DURATION`` specs on top of ``base``; a duration of 0 keeps that type forever."""
+    retention = dict(base)
+    for spec in specs:
+        kind, sep, duration = spec.partition("=")
+        if not sep or not kind.strip():
+            raise ValueError(f"invalid retention {spec!r}; expected TYPE=DURATION, e.g. notification=6h")
+        seconds = parse_duration(duration)
+        if seconds:
+            retention[kind.strip()] = seconds
+        else:
+            retention.pop(kind.strip(), None)
+    return retention
+
+
+def parse_caps(specs, base=DEFAULT_MAILBOX_CAPS):
+    """Apply ``TYPE=COUNT`` specs on top of ``base``; a count of 0 removes the cap for that type."""
+    caps = dict(base)
+    for spec in specs:
+        kind, sep, count = spec.partition("=")
+        if not sep or not kind.strip() or not count.strip().isdigit():
+            raise ValueError(f"invalid mailbox cap {spec!r}; expected TYPE=COUNT, e.g. notification=1000")
+        if int(count):
+            caps[kind.strip()] = int(count)
+        else:
+            caps.pop(kind.strip(), None)
+    return caps
+
+
+class Retention:
+    """Stamps expiry times on new messages and keeps mailboxes within bounds."""
+
+    def __init__(self, storage, ttl=None, caps=None, sweep_interval=SWEEP_INTERVAL):
+        self.storage = storage
+        self.ttl = DEFAULT_RETENTION if ttl is None else ttl
+        self.caps = DEFAULT_MAILBOX_CAPS if caps is None else caps
+        self.sweep_interval = sweep_interval
+        self.dirty = set()  # (destination, type) pairs that got mail since their last trim
+        self.trimmer = None
+        self.sweeper = None
+
+    def stamp(self, document, now=None):
+        """Give a message its ``expires_at`` (seconds since the epoch) if its type expires."""
+        ttl = self.ttl.get(document.get("type"))
+        if ttl:
+            document["expires_at"] = (time.time() if now is None else now) + ttl
+        return document
+
+    def touch(self, mail):
+        """Note (destination, type) pairs that grew; capped types are checked shortly."""
+        if not self.caps:
+            return
+        self.dirty.update((destination, kind) for destination, kind in mail if kind in self.caps)
+        if self.dirty and self.trimmer is None:
+            self.trimmer = asyncio.create_task(self._trim())
+
+    async def _trim(self):
+        try:
+            while self.dirty:
+                dirty, self.dirty = self.dirty, set()
+                for destination, kind in dirty:
+                    cap = self.caps[kind]
+                    try:
+                        dropped = await self.storage.trim(destination, cap, kind)
+                    except Exception as e:
+                        print(f"Failed to trim {destination}'s mailbox: {e}")
+                        continue
+                    if dropped:
+                        print(f"Dropped {dropped} oldest {kind} messages for {destination} (cap {cap})")
+        finally:
+            self.trimmer = None
+
+    async def sweep(self, now=None):
+        """Remove expired messages now; returns how many went."""
+        return await self.storage.expire(time.time() if now is None else now)
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                expired = await self.sweep()
+            except Exception as e:
+                print(f"Expiry sweep failed: {e}")
+                continue
+            if expired:
+                print(f"Expired {expired} messages")
+
+    def start(self):
+        if self.ttl and self.sweeper is None:
+            self.sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def close(self):
+        for task in (self.sweeper, self.trimmer):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.sweeper = self.trimmer = None
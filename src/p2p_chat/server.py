@@ -1,122 +1,902 @@
 import asyncio
-import httpx
 import argparse
+import time
+import httpx
+from collections import deque
 from datetime import datetime, UTC
 
+from . import api_client
+from .presence import PresenceBatcher, Roster
+from .protocol import (
+    CONTROL,
+    FrameDecoder,
+    LineDecoder,
+    MUX,
+    MUX_HELLO,
+    ProtocolError,
+    READ_SIZE,
+    USERNAME_PROMPT,
+    V2_HELLO,
+    encode_frame,
+    encode_tagged,
+    parse_hello,
+    render_v1,
+    stored_event,
+    tag_frame,
+)
+from .spool import DEFAULT_MEMORY_LIMIT, DEFAULT_SPOOL_PATH, StoreQueue
+
 DEFAULT_HOST = '0.0.0.0'  # Localhost
 DEFAULT_PORT = 5000  # Server Port
 DEFAULT_API_BASE = 'http://localhost:8000'  # FastAPI address
 
-clients = {}  # username -> (reader, writer)
+# Outbound queue limits, counted in queued messages per connection
+DEFAULT_QUEUE_MAX = 10000  # Hard cap; the slow-consumer policy applies immediately
+DEFAULT_HIGH_WATERMARK = 1000  # Above this a consumer is considered lagging
+DEFAULT_LOW_WATERMARK = 100  # ...until it drains back below this
+DEFAULT_SLOW_CONSUMER_TIMEOUT = 10.0  # Seconds lagging before the policy applies
+SLOW_CONSUMER_POLICIES = ("drop", "spill")
+WRITE_BATCH = 256  # Queued messages coalesced into one socket write
+MAILBOX_PAGE_SIZE = 500  # Stored messages fetched and written per batch
+MAILBOX_LEASE = 30.0  # Seconds a claimed page stays hidden before it is offered again
+MAIL_PUSH_MAX_BACKOFF = 30.0  # Longest wait before reconnecting to the API's event stream
+GATEWAY_QUEUE_MAX = 1000000  # Frames queued for one gateway before it is disconnected
 
-async def send_message(writer, message):
-    try:
-        writer.write(message.encode())
-        await writer.drain()
-        return True  # Message sent successfully
-    except:
-        return False  # Failed to send message
+outbound_settings = {
+    "queue_max": DEFAULT_QUEUE_MAX,
+    "high_watermark": DEFAULT_HIGH_WATERMARK,
+    "low_watermark": DEFAULT_LOW_WATERMARK,
+    "slow_consumer_timeout": DEFAULT_SLOW_CONSUMER_TIMEOUT,
+    "slow_consumer_policy": "drop",
+    "spool_path": DEFAULT_SPOOL_PATH,  # Where stores wait while the Message API is down (None: memory only)
+}
+
+BROADCAST_DESTINATION = "TO_ALL"  # Delivered to everyone online, never stored
+ROOM_PREFIX = "#"  # Destinations like "#general" publish to a room
+
+clients = {}  # username -> ClientConnection
+roster = Roster()  # Everyone online, including users on other workers or nodes
+gateways = set()  # Connected GatewayLinks; roster changes are pushed to them
+presence_batcher = None
+rooms = {}  # room -> set of member usernames (online or not)
+background_tasks = set()  # Keeps fire-and-forget tasks alive until they finish
+store_queues = {}  # api_base -> StoreQueue, for the running event loop
+_store_loop = None
+router = None  # Reaches users held by other processes; set in --workers and cluster mode
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def settle(future, result):
+    if not future.done():
+        future.set_result(result)
+
+class ClientConnection:
+    """A logged-in user's streams and the protocol version they negotiated.
+
+    Everything sent to the user goes through a bounded outbound queue drained
+    by the connection's own writer task, so a slow reader only ever stalls
+    itself. A consumer that stays above the high watermark for too long (or
+    hits the hard cap) is handled by the slow-consumer policy: ``drop``
+    disconnects it, ``spill`` moves its queued chat messages to the Message API
+    and keeps everything else queued.
+
+    Bytes queued with a ``sent`` future resolve it to True once they have been
+    written to the socket, or to False if they never will be.
+    """
+
+    def __init__(self, username, reader, writer, version=1, api_base=DEFAULT_API_BASE):
+        self.username = username
+        self.reader = reader
+        self.writer = writer
+        self.version = version
+        self.api_base = api_base
+        self.queue = deque()  # (encoded bytes, event or None, sent future or None)
+        self.queued_bytes = 0
+        self.lagging_since = None
+        self.evicted = 0  # Messages dropped or spilled by the slow-consumer policy
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._writer_task = None
+        self.delivering = False  # A mailbox delivery is running
+        self.mail_waiting = False  # More mail was reported while it ran
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    def encode(self, event):
+        """Serialize an event the way this client's protocol expects it."""
+        if self.version == 2:
+            return encode_frame(event)
+        return render_v1(event).encode()
+
+    def start(self):
+        self._writer_task = spawn(self._write_loop())
+
+    def send(self, event):
+        """Queue an event. Returns False if the connection can no longer take it."""
+        return self.send_raw(self.encode(event), event)
+
+    def send_encoded(self, event, encoded):
+        """Queue an event shared by many recipients, serializing it at most once
+        per protocol version. ``encoded`` is a dict cache owned by the caller."""
+        data = encoded.get(self.version)
+        if data is None:
+            data = encoded[self.version] = self.encode(event)
+        return self.send_raw(data, event)
+
+    def send_raw(self, data, event=None, sent=None):
+        """Queue pre-encoded bytes; ``event`` is kept so it can be spilled."""
+        if self.closed:
+            if sent is not None:
+                settle(sent, False)
+            return False
+        self.queue.append((data, event, sent))
+        self.queued_bytes += len(data)
+        self._ready.set()
+        self._check_watermarks()
+        return not self.closed
+
+    def _check_watermarks(self):
+        depth = len(self.queue)
+        if depth >= outbound_settings["high_watermark"]:
+            now = time.monotonic()
+            if self.lagging_since is None:
+                self.lagging_since = now
+                print(f"{self.username} is lagging ({depth} messages queued).")
+            if (depth >= outbound_settings["queue_max"]
+                    or now - self.lagging_since >= outbound_settings["slow_consumer_timeout"]):
+                self._apply_slow_consumer_policy()
+        elif depth <= outbound_settings["low_watermark"]:
+            self.lagging_since = None
+
+    def _apply_slow_consumer_policy(self):
+        self.lagging_since = None
+        if outbound_settings["slow_consumer_policy"] == "spill":
+            # Chat goes to the Message API. Mailbox pages are still stored (just
+            # not acked) and come back when their lease runs out. Presence,
+            # system notices and the like stay queued.
+            pending, kept = [], deque()
+            for entry in self.queue:
+                _, event, sent = entry
+                if sent is not None:
+                    settle(sent, False)
+                elif event and event.get("type") == "chat":
+                    pending.append(event)
+                else:
+                    kept.append(entry)
+            if len(kept) < outbound_settings["high_watermark"]:
+                self.evicted += len(self.queue) - len(kept)
+                self.queue = kept
+                self.queued_bytes = sum(len(data) for data, _, _ in kept)
+                print(f"{self.username} is too slow; spilling {len(pending)} messages to the Message API.")
+                spawn(spill_messages(self.username, pending, self.api_base))
+                self.send({"type": "system", "message": f"You fell behind; {len(pending)} messages were saved. Use !check to read them."})
+                return
+            spawn(spill_messages(self.username, pending, self.api_base))  # Nothing left to spill; give up on them
+        print(f"{self.username} is too slow; disconnecting.")
+        self.evicted += len(self.queue)
+        self._abort()
+
+    def _abort(self):
+        """Drop the connection and everything queued on it, without flushing."""
+        self.closed = True
+        self._fail_queued()
+        self._ready.set()
+        self.writer.transport.abort()
+
+    def _fail_queued(self):
+        for _, _, sent in self.queue:
+            if sent is not None:
+                settle(sent, False)
+        self.queue.clear()
+        self.queued_bytes = 0
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                if not self.queue:
+                    if self.closed:
+                        break
+                    continue
+
+                # Coalesce whatever has piled up into one write
+                batch = []
+                waiting = []  # Futures of the bytes in this write
+                while self.queue and len(batch) < WRITE_BATCH:
+                    data, _, sent = self.queue.popleft()
+                    self.queued_bytes -= len(data)
+                    batch.append(data)
+                    if sent is not None:
+                        waiting.append(sent)
+                if self.queue or self.closed:
+                    self._ready.set()
+
+                try:
+                    self.writer.write(b"".join(batch))
+                    await self.writer.drain()
+                except Exception:
+                    for sent in waiting:
+                        settle(sent, False)
+                    raise
+                for sent in waiting:
+                    settle(sent, True)
+
+                if len(self.queue) <= outbound_settings["low_watermark"]:
+                    self.lagging_since = None
+        except Exception:
+            self.closed = True
+            self._fail_queued()
 
-async def store_message(sender, destination, message, api_base=DEFAULT_API_BASE):
-    async with httpx.AsyncClient() as client:
-        await client.post(f"{api_base}/messages/", json={
+    def send_page(self, data):
+        """Queue bytes that must not be acked unless written; returns a future
+        that resolves to whether they were."""
+        sent = asyncio.get_running_loop().create_future()
+        self.send_raw(data, None, sent)
+        return sent
+
+    async def close(self, timeout=1.0):
+        """Flush what is queued (up to ``timeout`` seconds) and close the socket."""
+        self.closed = True
+        self._ready.set()
+        if self._writer_task is not None:
+            try:
+                await asyncio.wait_for(self._writer_task, timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+        self._fail_queued()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+class GatewayLink(ClientConnection):
+    """A gateway's connection (``P2P/MUX``), carrying the sessions of many users.
+
+    All sessions share this connection's outbound queue and writer task. The
+    gateway keeps its own per-user limits, so only the hard cap applies here:
+    one lagging browser mustn't cost everyone else on the link their session.
+    Roster changes go to the link's control session in batches, once for all
+    of its users.
+    """
+
+    def __init__(self, name, reader, writer, api_base=DEFAULT_API_BASE):
+        super().__init__(name, reader, writer, 2, api_base)
+        self.sessions = {}  # session id -> GatewaySession
+
+    def encode(self, event):
+        return encode_tagged(CONTROL, event)  # Events for the link itself go on the control session
+
+    def start(self):
+        super().start()
+        gateways.add(self)
+        follow_presence()
+
+    def _check_watermarks(self):
+        if len(self.queue) >= GATEWAY_QUEUE_MAX:
+            print(f"Gateway {self.username} stopped reading; disconnecting it.")
+            self._abort()
+
+    def submit(self, session_id, request):
+        """Hand a request to its session; an ``open`` request starts one."""
+        session = self.sessions.get(session_id)
+        if session is None:
+            if request.get("type") != "open":
+                return
+            session = self.sessions[session_id] = GatewaySession(self, session_id, request.get("username"))
+        session.requests.append(request)
+        if not session.serving:
+            session.serving = True
+            spawn(session.serve())
+
+    async def close(self, timeout=1.0):
+        gateways.discard(self)
+        for session in list(self.sessions.values()):
+            session.end(notify=False)
+        await super().close(timeout)
+
+
+class GatewaySession(ClientConnection):
+    """One user logged in through a gateway.
+
+    The link's control session reports the login, then the user gets the
+    usual welcome with the first roster page. Events are tagged
+    with the session id and queued on the gateway's link;
+    v2 frames shared by many recipients are retagged, not re-serialized.
+    Requests run in order per session, on a task that only exists while the
+    session has requests waiting, so a slow ``!check`` holds up nobody else.
+    """
+
+    def __init__(self, link, session_id, username):
+        super().__init__((username or "").strip(), None, link.writer, 2, link.api_base)
+        self.link = link
+        self.session_id = session_id
+        self.requests = deque()
+        self.serving = False
+        self.logged_in = False
+
+    def encode(self, event):
+        return encode_tagged(self.session_id, event)
+
+    def send_encoded(self, event, encoded):
+        frame = encoded.get(2)
+        if frame is None:
+            frame = encoded[2] = encode_frame(event)
+        return self.send_raw(tag_frame(self.session_id, frame), event)
+
+    def send_raw(self, data, event=None, sent=None):
+        if self.closed:
+            if sent is not None:
+                settle(sent, False)
+            return False
+        return self.link.send_raw(data, None, sent)
+
+    def start(self):
+        pass  # The link's writer task does the writing
+
+    async def close(self, timeout=1.0):
+        self.end()
+
+    async def serve(self):
+        try:
+            while self.requests and not self.closed:
+                request = self.requests.popleft()
+                if request.get("type") == "open":
+                    if not self.logged_in:
+                        await self.open()
+                    continue
+                try:
+                    running = await handle_request(self, request, self.api_base)
+                except Exception as e:
+                    print(f"Request from {self.username} failed: {e!r}")
+                    self.send({"type": "system", "message": "Request failed; please try again."})
+                    continue
+                if not running:
+                    self.end(notify=False)
+        finally:
+            self.serving = False
+
+    async def open(self):
+        if not self.username or not await login(self):
+            self.end(message="Username already taken. Disconnecting...")
+            return
+        self.logged_in = True
+        if self.closed:  # The gateway went away while we were checking the name
+            self.logged_in = False
+            logout(self)
+            return
+        print(f"{self.username} connected (gateway {self.link.username}).")
+        self.link.send({"type": "opened", "session": self.session_id})
+        welcome(self)
+        spawn(push_stored_messages(self, self.api_base))  # The session's requests don't wait for it
+
+    def end(self, notify=True, message="Session closed."):
+        """Log the user out; ``notify`` tells the gateway the server ended the session."""
+        if self.link.sessions.get(self.session_id) is self:
+            del self.link.sessions[self.session_id]
+        if notify and not self.closed:
+            self.link.send({"type": "closed", "session": self.session_id, "message": message})
+        self.closed = True
+        self.requests.clear()
+        if self.logged_in:
+            self.logged_in = False
+            print(f"{self.username} disconnected.")
+            logout(self)
+
+def queue_stats():
+    """Outbound queue depth per connection, deepest first."""
+    stats = [
+        {
+            "username": conn.username,
+            "depth": conn.depth,
+            "bytes": conn.queued_bytes,
+            "lagging": conn.lagging_since is not None,
+            "evicted": conn.evicted,
+        }
+        for conn in clients.values()
+    ]
+    return sorted(stats, key=lambda s: s["depth"], reverse=True)
+
+def store_queue(api_base=DEFAULT_API_BASE):
+    """The write-behind queue for ``api_base``, started on first use."""
+    global _store_loop
+    loop = asyncio.get_running_loop()
+    if _store_loop is not loop:
+        store_queues.clear()  # Queues from a previous event loop can't be used here
+        _store_loop = loop
+    queue = store_queues.get(api_base)
+    if queue is None:
+        path = outbound_settings.get("spool_path")
+        if path is not None and store_queues:
+            path = f"{path}.{len(store_queues)}"  # One spool per Message API
+        queue = store_queues[api_base] = StoreQueue(api_base, path)
+        queue.start()
+    return queue
+
+async def close_store_queues():
+    """Send or spool whatever is still queued for the Message API."""
+    queues = list(store_queues.values())
+    store_queues.clear()
+    for queue in queues:
+        await queue.close()
+
+async def store_message(sender, destination, message, api_base=DEFAULT_API_BASE, msg_type="chat", metadata=None):
+    """Queue a message for storage; returns without waiting for the Message API."""
+    store_queue(api_base).put([{
+        "sender": sender,
+        "destination": destination,
+        "message": message,
+        "timestamp": datetime.now(UTC).isoformat(),
+        "type": msg_type,
+        "metadata": metadata or {}
+    }])
+
+async def store_messages(sender, destinations, message, api_base=DEFAULT_API_BASE, msg_type="chat", metadata=None):
+    """Queue the same message for many destinations; they are sent in one batch."""
+    timestamp = datetime.now(UTC).isoformat()
+    store_queue(api_base).put([
+        {
             "sender": sender,
             "destination": destination,
             "message": message,
-            "timestamp": datetime.now(UTC).isoformat(),
-            "type": "chat",
-            "metadata": {}
-        })
-
-async def get_stored_messages(username, api_base=DEFAULT_API_BASE):
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{api_base}/messages/{username}")
-        messages = response.json().get("messages", [])
-        return [
-            f"[{msg['type'].upper()}][{msg['timestamp']}][{msg['sender']}] {msg['message']} {f'Metadata: {msg['metadata']}' if msg.get('metadata') else ''}"
-            for msg in messages
+            "timestamp": timestamp,
+            "type": msg_type,
+            "metadata": metadata or {}
+        }
+        for destination in destinations
+    ])
+
+async def get_stored_messages(username, api_base=DEFAULT_API_BASE, limit=MAILBOX_PAGE_SIZE):
+    """Claim one page of a user's mailbox, oldest first.
+
+    The messages stay in the store until ``ack_stored_messages``; if that never
+    happens they are offered again once the lease runs out. Raises
+    ``httpx.HTTPStatusError`` if the API answers with an error.
+    """
+    reply = await api_client.post(f"{api_base}/messages/{username}/claim",
+                                  params={"limit": limit, "lease": MAILBOX_LEASE}, check=True)
+    return reply.get("messages", [])
+
+async def get_mailbox_summary(username, api_base=DEFAULT_API_BASE):
+    """Unread counts for a user, without touching the messages."""
+    return await api_client.call("GET", f"{api_base}/messages/{username}/summary", check=True)
+
+async def ack_stored_messages(username, ids, api_base=DEFAULT_API_BASE):
+    """Delete delivered messages from the store."""
+    await api_client.post(f"{api_base}/messages/{username}/ack", {"ids": ids}, check=True)
+
+async def spill_messages(username, events, api_base=DEFAULT_API_BASE):
+    """Store queued chat events for a user we couldn't keep up with."""
+    for event in events:
+        try:
+            await store_message(event["sender"], username, event["message"], api_base,
+                                event.get("message_type", "chat"), event.get("metadata"))
+        except Exception as e:
+            print(f"Failed to spill message for {username}: {e}")
+
+async def deliver_stored_messages(conn, api_base=DEFAULT_API_BASE):
+    """Stream a user's mailbox to them a page at a time.
+
+    Each page goes out as one coalesced write and is acked once the writer
+    has written it, before the next page is claimed, so memory use stays flat
+    no matter how large the mailbox is. A page that never reaches the socket
+    (the connection failed, or the slow-consumer policy dropped it) is not
+    acked and comes back when its lease expires.
+
+    Only one delivery runs per connection; asking again while it runs makes
+    it go round once more when it finishes, instead of claiming in parallel.
+    """
+    if conn.delivering:
+        conn.mail_waiting = True
+        return
+    conn.delivering = True
+    try:
+        while True:
+            conn.mail_waiting = False
+            await stream_mailbox(conn, api_base)
+            if conn.closed or not conn.mail_waiting:
+                break
+    finally:
+        conn.delivering = False
+
+async def stream_mailbox(conn, api_base=DEFAULT_API_BASE):
+    while not conn.closed:
+        stored_msgs = await get_stored_messages(conn.username, api_base, MAILBOX_PAGE_SIZE)
+        if not stored_msgs:
+            break
+        if not await conn.send_page(b"".join(conn.encode(stored_event(msg)) for msg in stored_msgs)):
+            break
+        ids = [msg["_id"] for msg in stored_msgs if "_id" in msg]
+        if ids:
+            await ack_stored_messages(conn.username, ids, api_base)
+        if len(stored_msgs) < MAILBOX_PAGE_SIZE:
+            break
+
+async def check_mailbox(conn, api_base=DEFAULT_API_BASE):
+    """``!check``: say so if the mailbox is empty, otherwise deliver it."""
+    try:
+        summary = await get_mailbox_summary(conn.username, api_base)
+    except Exception as e:
+        print(f"Mailbox summary for {conn.username} failed ({e}); fetching anyway")
+        summary = None
+    if summary is not None and not summary.get("total"):
+        conn.send({"type": "system", "message": "No stored messages."})
+        return
+    try:
+        await deliver_stored_messages(conn, api_base)
+    except Exception as e:
+        print(f"Failed to deliver stored messages to {conn.username}: {e}")
+        conn.send({"type": "system", "message": "Your mailbox is unavailable right now; try again later."})
+
+async def push_stored_messages(conn, api_base=DEFAULT_API_BASE):
+    """Deliver a user's mailbox, logging rather than raising if the API fails."""
+    try:
+        await deliver_stored_messages(conn, api_base)
+    except Exception as e:
+        print(f"Failed to deliver stored messages to {conn.username}: {e}")
+
+async def watch_mailboxes(api_base=DEFAULT_API_BASE):
+    """Deliver mail stored for online users as soon as the Message API reports it.
+
+    Follows the API's ``/events`` stream and reconnects with backoff. After a
+    reconnect every online user's mailbox is checked, since mail may have
+    arrived while the stream was down.
+    """
+    backoff, connected = 0, False
+    while True:
+        try:
+            async for _, data in api_client.events(f"{api_base}/events"):
+                if not connected:
+                    print("Following Message API events; stored messages are pushed to online users")
+                    connected = True
+                    if backoff:
+                        for conn in list(clients.values()):
+                            spawn(push_stored_messages(conn, api_base))
+                    backoff = 0
+                for destination in data.get("destinations", ()):
+                    conn = clients.get(destination)
+                    if conn is not None:
+                        spawn(push_stored_messages(conn, api_base))
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                print("The Message API has no event stream; stored messages wait for login or !check")
+                return
+            print(f"Message API event stream failed: {e}")
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"Message API event stream failed: {e!r}")
+        connected = False
+        backoff = min(backoff * 2 or 1, MAIL_PUSH_MAX_BACKOFF)
+        await asyncio.sleep(backoff)
+
+async def login(conn):
+    """Register a connection under its username; False if the name is taken."""
+    username = conn.username
+    # With several workers the username must also be free on every other one
+    if username in clients or (router is not None and not await router.claim(username)):
+        return False
+    clients[username] = conn
+    roster.join(username)
+    return True
+
+def logout(conn):
+    del clients[conn.username]
+    roster.leave(conn.username)
+    if router is not None:
+        router.release(conn.username)
+
+async def read_handshake(reader):
+    """Read the login line; returns (version, username, bytes read past it)."""
+    data = await reader.read(1024)
+    if data.startswith((V2_HELLO.encode(), MUX_HELLO.encode())):
+        # v2 clients and gateways always terminate the hello, so wait for the whole line
+        while b"\n" not in data:
+            more = await reader.read(1024)
+            if not more:
+                break
+            data += more
+    line, _, rest = data.partition(b"\n")
+    version, username = parse_hello(line.decode(errors="replace"))
+    return version, username, rest
+
+async def route_message(conn, request, api_base=DEFAULT_API_BASE):
+    """Deliver a chat request to its destination, storing it if they're offline."""
+    username = conn.username
+    target_user = (request.get("destination") or "").strip()
+    msg_content = request.get("message", "")
+    msg_type = request.get("message_type", "chat")
+    metadata = request.get("metadata") or {}
+
+    event = {
+        "type": "chat",
+        "sender": username,
+        "destination": target_user,
+        "timestamp": datetime.now(UTC).isoformat(),
+        "message": msg_content,
+        "message_type": msg_type,
+        "metadata": metadata,
+    }
+
+    if target_user in clients:
+        # Queue it on the recipient's connection; never wait on their socket here
+        if not clients[target_user].send(event):
+            # If failed to send (connection might be stale), store it
+            print(f"Failed to send message to {target_user}, storing instead.")
+            await store_message(username, target_user, msg_content, api_base, msg_type, metadata)
+            conn.send({"type": "system", "message": f"Message to '{target_user}' couldn't be delivered. Message saved."})
+    elif router is not None and router.forward(target_user, event):
+        pass  # Online on another worker, which queues it for them
+    else:
+        # User is offline, store the message
+        await store_message(username, target_user, msg_content, api_base, msg_type, metadata)
+        conn.send({"type": "system", "message": f"User '{target_user}' is offline. Message saved."})
+
+def join_room(username, room, propagate=True):
+    rooms.setdefault(room, set()).add(username)
+    if propagate and router is not None:
+        router.room_changed("join", username, room)
+
+def leave_room(username, room, propagate=True):
+    members = rooms.get(room)
+    if members is not None:
+        members.discard(username)
+        if not members:
+            del rooms[room]
+    if propagate and router is not None:
+        router.room_changed("leave", username, room)
+
+def welcome(conn):
+    """The login_success event: the first roster page plus the version to sync from.
+
+    v1 clients get the full list as one line, rebuilt only when presence changes.
+    """
+    if conn.version == 1:
+        return conn.send_raw(f"Connected! Users online: {roster.text()}\n".encode())
+    page = roster.snapshot()
+    return conn.send({
+        "type": "login_success",
+        "online_users": page["users"],
+        "online_count": page["count"],
+        "presence_version": page["version"],
+        "next": page["next"],
+    })
+
+def publish_presence(event):
+    """Send a batch of roster changes to every gateway, for all of its users at once."""
+    for link in list(gateways):
+        link.send(event)
+
+def follow_presence():
+    """Batch changes to the roster for the gateways, once one has connected."""
+    global presence_batcher
+    if presence_batcher is None or presence_batcher.roster is not roster:
+        presence_batcher = PresenceBatcher(roster, publish_presence)
+        roster.on_change = presence_batcher.changed
+
+def presence_request(conn, request):
+    """Answer ``presence`` requests: changes since a version, or a roster page."""
+    since = request.get("since")
+    if since is not None:
+        delta = roster.delta(int(since))
+        if delta is not None:
+            return conn.send({"type": "presence", **delta})
+    after = request.get("after") or request.get("message") or None  # v1: !presence <cursor>
+    conn.send({"type": "roster", **roster.snapshot(after=after)})
+
+def user_rooms(username):
+    return sorted(room for room, members in rooms.items() if username in members)
+
+def fan_out(sender, usernames, event):
+    """Queue one event on every online user in ``usernames`` (except the sender).
+
+    The event is serialized once per protocol version and the same bytes are
+    queued everywhere. Returns the users that are offline or couldn't take it.
+    """
+    encoded = {}
+    undelivered = []
+    for username in usernames:
+        if username == sender:
+            continue
+        target = clients.get(username)
+        if target is None or not target.send_encoded(event, encoded):
+            undelivered.append(username)
+    return undelivered
+
+async def publish(conn, room, request, api_base=DEFAULT_API_BASE):
+    """Publish to a room: live delivery to online members, one bulk store for the rest."""
+    members = rooms.get(room)
+    if not members:
+        conn.send({"type": "system", "message": f"Room '{ROOM_PREFIX}{room}' has no members."})
+        return
+
+    msg_content = request.get("message", "")
+    msg_type = request.get("message_type", "chat")
+    metadata = {**(request.get("metadata") or {}), "room": room}
+    event = {
+        "type": "chat",
+        "sender": conn.username,
+        "destination": ROOM_PREFIX + room,
+        "room": room,
+        "timestamp": datetime.now(UTC).isoformat(),
+        "message": msg_content,
+        "message_type": msg_type,
+        "metadata": metadata,
+    }
+
+    offline = fan_out(conn.username, members, event)
+    if router is not None:
+        offline = router.forward_many(offline, event)
+    if offline:
+        await store_messages(conn.username, offline, msg_content, api_base, msg_type, metadata)
+    online = len(members) - len(offline) - (conn.username in members)
+    conn.send({"type": "system", "message": f"Published to {ROOM_PREFIX}{room}: {online} delivered, {len(offline)} saved."})
+
+def broadcast(conn, request):
+    """Deliver a message to everyone currently online."""
+    event = {
+        "type": "chat",
+        "sender": conn.username,
+        "destination": BROADCAST_DESTINATION,
+        "timestamp": datetime.now(UTC).isoformat(),
+        "message": request.get("message", ""),
+        "message_type": request.get("message_type", "chat"),
+        "metadata": request.get("metadata") or {},
+    }
+    fan_out(conn.username, list(clients), event)
+    if router is not None:
+        router.broadcast(event)
+
+def room_argument(request):
+    return (request.get("room") or request.get("message") or "").strip().lstrip(ROOM_PREFIX)
+
+async def handle_request(conn, request, api_base=DEFAULT_API_BASE):
+    """Act on one parsed request. Returns False when the session should end."""
+    kind = request.get("type")
+    if kind == "exit":
+        return False
+    elif kind == "check":
+        await check_mailbox(conn, api_base)
+    elif kind == "stats":
+        lines = [
+            f"{s['username']}: {s['depth']} queued{' (lagging)' if s['lagging'] else ''}"
+            for s in queue_stats()
         ]
+        conn.send({"type": "system", "message": "Outbound queues:\n" + "\n".join(lines), "metadata": {"queues": queue_stats()}})
+    elif kind == "join" and room_argument(request):
+        room = room_argument(request)
+        join_room(conn.username, room)
+        conn.send({"type": "system", "message": f"Joined {ROOM_PREFIX}{room} ({len(rooms[room])} members)."})
+    elif kind == "leave" and room_argument(request):
+        room = room_argument(request)
+        leave_room(conn.username, room)
+        conn.send({"type": "system", "message": f"Left {ROOM_PREFIX}{room}."})
+    elif kind == "presence":
+        presence_request(conn, request)
+    elif kind == "rooms":
+        joined = ", ".join(ROOM_PREFIX + room for room in user_rooms(conn.username)) or "none"
+        conn.send({"type": "system", "message": f"Your rooms: {joined}"})
+    elif kind == "chat" and request.get("destination"):
+        destination = request["destination"].strip()
+        if destination == BROADCAST_DESTINATION:
+            broadcast(conn, request)
+        elif destination.startswith(ROOM_PREFIX):
+            await publish(conn, destination[len(ROOM_PREFIX):], request, api_base)
+        else:
+            await route_message(conn, request, api_base)
+    else:
+        conn.send({"type": "system", "message": "Invalid format. Use: TO_USERNAME: MESSAGE"})
+    return True
+
+def parse_requests(decoder, data):
+    """The requests one read completes: every whole v2 frame or v1 line.
+
+    An empty read is the end of the stream; a v1 client's last line counts
+    even without its newline.
+    """
+    if data:
+        return decoder.feed(data)
+    return decoder.finish() if isinstance(decoder, LineDecoder) else []
 
 async def handle_client(reader, writer, api_base=DEFAULT_API_BASE):
-    writer.write("Enter your username: ".encode())
+    writer.write(USERNAME_PROMPT.encode())
     await writer.drain()
-    username = (await reader.read(1024)).decode().strip()
+    version, username, pending = await read_handshake(reader)
+    if version == MUX:
+        return await handle_gateway(reader, writer, username, pending, api_base)
+    conn = ClientConnection(username, reader, writer, version, api_base)
 
-    if username in clients:
-        writer.write("Username already taken. Disconnecting...\n".encode())
+    if not await login(conn):
+        writer.write(conn.encode({"type": "system", "message": "Username already taken. Disconnecting..."}))
         await writer.drain()
         writer.close()
         await writer.wait_closed()
         return
 
-    clients[username] = (reader, writer)
-    print(f"{username} connected.")
+    conn.start()
+    print(f"{username} connected (protocol v{version}).")
 
-    await send_message(writer, f"Connected! Users online: {', '.join(clients.keys())}\n")
+    welcome(conn)
 
-    # Retrieve stored messages
-    stored_msgs = await get_stored_messages(username, api_base)
-    for msg in stored_msgs:
-        await send_message(writer, f"[Stored] {msg}\n")
+    decoder = FrameDecoder() if version == 2 else LineDecoder()
+    # Stored messages stream in the background; the user can chat meanwhile
+    spawn(push_stored_messages(conn, api_base))
+    try:
+        data = pending
+        running = True
+        while running:
+            if not data:
+                data = await reader.read(READ_SIZE)
+            ended = not data
 
+            # A single read may carry several pipelined requests, or part of one
+            for request in parse_requests(decoder, data):
+                try:
+                    running = await handle_request(conn, request, api_base)
+                except Exception as e:
+                    # One failed request (e.g. the Message API is down) doesn't end the session
+                    print(f"Request from {username} failed: {e!r}")
+                    conn.send({"type": "system", "message": "Request failed; please try again."})
+                    continue
+                if not running:
+                    break
+            if ended:
+                break
+            data = b""
+    except (ConnectionError, ProtocolError) as e:
+        print(f"{username}'s connection failed: {e}")
+    finally:
+        print(f"{username} disconnected.")
+        logout(conn)
+        await conn.close()
+
+async def handle_gateway(reader, writer, name, pending=b"", api_base=DEFAULT_API_BASE):
+    """Serve a gateway's connection: one link, any number of user sessions."""
+    link = GatewayLink(name, reader, writer, api_base)
+    link.start()
+    print(f"Gateway {name} connected.")
+    decoder = FrameDecoder(tagged=True)
     try:
+        data = pending
         while True:
-            data = await reader.read(1024)
             if not data:
-                break
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+            for session_id, request in decoder.feed(data):
+                link.submit(session_id, request)
+            data = b""
+    except (ConnectionError, ProtocolError) as e:
+        print(f"Gateway {name}'s connection failed: {e}")
+    finally:
+        print(f"Gateway {name} disconnected ({len(link.sessions)} sessions).")
+        await link.close()
 
-            message = data.decode().strip()
-            if message.lower() == "exit":
-                break
-            elif message.lower() == "!check":
-                stored_msgs = await get_stored_messages(username, api_base)
-                for msg in stored_msgs:
-                    await send_message(writer, f"[Stored] {msg}\n")
-                continue
-
-            if ":" in message:
-                target_user, msg_content = message.split(":", 1)
-                target_user = target_user.strip()
-                msg_content = msg_content.strip()
-
-                timestamp = datetime.now(UTC).isoformat()
-
-                if target_user in clients:
-                    _, target_writer = clients[target_user]
-                    # Try to send message directly
-                    sent = await send_message(target_writer, f"[{username}][{timestamp}] {msg_content}\n")
-                    if not sent:
-                        # If failed to send (connection might be stale), store it
-                        print(f"Failed to send message to {target_user}, storing instead.")
-                        await store_message(username, target_user, msg_content, api_base)
-                        await send_message(writer, f"Message to '{target_user}' couldn't be delivered. Message saved.\n")
-                else:
-                    # User is offline, store the message
-                    await store_message(username, target_user, msg_content, api_base)
-                    await send_message(writer, f"User '{target_user}' is offline. Message saved.\n")
-            else:
-                await send_message(writer, "Invalid format. Use: TO_USERNAME: MESSAGE\n")
-    except:
-        pass
-
-    print(f"{username} disconnected.")
-    del clients[username]
-    writer.close()
-    await writer.wait_closed()
-
-async def run_server(host=DEFAULT_HOST, port=DEFAULT_PORT, api_base=DEFAULT_API_BASE):
+async def run_server(host=DEFAULT_HOST, port=DEFAULT_PORT, api_base=DEFAULT_API_BASE, reuse_port=False):
     """Starts the chat server."""
     server = await asyncio.start_server(
         lambda r, w: handle_client(r, w, api_base), 
         host, 
-        port
+        port,
+        reuse_port=reuse_port or None
     )
     addr = server.sockets[0].getsockname()
     print(f"Server running on {addr}")
     print(f"Using API at {api_base}")
+    watcher = spawn(watch_mailboxes(api_base))
     
-    async with server:
-        await server.serve_forever()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watcher.cancel()
+        await close_store_queues()
+        await api_client.close_client()
 
 def main(host=DEFAULT_HOST, port=DEFAULT_PORT, api_base=DEFAULT_API_BASE):
     """Main function to run the server."""
@@ -128,9 +908,54 @@ def main_entry():
     parser.add_argument('--host', default=DEFAULT_HOST, help='Server host')
     parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Server port')
     parser.add_argument('--api-base', default=DEFAULT_API_BASE, help='API base URL')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes sharing the port via SO_REUSEPORT (default: 1)')
+    cluster = parser.add_argument_group('Cluster mode')
+    cluster.add_argument('--node-id', help='Run as a cluster node with this unique id')
+    cluster.add_argument('--cluster-listen', default='0.0.0.0:5100',
+                         help='HOST:PORT other nodes connect to (default: 0.0.0.0:5100)')
+    cluster.add_argument('--peer', action='append', default=[], metavar='ID=HOST:PORT',
+                         help='Another cluster node; repeat for each one')
+    parser.add_argument('--queue-max', type=int, default=DEFAULT_QUEUE_MAX,
+                        help='Hard cap on queued outbound messages per connection')
+    parser.add_argument('--queue-high-watermark', type=int, default=DEFAULT_HIGH_WATERMARK,
+                        help='Queue depth at which a connection counts as lagging')
+    parser.add_argument('--queue-low-watermark', type=int, default=DEFAULT_LOW_WATERMARK,
+                        help='Queue depth at which a lagging connection has caught up')
+    parser.add_argument('--slow-consumer-timeout', type=float, default=DEFAULT_SLOW_CONSUMER_TIMEOUT,
+                        help='Seconds a connection may lag before the slow-consumer policy applies')
+    parser.add_argument('--slow-consumer-policy', choices=SLOW_CONSUMER_POLICIES, default="drop",
+                        help='Disconnect slow consumers (drop) or save their backlog to the Message API (spill)')
+    parser.add_argument('--spool-path', default=DEFAULT_SPOOL_PATH,
+                        help='File that holds messages to store while the Message API is unreachable '
+                             f'(default: {DEFAULT_SPOOL_PATH}; "" keeps up to {DEFAULT_MEMORY_LIMIT:,} in memory, dropping the oldest)')
+    api_client.add_arguments(parser)
     args = parser.parse_args()
+    api_client.configure_from_args(args)
+    outbound_settings.update(
+        queue_max=args.queue_max,
+        high_watermark=args.queue_high_watermark,
+        low_watermark=args.queue_low_watermark,
+        slow_consumer_timeout=args.slow_consumer_timeout,
+        slow_consumer_policy=args.slow_consumer_policy,
+        spool_path=args.spool_path or None,
+    )
     
-    main(args.host, args.port, args.api_base)
+    if args.node_id:
+        if args.workers > 1:
+            parser.error('--workers and --node-id cannot be combined')
+        from .cluster import parse_address, parse_peer, run_node
+        try:
+            peers = [parse_peer(spec) for spec in args.peer]
+        except ValueError as e:
+            parser.error(str(e))
+        asyncio.run(run_node(args.node_id, parse_address(args.cluster_listen), peers,
+                             args.host, args.port, args.api_base, outbound_settings))
+    elif args.workers > 1:
+        from .workers import run_workers
+        run_workers(args.workers, args.host, args.port, args.api_base, outbound_settings)
+    else:
+        main(args.host, args.port, args.api_base)
 
 if __name__ == "__main__":
     main_entry()
\ No newline at end of file
@@ -0,0 +1,222 @@
+"""
+Write-behind queue for the chat server's Message API stores.
+
+``put`` never waits: messages are queued in memory and a background task
+sends them to ``POST /messages/batch`` in batches. While the API can't be
+reached (or the memory queue is full) messages are appended to a local spool
+file instead, one JSON document per line, and the task keeps retrying with
+backoff. Once the API answers again the spool is replayed in order and
+removed. A spool left behind by a crash is replayed on the next start.
+
+Delivery is at least once: how far the replay got is saved next to the spool
+after every batch, so a restart resends at most one batch. Without a spool
+file the memory queue still holds at most ``memory_limit`` messages; beyond
+that the oldest are dropped and counted.
+"""
+import asyncio
+import json
+import os
+from collections import deque
+
+import httpx
+
+from . import api_client
+
+DEFAULT_SPOOL_PATH = "message-spool.jsonl"
+DEFAULT_BATCH_SIZE = 256  # Messages per POST /messages/batch
+DEFAULT_MEMORY_LIMIT = 10000  # Queued messages kept in memory; beyond it they go to the spool, or the oldest are dropped
+DEFAULT_LINGER = 0.002  # Seconds the first queued message waits for others to share its request
+RETRY_DELAY = 1.0  # Wait after the first failed attempt; doubles up to MAX_BACKOFF
+MAX_BACKOFF = 30.0  # Longest wait between attempts while the API is down
+
+
+class StoreQueue:
+    """Batches message stores to one Message API, spooling to disk during outages."""
+
+    def __init__(self, api_base, path=DEFAULT_SPOOL_PATH, batch_size=DEFAULT_BATCH_SIZE,
+                 memory_limit=DEFAULT_MEMORY_LIMIT, linger=DEFAULT_LINGER):
+        self.api_base = api_base
+        self.path = path  # None keeps everything in memory
+        self.batch_size = batch_size
+        self.memory_limit = memory_limit
+        self.linger = linger
+        self.pending = deque()  # Documents waiting to be sent, oldest first
+        self.spool = None  # Open spool file while anything is spooled
+        self.ready = asyncio.Event()
+        self.task = None
+        self.stored = 0
+        self.dropped = 0  # Refused by the API
+        self.overflowed = 0  # Dropped from a full memory queue with no spool to go to
+        if path is not None and os.path.exists(path):
+            self.spool = open(path, "a", encoding="utf-8")
+            print(f"[SPOOL] Replaying messages left in {path}")
+
+    @property
+    def spooling(self):
+        return self.spool is not None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def put(self, documents):
+        """Queue documents for storage. Never blocks on the API or the disk."""
+        if self.spooling:
+            self._append(documents)  # Keep their order behind what is already spooled
+        elif self.path is not None and len(self.pending) + len(documents) > self.memory_limit:
+            self._spill()
+            self._append(documents)
+        else:
+            self.pending.extend(documents)
+            if self.path is None:
+                self._shed()
+        self.ready.set()
+
+    def _append(self, documents):
+        if self.spool is None:
+            self.spool = open(self.path, "a", encoding="utf-8")
+        self.spool.write("".join(json.dumps(doc, ensure_ascii=False) + "\n" for doc in documents))
+        self.spool.flush()  # Survives a crash of this process
+
+    def _spill(self):
+        """Move the memory queue to the spool, so later messages line up behind it."""
+        if self.path is None:
+            self._shed()
+            return
+        self._append(self.pending)
+        self.pending = deque()  # Only once they are safely in the spool
+        os.fsync(self.spool.fileno())
+
+    def _shed(self):
+        """Drop the oldest messages beyond ``memory_limit``, so an outage can't use up memory."""
+        excess = len(self.pending) - self.memory_limit
+        for _ in range(excess):
+            self.pending.popleft()
+        if excess > 0:
+            self.overflowed += excess
+
+    async def _send(self, documents):
+        """POST one batch. Returns False if the API is unreachable or failing."""
+        try:
+            await api_client.post(f"{self.api_base}/messages/batch", {"messages": documents}, check=True)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code >= 500:
+                print(f"[SPOOL] Message API error {e.response.status_code}; will retry")
+                return False
+            # The API rejected the batch itself; retrying would never succeed
+            self.dropped += len(documents)
+            print(f"[SPOOL] Message API refused {len(documents)} messages ({e.response.status_code}); dropped")
+            return True
+        except httpx.TransportError as e:
+            print(f"[SPOOL] Message API unreachable ({e!r}); will retry")
+            return False
+        except Exception as e:
+            # Anything else (a reply we can't decode, a bug) must not stop the writer
+            print(f"[SPOOL] Sending {len(documents)} messages failed ({e!r}); will retry")
+            return False
+        self.stored += len(documents)
+        return True
+
+    async def _run(self):
+        backoff = 0
+        while True:
+            try:
+                if await self._step():
+                    backoff = 0
+                    continue
+            except Exception as e:
+                # A spool the disk won't take or can't give back; keep the task alive and retry
+                print(f"[SPOOL] Store queue error ({e!r}); will retry")
+            if self.path is None:
+                print(f"[SPOOL] {len(self.pending)} messages are waiting in memory ({self.overflowed} dropped)")
+            backoff = min(backoff * 2 or RETRY_DELAY, MAX_BACKOFF)
+            await asyncio.sleep(backoff)
+
+    async def _step(self):
+        """Send one batch, or replay the spool. Returns False if the caller should back off."""
+        if not self.pending and not self.spooling:
+            await self.ready.wait()
+            self.ready.clear()
+            await asyncio.sleep(self.linger)
+        if self.pending:
+            batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+            sent = False
+            try:
+                sent = await self._send(batch)
+            finally:
+                if not sent:
+                    self.pending.extendleft(reversed(batch))  # Retried, or sent or spooled by close()
+            if sent:
+                return True
+            self._spill()
+        elif self.spooling:
+            return await self._replay()
+        return False
+
+    def _offset_path(self):
+        return self.path + ".offset"
+
+    async def _replay(self):
+        """Send the spool in order; returns False if the API failed part way."""
+        offset_path = self._offset_path()
+        offset = 0
+        if os.path.exists(offset_path):
+            with open(offset_path) as f:
+                offset = int(f.read() or 0)
+        with open(self.path, "rb") as spool:
+            spool.seek(offset)
+            while True:
+                lines = []
+                while len(lines) < self.batch_size:
+                    line = spool.readline()
+                    if not line.endswith(b"\n"):
+                        break  # End of the file, or a line still being written
+                    lines.append(line)
+                if not lines:
+                    break
+                documents = []
+                for line in lines:
+                    try:
+                        documents.append(json.loads(line))
+                    except ValueError:
+                        print("[SPOOL] Skipping a damaged spool line")
+                if documents and not await self._send(documents):
+                    return False
+                offset = spool.tell()
+                with open(offset_path, "w") as f:
+                    f.write(str(offset))
+
+        # Nothing awaited since the last read, so no message can have been appended unseen
+        self.spool.close()
+        self.spool = None
+        os.remove(self.path)
+        if os.path.exists(offset_path):
+            os.remove(offset_path)
+        print("[SPOOL] Spool replayed; the Message API is back")
+        return True
+
+    async def close(self, timeout=5.0):
+        """Send what is queued if the API answers within ``timeout``; spool the rest."""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        while self.pending and not self.spooling:
+            batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+            try:
+                sent = await asyncio.wait_for(self._send(batch), timeout)
+            except asyncio.TimeoutError:
+                sent = False
+            if not sent:
+                self.pending.extendleft(reversed(batch))
+                break
+        if self.pending:
+            if self.path is None:
+                print(f"[SPOOL] Losing {len(self.pending)} unsent messages")
+            else:
+                self._spill()
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
@@ -0,0 +1,128 @@
+"""
+In-memory static files for the web adapter.
+
+Every file under the static directory is read once at startup, hashed for an
+``ETag`` and kept alongside gzip and (when the ``brotli`` package is
+installed) brotli copies, so a page load is a dictionary lookup and a write:
+no disk access on the event loop and no compression per request. Clients
+that send back a matching ``If-None-Match`` get a bodiless 304.
+
+In dev mode each request checks the file's modification time and reloads
+it when it has changed, so edits show up without restarting the adapter.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from fastapi import Request, Response
+
+DEFAULT_CACHE_CONTROL = "no-cache"  # Browsers keep copies but revalidate them with the ETag
+MIN_COMPRESS_SIZE = 256  # Smaller files are sent as they are
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+class Asset:
+    """One file's bytes, its compressed variants and validators."""
+
+    __slots__ = ("path", "stamp", "media_type", "etag", "variants")
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = file_stamp(path)
+        data = path.read_bytes()
+        self.media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        self.etag = '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+        self.variants = {"identity": data}  # Content-Encoding -> body
+        if len(data) >= MIN_COMPRESS_SIZE and self.media_type.startswith(COMPRESSIBLE):
+            self.variants["gzip"] = gzip.compress(data, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants["br"] = brotli.compress(data, quality=11)
+
+    def stale(self):
+        try:
+            return file_stamp(self.path) != self.stamp
+        except FileNotFoundError:
+            return True
+
+    def pick(self, accept_encoding):
+        """The smallest variant the client accepts, as (encoding, body)."""
+        accepted = parse_accept_encoding(accept_encoding)
+        best = "identity"
+        for encoding, body in self.variants.items():
+            if encoding in accepted and len(body) < len(self.variants[best]):
+                best = encoding
+        return best, self.variants[best]
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def parse_accept_encoding(header):
+    """Encodings named in an Accept-Encoding header, leaving out any with q=0."""
+    accepted = set()
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        q = params.strip().replace(" ", "")
+        if name and q not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name)
+    return accepted
+
+
+def etag_matches(header, etag):
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+class StaticAssets:
+    """Serves the files of one directory from memory."""
+
+    def __init__(self, directory, dev=False, cache_control=DEFAULT_CACHE_CONTROL):
+        self.directory = Path(directory)
+        self.dev = dev
+        self.cache_control = cache_control
+        self.assets = {}  # Path relative to the directory -> Asset
+        self.load()
+
+    def load(self):
+        """(Re)read every file under the directory."""
+        assets = {}
+        if self.directory.is_dir():
+            for path in sorted(self.directory.rglob("*")):
+                if path.is_file():
+                    assets[path.relative_to(self.directory).as_posix()] = Asset(path)
+        self.assets = assets
+
+    def get(self, name):
+        asset = self.assets.get(name)
+        if self.dev:
+            if asset is not None and asset.stale():
+                asset = None
+                self.assets.pop(name, None)
+            if asset is None:
+                path = (self.directory / name).resolve()
+                if path.is_file() and path.is_relative_to(self.directory.resolve()):
+                    asset = self.assets[name] = Asset(path)
+        return asset
+
+    def response(self, request: Request, name):
+        asset = self.get(name)
+        if asset is None:
+            return Response(status_code=404)
+        headers = {"ETag": asset.etag, "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if etag_matches(request.headers.get("if-none-match", ""), asset.etag):
+            return Response(status_code=304, headers=headers)
+        encoding, body = asset.pick(request.headers.get("accept-encoding", ""))
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type=asset.media_type, headers=headers)
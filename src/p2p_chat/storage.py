@@ -0,0 +1,582 @@
+"""
+Storage engines for the Message API's offline mailboxes.
+
+Every engine offers the same coroutines:
+
+- ``insert_many(documents)`` stores messages (unordered) and returns their ids
+- ``take(destination, limit, after, now)`` returns and removes the oldest page
+- ``claim(destination, limit, lease, now)`` hides the oldest page under a lease
+- ``ack(destination, ids)`` deletes delivered messages
+- ``count(destination)`` counts what is waiting, claimed or not
+- ``summary(destination)`` gives unread counts by sender and type, from
+  counters the engine keeps as messages come and go (see ``summary.py``)
+- ``trim(destination, cap, kind=None)`` drops the oldest messages beyond
+  ``cap``, counting only messages of type ``kind`` when one is given
+- ``expire(now)`` drops messages whose ``expires_at`` has passed
+
+A document may carry ``expires_at`` (seconds since the epoch), which is never
+returned to readers. One whose ``metadata`` has a ``coalesce`` key replaces
+older unclaimed messages to the same destination from the same sender with
+the same key when it is inserted (see ``retention.py``).
+
+An engine may also offer ``watch(notify)``, which runs until cancelled and
+reports inserts made by other processes (the Mongo engine's change stream).
+
+Messages come back as plain dicts. ``_id`` is a string, except that the
+Mongo engine leaves ObjectIds for the response encoder to stringify. Pick one with
+``open_storage("mongo" | "sqlite" | "log" | "memory")``; the log engine
+lives in ``logstore.py``.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, UTC
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from .logstore import DEFAULT_LOG_DIR, LogStorage
+from .summary import Tally, empty_summary, fold_counts
+
+STORAGE_KINDS = ("mongo", "sqlite", "log", "memory")
+DEFAULT_SQLITE_PATH = "messages.db"
+
+class BatchInsertError(Exception):
+    """Some documents of an unordered insert failed.
+
+    ``failed`` maps a document's index to the reason; ``ids`` has the ids of
+    the whole batch, in order, for the ones that were stored.
+    """
+
+    def __init__(self, failed, ids):
+        super().__init__(f"{len(failed)} documents were not stored")
+        self.failed = failed
+        self.ids = ids
+
+def is_visible(doc, now):
+    """True unless the message is under an unexpired claim."""
+    claimed_until = doc.get("claimed_until")
+    return claimed_until is None or claimed_until <= now
+
+def coalesce_key(doc):
+    return (doc.get("metadata") or {}).get("coalesce")
+
+def public(doc):
+    """A copy without claim and expiry bookkeeping and with a serializable ``_id``."""
+    msg = {key: value for key, value in doc.items() if key not in ("claim", "claimed_until", "expires_at")}
+    msg["_id"] = str(msg["_id"])
+    return msg
+
+# ----------------------
+# MongoDB
+# ----------------------
+EXPIRY_BACKSTOP = 86400  # Seconds past expiry before MongoDB's TTL monitor removes a message the sweep missed
+DELETE_BATCH = 1000  # Messages loaded (for the counters) and deleted per round trip by sweeps and trims
+
+class MongoStorage:
+    """Mailboxes in a MongoDB collection through Motor.
+
+    Unread counts live in a second collection, one document per
+    (destination, sender, type), updated alongside every insert and delete.
+    """
+
+    def __init__(self, collection, summaries=None):
+        self.collection = collection
+        self.summaries = summaries if summaries is not None else collection.database[f"{collection.name}_summaries"]
+
+    @classmethod
+    def connect(cls, mongo_url=None):
+        mongo_url = mongo_url or os.getenv("MONGO_URL", "mongodb://localhost:27017")
+        client = AsyncIOMotorClient(mongo_url)
+        return cls(client["messaging_db"]["messages"], client["messaging_db"]["mailbox_summaries"])
+
+    async def setup(self):
+        """Indexes that keep mailbox reads proportional to the page size."""
+        await self.collection.create_index([("destination", 1), ("_id", 1)])
+        await self.collection.create_index([("destination", 1), ("claimed_until", 1)])
+        await self.collection.create_index("claim", sparse=True)
+        await self.summaries.create_index([("destination", 1), ("sender", 1), ("type", 1)], unique=True)
+        # Expired messages are swept by the API so the counters see them go; the TTL
+        # index only catches what no sweep got to
+        try:
+            await self.collection.create_index("expires_at", expireAfterSeconds=EXPIRY_BACKSTOP)
+        except OperationFailure:
+            await self.collection.database.command(
+                "collMod", self.collection.name,
+                index={"keyPattern": {"expires_at": 1}, "expireAfterSeconds": EXPIRY_BACKSTOP},
+            )
+
+    async def close(self):
+        pass
+
+    @staticmethod
+    def parse_id(value):
+        """Turn a string id back into the ``_id`` type the collection uses."""
+        return ObjectId(value) if ObjectId.is_valid(value) else value
+
+    # Claim bookkeeping stays in the database; ObjectIds are left for the encoder
+    PUBLIC = {"claim": 0, "claimed_until": 0, "expires_at": 0}
+    COUNTED = {"destination": 1, "sender": 1, "type": 1, "timestamp": 1}
+
+    @staticmethod
+    def visible(destination, now):
+        return {"destination": destination, "claimed_until": {"$not": {"$gt": now}}}
+
+    async def insert_many(self, documents):
+        for doc in documents:
+            if "expires_at" in doc:
+                # TTL indexes only act on dates
+                doc["expires_at"] = datetime.fromtimestamp(doc["expires_at"], UTC)
+        try:
+            # Unordered so one bad document doesn't stop the rest
+            await self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            failed = {err["index"]: err.get("errmsg", "insert failed") for err in e.details.get("writeErrors", [])}
+            await self._tally([doc for i, doc in enumerate(documents) if i not in failed], 1)
+            raise BatchInsertError(failed, [str(doc.get("_id")) for doc in documents]) from e
+        await self._tally(documents, 1)
+
+        newest = {}
+        for doc in documents:
+            if coalesce_key(doc) is not None:
+                newest[doc["destination"], doc["sender"], coalesce_key(doc)] = doc["_id"]
+        now = time.time()
+        for (destination, sender, key), newest_id in newest.items():
+            await self._delete_matching({
+                **self.visible(destination, now), "sender": sender, "metadata.coalesce": key, "_id": {"$lt": newest_id},
+            })
+        return [str(doc.get("_id")) for doc in documents]
+
+    async def take(self, destination, limit, after=None, now=None):
+        now = time.time() if now is None else now
+        query = self.visible(destination, now)
+        if after:
+            query["_id"] = {"$gt": self.parse_id(after)}
+        # One extra document tells us whether another page follows
+        docs = await self.collection.find(query, self.PUBLIC).sort("_id", 1).limit(limit + 1).to_list(length=limit + 1)
+        more = len(docs) > limit
+        docs = docs[:limit]
+        if docs:
+            await self._delete(docs)
+        return docs, more
+
+    async def claim(self, destination, limit, lease, now=None):
+        now = time.time() if now is None else now
+        candidates = await self.collection.find(self.visible(destination, now), {"_id": 1}) \
+            .sort("_id", 1).limit(limit).to_list(length=limit)
+        if not candidates:
+            return None, []
+
+        # The update re-checks visibility per document, so concurrent claimers never share one
+        claim = uuid.uuid4().hex
+        await self.collection.update_many(
+            {"_id": {"$in": [doc["_id"] for doc in candidates]}, **self.visible(destination, now)},
+            {"$set": {"claim": claim, "claimed_until": now + lease}},
+        )
+        docs = await self.collection.find({"claim": claim}, self.PUBLIC).sort("_id", 1).to_list(length=limit)
+        return claim, docs
+
+    async def ack(self, destination, ids):
+        return await self._delete_matching({"destination": destination, "_id": {"$in": [self.parse_id(i) for i in ids]}})
+
+    async def count(self, destination):
+        return await self.collection.count_documents({"destination": destination})
+
+    async def summary(self, destination):
+        rows = await self.summaries.find({"destination": destination}).to_list(length=None)
+        return fold_counts((row["sender"], row.get("type"), row["count"], row.get("newest")) for row in rows)
+
+    async def trim(self, destination, cap, kind=None):
+        query = {"destination": destination} if kind is None else {"destination": destination, "type": kind}
+        beyond = await self.collection.find(query, {"_id": 1}).sort("_id", -1).skip(cap).limit(1).to_list(length=1)
+        if not beyond:
+            return 0
+        return await self._delete_matching({**query, "_id": {"$lte": beyond[0]["_id"]}})
+
+    async def expire(self, now):
+        return await self._delete_matching({"expires_at": {"$lte": datetime.fromtimestamp(now, UTC)}})
+
+    # ----------------------
+    # Counters
+    # ----------------------
+    async def _delete_matching(self, query):
+        """Delete what matches ``query`` in batches, so a large backlog is never loaded at once."""
+        deleted = 0
+        while True:
+            docs = await self.collection.find(query, self.COUNTED).limit(DELETE_BATCH).to_list(length=DELETE_BATCH)
+            if docs:
+                deleted += await self._delete(docs)
+            if len(docs) < DELETE_BATCH:
+                return deleted
+
+    async def _delete(self, docs):
+        """Delete these messages and take them off the counters."""
+        result = await self.collection.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+        if result.deleted_count == len(docs):
+            await self._tally(docs, -1)
+        else:
+            # Someone else deleted some of them meanwhile; recount rather than guess which
+            for destination in {doc["destination"] for doc in docs}:
+                await self._recount(destination)
+        return result.deleted_count
+
+    async def _tally(self, docs, sign):
+        groups = defaultdict(lambda: [0, None])
+        for doc in docs:
+            group = groups[doc["destination"], doc["sender"], doc.get("type")]
+            group[0] += 1
+            if doc.get("timestamp") and (group[1] is None or doc["timestamp"] > group[1]):
+                group[1] = doc["timestamp"]
+        if not groups:
+            return
+        ops = []
+        for (destination, sender, kind), (count, newest) in groups.items():
+            update = {"$inc": {"count": sign * count}}
+            if sign > 0 and newest is not None:
+                update["$max"] = {"newest": newest}
+            ops.append(UpdateOne({"destination": destination, "sender": sender, "type": kind}, update, upsert=sign > 0))
+        await self.summaries.bulk_write(ops, ordered=False)
+        if sign < 0:
+            await self.summaries.delete_many({"destination": {"$in": list({key[0] for key in groups})}, "count": {"$lte": 0}})
+
+    async def _recount(self, destination):
+        rows = await self.collection.aggregate([
+            {"$match": {"destination": destination}},
+            {"$group": {"_id": {"sender": "$sender", "type": "$type"}, "count": {"$sum": 1}, "newest": {"$max": "$timestamp"}}},
+        ]).to_list(length=None)
+        await self.summaries.delete_many({"destination": destination})
+        if rows:
+            await self.summaries.insert_many([
+                {"destination": destination, "sender": row["_id"]["sender"], "type": row["_id"].get("type"),
+                 "count": row["count"], "newest": row["newest"]}
+                for row in rows
+            ])
+
+    async def watch(self, notify):
+        """Call ``notify([destination])`` for every message any API instance inserts.
+
+        Uses a change stream, so it needs a replica set; on a standalone
+        mongod it returns straight away and only local inserts wake readers.
+        """
+        pipeline = [{"$match": {"operationType": "insert"}}, {"$project": {"fullDocument.destination": 1}}]
+        try:
+            async with self.collection.watch(pipeline) as stream:
+                async for change in stream:
+                    notify([change["fullDocument"]["destination"]])
+        except OperationFailure as e:
+            print(f"MongoDB change streams unavailable ({e}); "
+                  "only this instance's inserts will wake mailbox readers")
+
+# ----------------------
+# In memory
+# ----------------------
+class MemoryStorage:
+    """Mailboxes in process memory, for tests and throwaway deployments."""
+
+    def __init__(self):
+        self.mailboxes = defaultdict(dict)  # destination -> {id: document}, oldest first
+        self.tallies = {}  # destination -> Tally
+        self.next_id = 1
+
+    async def setup(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def insert_many(self, documents):
+        ids = []
+        now = time.time()
+        for document in documents:
+            doc = dict(document, _id=self.next_id)
+            self.next_id += 1
+            mailbox = self.mailboxes[doc["destination"]]
+            key = coalesce_key(doc)
+            if key is not None:
+                for old in [old for old in mailbox.values()
+                            if coalesce_key(old) == key and old["sender"] == doc["sender"] and is_visible(old, now)]:
+                    self._remove(doc["destination"], old["_id"])
+                mailbox = self.mailboxes[doc["destination"]]
+            mailbox[doc["_id"]] = doc
+            if doc["destination"] not in self.tallies:
+                self.tallies[doc["destination"]] = Tally()
+            self.tallies[doc["destination"]].add_message(doc)
+            ids.append(str(doc["_id"]))
+        return ids
+
+    def _remove(self, destination, msg_id):
+        """Delete one message; returns whether it was there."""
+        mailbox = self.mailboxes.get(destination)
+        doc = mailbox.pop(msg_id, None) if mailbox else None
+        if doc is None:
+            return False
+        self.tallies[destination].remove_message(doc)
+        if not mailbox:
+            del self.mailboxes[destination]
+            del self.tallies[destination]
+        return True
+
+    def _visible(self, destination, now, after=0):
+        for msg_id, doc in self.mailboxes.get(destination, {}).items():
+            if msg_id > after and is_visible(doc, now):
+                yield doc
+
+    async def take(self, destination, limit, after=None, now=None):
+        now = time.time() if now is None else now
+        docs = []
+        for doc in self._visible(destination, now, int(after) if after else 0):
+            docs.append(doc)
+            if len(docs) > limit:
+                break
+        more = len(docs) > limit
+        docs = docs[:limit]
+        for doc in docs:
+            self._remove(destination, doc["_id"])
+        return [public(doc) for doc in docs], more
+
+    async def claim(self, destination, limit, lease, now=None):
+        now = time.time() if now is None else now
+        claim = uuid.uuid4().hex
+        docs = []
+        for doc in self._visible(destination, now):
+            doc.update(claim=claim, claimed_until=now + lease)
+            docs.append(public(doc))
+            if len(docs) == limit:
+                break
+        return (claim if docs else None), docs
+
+    async def ack(self, destination, ids):
+        return sum(self._remove(destination, int(i)) for i in ids if i.isdigit())
+
+    async def count(self, destination):
+        return len(self.mailboxes.get(destination, {}))
+
+    async def summary(self, destination):
+        tally = self.tallies.get(destination)
+        return tally.summary() if tally is not None else empty_summary()
+
+    async def trim(self, destination, cap, kind=None):
+        mailbox = self.mailboxes.get(destination, {})
+        ids = [i for i, doc in mailbox.items() if kind is None or doc.get("type", "chat") == kind]
+        excess = max(len(ids) - cap, 0)
+        for msg_id in ids[:excess]:
+            self._remove(destination, msg_id)
+        return excess
+
+    async def expire(self, now):
+        expired = 0
+        for destination, mailbox in list(self.mailboxes.items()):
+            for msg_id in [i for i, doc in mailbox.items() if doc.get("expires_at", now + 1) <= now]:
+                expired += self._remove(destination, msg_id)
+        return expired
+
+# ----------------------
+# SQLite
+# ----------------------
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    destination TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    message TEXT NOT NULL,
+    timestamp TEXT,
+    type TEXT,
+    metadata TEXT,
+    claim TEXT,
+    claimed_until REAL,
+    expires_at REAL,
+    coalesce TEXT
+);
+"""
+INDEXES = """
+CREATE INDEX IF NOT EXISTS messages_by_destination ON messages (destination, id);
+CREATE INDEX IF NOT EXISTS messages_by_claim ON messages (claim) WHERE claim IS NOT NULL;
+CREATE INDEX IF NOT EXISTS messages_by_expiry ON messages (expires_at) WHERE expires_at IS NOT NULL;
+"""
+# Unread counts per (destination, sender, type), kept by triggers on every insert and delete.
+# A missing type is counted as '': NULLs never conflict in a primary key, so each untyped
+# insert would otherwise add a row. Created (or rebuilt, for tables made by older versions
+# with a nullable type) in one transaction with the counts of what is already stored.
+SUMMARIES = """
+BEGIN;
+DROP TRIGGER IF EXISTS summaries_on_insert;
+DROP TRIGGER IF EXISTS summaries_on_delete;
+DROP TABLE IF EXISTS summaries;
+CREATE TABLE summaries (
+    destination TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    type TEXT NOT NULL DEFAULT '',
+    count INTEGER NOT NULL,
+    newest TEXT,
+    PRIMARY KEY (destination, sender, type)
+);
+INSERT INTO summaries SELECT destination, sender, COALESCE(type, ''), COUNT(*), MAX(timestamp)
+    FROM messages GROUP BY destination, sender, COALESCE(type, '');
+CREATE TRIGGER summaries_on_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO summaries (destination, sender, type, count, newest)
+    VALUES (NEW.destination, NEW.sender, COALESCE(NEW.type, ''), 1, NEW.timestamp)
+    ON CONFLICT (destination, sender, type) DO UPDATE SET
+        count = count + 1, newest = max(coalesce(newest, ''), coalesce(excluded.newest, ''));
+END;
+CREATE TRIGGER summaries_on_delete AFTER DELETE ON messages BEGIN
+    UPDATE summaries SET count = count - 1
+    WHERE destination = OLD.destination AND sender = OLD.sender AND type = COALESCE(OLD.type, '');
+    DELETE FROM summaries
+    WHERE destination = OLD.destination AND sender = OLD.sender AND type = COALESCE(OLD.type, '') AND count <= 0;
+END;
+COMMIT;
+"""
+ADDED_COLUMNS = {"expires_at": "REAL", "coalesce": "TEXT"}  # Missing from databases made by older versions
+
+# Fixed statement texts, so sqlite3's statement cache prepares each one only once
+INSERT = ("INSERT INTO messages (destination, sender, message, timestamp, type, metadata, expires_at, coalesce) "
+          "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+COLUMNS = "id, destination, sender, message, timestamp, type, metadata"
+VISIBLE = "destination = ? AND (claimed_until IS NULL OR claimed_until <= ?)"
+SELECT_PAGE = f"SELECT {COLUMNS} FROM messages WHERE {VISIBLE} AND id > ? ORDER BY id LIMIT ?"
+CLAIM = (f"UPDATE messages SET claim = ?, claimed_until = ? "
+         f"WHERE id IN (SELECT id FROM messages WHERE {VISIBLE} ORDER BY id LIMIT ?)")
+SELECT_CLAIMED = f"SELECT {COLUMNS} FROM messages WHERE claim = ? ORDER BY id"
+DELETE = "DELETE FROM messages WHERE id = ? AND destination = ?"
+COUNT = "SELECT COUNT(*) FROM messages WHERE destination = ?"
+SUPERSEDE = f"DELETE FROM messages WHERE {VISIBLE} AND sender = ? AND coalesce = ? AND id < ?"
+TRIM = ("DELETE FROM messages WHERE destination = ? AND id <= "
+        "(SELECT id FROM messages WHERE destination = ? ORDER BY id DESC LIMIT 1 OFFSET ?)")
+TRIM_TYPE = ("DELETE FROM messages WHERE destination = ? AND type = ? AND id <= "
+             "(SELECT id FROM messages WHERE destination = ? AND type = ? ORDER BY id DESC LIMIT 1 OFFSET ?)")
+EXPIRE = "DELETE FROM messages WHERE expires_at <= ?"
+SUMMARY = "SELECT sender, NULLIF(type, ''), count, newest FROM summaries WHERE destination = ?"
+
+class SQLiteStorage:
+    """Mailboxes in a SQLite database in WAL mode.
+
+    One connection is driven by a single worker thread, so queries never block
+    the event loop and never need a lock.
+    """
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.db = sqlite3.connect(path, check_same_thread=False, cached_statements=64)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")  # Durable across app crashes; WAL syncs at checkpoints
+        self.db.executescript(SCHEMA)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(messages)")}
+        for column, kind in ADDED_COLUMNS.items():
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE messages ADD COLUMN {column} {kind}")
+        self.db.executescript(INDEXES)
+        summary_columns = {row[1]: row[3] for row in self.db.execute("PRAGMA table_info(summaries)")}
+        if not summary_columns.get("type"):  # Missing, or nullable from an older version
+            self.db.executescript(SUMMARIES)
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def setup(self):
+        pass
+
+    async def close(self):
+        await self._run(self.db.close)
+        self.executor.shutdown()
+
+    @staticmethod
+    def _message(row):
+        msg_id, destination, sender, message, timestamp, kind, metadata = row
+        return {
+            "_id": str(msg_id), "sender": sender, "destination": destination, "message": message,
+            "timestamp": timestamp, "type": kind, "metadata": json.loads(metadata) if metadata else {},
+        }
+
+    def _insert_many(self, documents):
+        now = time.time()
+        ids = []
+        with self.db:
+            for doc in documents:
+                key = coalesce_key(doc)
+                msg_id = self.db.execute(INSERT, (
+                    doc["destination"], doc["sender"], doc["message"], doc.get("timestamp"),
+                    doc.get("type", "chat"), json.dumps(doc.get("metadata") or {}), doc.get("expires_at"),
+                    None if key is None else str(key),
+                )).lastrowid
+                if key is not None:
+                    self.db.execute(SUPERSEDE, (doc["destination"], now, doc["sender"], str(key), msg_id))
+                ids.append(str(msg_id))
+        return ids
+
+    def _take(self, destination, limit, after, now):
+        with self.db:
+            rows = self.db.execute(SELECT_PAGE, (destination, now, int(after) if after else 0, limit + 1)).fetchall()
+            more = len(rows) > limit
+            rows = rows[:limit]
+            self.db.executemany(DELETE, [(row[0], destination) for row in rows])
+        return [self._message(row) for row in rows], more
+
+    def _claim(self, destination, limit, lease, now):
+        claim = uuid.uuid4().hex
+        with self.db:
+            self.db.execute(CLAIM, (claim, now + lease, destination, now, limit))
+            rows = self.db.execute(SELECT_CLAIMED, (claim,)).fetchall()
+        return (claim if rows else None), [self._message(row) for row in rows]
+
+    def _ack(self, destination, ids):
+        with self.db:
+            return self.db.executemany(DELETE, [(int(i), destination) for i in ids if i.isdigit()]).rowcount
+
+    def _count(self, destination):
+        return self.db.execute(COUNT, (destination,)).fetchone()[0]
+
+    def _summary(self, destination):
+        return fold_counts(self.db.execute(SUMMARY, (destination,)))
+
+    def _trim(self, destination, cap, kind):
+        with self.db:
+            if kind is None:
+                return self.db.execute(TRIM, (destination, destination, cap)).rowcount
+            return self.db.execute(TRIM_TYPE, (destination, kind, destination, kind, cap)).rowcount
+
+    def _expire(self, now):
+        with self.db:
+            return self.db.execute(EXPIRE, (now,)).rowcount
+
+    async def insert_many(self, documents):
+        return await self._run(self._insert_many, documents)
+
+    async def take(self, destination, limit, after=None, now=None):
+        return await self._run(self._take, destination, limit, after, time.time() if now is None else now)
+
+    async def claim(self, destination, limit, lease, now=None):
+        return await self._run(self._claim, destination, limit, lease, time.time() if now is None else now)
+
+    async def ack(self, destination, ids):
+        return await self._run(self._ack, destination, ids)
+
+    async def count(self, destination):
+        return await self._run(self._count, destination)
+
+    async def summary(self, destination):
+        return await self._run(self._summary, destination)
+
+    async def trim(self, destination, cap, kind=None):
+        return await self._run(self._trim, destination, cap, kind)
+
+    async def expire(self, now):
+        return await self._run(self._expire, now)
+
+def open_storage(kind="mongo", mongo_url=None, sqlite_path=None, log_dir=None):
+    """Build the storage engine named by ``--storage``."""
+    if kind == "memory":
+        return MemoryStorage()
+    if kind == "sqlite":
+        return SQLiteStorage(sqlite_path or os.getenv("SQLITE_PATH", DEFAULT_SQLITE_PATH))
+    if kind == "log":
+        return LogStorage(log_dir or os.getenv("LOG_DIR", DEFAULT_LOG_DIR))
+    if kind == "mongo":
+        return MongoStorage.connect(mongo_url)
+    raise ValueError(f"unknown storage {kind!r}; expected one of {', '.join(STORAGE_KINDS)}")
@@ -0,0 +1,63 @@
+"""
+Unread mail counters for ``GET /messages/{username}/summary``.
+
+Engines keep a ``Tally`` per mailbox up to date as messages are stored and
+removed, so a summary is a dictionary lookup rather than a scan. ``newest``
+is the latest timestamp stored since the mailbox was last empty; messages
+are removed oldest first, so it is almost always the newest one still there.
+"""
+from collections import Counter
+
+
+def empty_summary():
+    return {"total": 0, "by_sender": {}, "by_type": {}, "newest": None}
+
+
+def fold_counts(rows):
+    """A summary from (sender, type, count, newest) rows, as kept by the database engines."""
+    summary = empty_summary()
+    for sender, kind, count, newest in rows:
+        summary["total"] += count
+        summary["by_sender"][sender] = summary["by_sender"].get(sender, 0) + count
+        summary["by_type"][kind] = summary["by_type"].get(kind, 0) + count
+        if newest and (summary["newest"] is None or newest > summary["newest"]):
+            summary["newest"] = newest
+    return summary
+
+
+class Tally:
+    """Counts of one mailbox by sender and by type, plus the newest timestamp."""
+
+    __slots__ = ("total", "senders", "types", "newest")
+
+    def __init__(self):
+        self.total = 0
+        self.senders = Counter()
+        self.types = Counter()
+        self.newest = None
+
+    def add(self, sender, kind, timestamp):
+        self.total += 1
+        self.senders[sender] += 1
+        self.types[kind] += 1
+        if timestamp is not None and (self.newest is None or timestamp > self.newest):
+            self.newest = timestamp
+
+    def remove(self, sender, kind):
+        self.total -= 1
+        for counter, key in ((self.senders, sender), (self.types, kind)):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+        if self.total <= 0:
+            self.newest = None
+
+    def add_message(self, doc):
+        self.add(doc.get("sender"), doc.get("type", "chat"), doc.get("timestamp"))
+
+    def remove_message(self, doc):
+        self.remove(doc.get("sender"), doc.get("type", "chat"))
+
+    def summary(self):
+        return {"total": self.total, "by_sender": dict(self.senders), "by_type": dict(self.types),
+                "newest": self.newest}
@@ -1,218 +1,305 @@
 import asyncio
-import json
-import re
 import argparse
-from datetime import datetime, UTC
+import itertools
+import json
+import os
+import time
+from collections import deque
 import httpx
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from pathlib import Path
 
+from . import codec
+from .protocol import CONTROL, FrameDecoder, ProtocolError, encode_tagged, iter_frames, open_gateway, parse_v1_request
+from .static_assets import StaticAssets
+
+DEFAULT_UPSTREAM_CONNECTIONS = 4  # Connections to the chat server shared by all web users
+DEFAULT_SEND_QUEUE_MAX = 1000  # Messages queued for one browser before it is dropped as too slow
+DEFAULT_SEND_TIMEOUT = 10.0  # Seconds a single WebSocket send may take before the browser is dropped
+
+# WebSocket subprotocols a browser can offer; one that offers none gets JSON text frames
+SUBPROTOCOL_MSGPACK = "p2p.msgpack"  # Events as MessagePack binary frames
+SUBPROTOCOL_JSON = "p2p.json"
+
 app = FastAPI()
 
-# Track active connections
-active_connections = {}  # username -> WebSocket
-connected_to_server = {}  # username -> (reader, writer)
+# Track active sessions
+sessions = {}  # session id -> WebSession
+pools = {}  # (host, port) -> UpstreamPool
+session_ids = itertools.count(1)
 server_host = "localhost"
 server_port = 5000
 api_base = "http://localhost:8000"
+upstream_connections = DEFAULT_UPSTREAM_CONNECTIONS
+send_settings = {
+    "queue_max": DEFAULT_SEND_QUEUE_MAX,
+    "send_timeout": DEFAULT_SEND_TIMEOUT,
+}
 
-# Serve static files (assuming frontend is in a 'static' directory)
-static_path = Path("static")
-if static_path.exists():
-    app.mount("/static", StaticFiles(directory="static"), name="static")
+background_tasks = set()
 
-# Serve the main HTML file
-@app.get("/")
-async def get_html():
-    with open(static_path / "index.html", "r") as f:
-        return HTMLResponse(content=f.read())
-
-# Pattern to extract sender and message from server messages
-MSG_PATTERN = re.compile(r'\[([^\]]+)\](?:\[([^\]]+)\])?\s+(.*)')
-STORED_MSG_PATTERN = re.compile(r'\[Stored\]\s+\[([^]]+)\](?:\[([^]]+)\])?\s+(.*)')
-
-# Parse server messages
-def parse_server_message(message):
-    # Check if this is a connection message with users list
-    if message.startswith("Connected! Users online:"):
-        try:
-            # Extract just the usernames at the end, ignoring any HTTP headers
-            user_section = message.split("Users online:")[-1].strip()
-            # Find the last comma in the HTTP headers section if present
-            if "Sec-WebSocket-Extensions:" in user_section:
-                user_section = user_section.split("permessage-deflate; client_max_window_bits")[-1].strip()
-                if user_section.startswith(","):
-                    user_section = user_section[1:].strip()
-            
-            # Clean up any other HTTP header remnants
-            clean_users = []
-            for user in user_section.split(", "):
-                # Skip HTTP headers
-                if ":" in user or user.startswith("HTTP") or len(user) > 30:
-                    continue
-                # Only keep valid usernames (alphanumeric and a few special chars)
-                if user and all(c.isalnum() or c in "_-." for c in user):
-                    clean_users.append(user)
-            
-            return {
-                "type": "login_success",
-                "online_users": clean_users
-            }
-        except Exception as e:
-            print(f"Error parsing user list: {e}")
-    
-    # Other message parsing continues as before
-    if message.startswith("[Stored]"):
-        match = STORED_MSG_PATTERN.match(message)
-        if match:
-            msg_type, timestamp, content = match.groups()
-            return {
-                "type": "stored",
-                "sender": msg_type,
-                "timestamp": timestamp,
-                "message": content
-            }
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def choose_subprotocol(offered):
+    """The first of the subprotocols a browser offered (most preferred first) that we speak."""
+    for subprotocol in offered:
+        if subprotocol == SUBPROTOCOL_JSON or (subprotocol == SUBPROTOCOL_MSGPACK and codec.msgpack_available()):
+            return subprotocol
+    return None
+
+async def receive_event(websocket, binary):
+    if binary:
+        return codec.unpack(await websocket.receive_bytes())
+    return await websocket.receive_json()
+
+async def send_event(websocket, binary, event):
+    """Send straight to a browser that has no session (and so no send queue)."""
+    if binary:
+        await websocket.send_bytes(codec.pack(event))
     else:
-        match = MSG_PATTERN.match(message)
-        if match:
-            sender, timestamp, content = match.groups()
-            return {
-                "type": "chat",
-                "sender": sender,
-                "timestamp": timestamp or datetime.now(UTC).isoformat(),
-                "message": content
-            }
-    
-    # Default system message
-    return {
-        "type": "system",
-        "message": message
-    }
-
-# Connect to chat server
-async def connect_to_server(username, websocket, host=server_host, port=server_port):
-    try:
-        print(f"Attempting to connect to server at {host}:{port}")
-        reader, writer = await asyncio.open_connection(host, port)
-        
-        # Read username prompt
-        username_prompt = await reader.read(1024)
-        
-        # Send username
-        writer.write(username.encode() + b'\n')
-        await writer.drain()
-        
-        # Store connection
-        connected_to_server[username] = (reader, writer)
-        
-        # Send success to client
-        online_users = list(connected_to_server.keys())
-        await websocket.send_json({
-            "type": "login_success",
-            "online_users": online_users
-        })
-        
-        # Notify other users
-        for user, conn in active_connections.items():
-            if user != username:
-                await conn.send_json({
-                    "type": "user_joined",
-                    "username": username,
-                    "online_users": online_users
-                })
-        
-        # Start listening for server messages
-        asyncio.create_task(listen_server_messages(username, reader, websocket))
-        
+        await websocket.send_json(event)
+
+class WebSession:
+    """One browser, carried as a session over a pooled upstream connection.
+
+    Everything sent to the browser goes through a bounded queue drained by
+    the session's own writer task, so a slow browser only ever stalls itself.
+    One that lets ``queue_max`` messages pile up, or is still stuck in a send
+    after ``send_timeout`` when the next message arrives, is disconnected.
+    A ``binary`` session gets its events as MessagePack instead of JSON text.
+    """
+
+    def __init__(self, username, websocket, upstream, binary=False):
+        self.session_id = next(session_ids)
+        self.username = username
+        self.websocket = websocket
+        self.upstream = upstream
+        self.binary = binary
+        self.queue = deque()  # Text (or MessagePack bytes) for the browser
+        self.logged_in = False
+        self.closed = False  # Takes no more messages; the writer stops once the queue is empty
+        self.hang_up = False  # Close the WebSocket when the writer stops
+        self.sending_since = None  # When the send in progress started
+        self._ready = asyncio.Event()
+        self._writer_task = None
+
+    def start(self):
+        self._writer_task = spawn(self._write_loop())
+
+    def request(self, request):
+        """Send a request for this user to the chat server."""
+        if not self.closed:
+            self.upstream.send(self.session_id, request)
+
+    def opened(self):
+        """The chat server accepted the login; its welcome (the first roster page) follows."""
+        self.logged_in = True
+
+    def send_text(self, text, packed=None):
+        """Queue a JSON event for the browser, re-encoded (or ``packed`` already) for
+        a binary session. Returns False if it can't take it."""
+        if self.closed:
+            return False
+        if self.binary:
+            self.queue.append(packed if packed is not None else codec.pack(codec.loads_json(text)))
+        else:
+            self.queue.append(text)
+        self._ready.set()
+        if len(self.queue) >= send_settings["queue_max"]:
+            self.drop(f"{len(self.queue)} messages queued")
+            return False
+        # Checked here rather than with a timer per send, which would cost more than the send
+        if self.sending_since is not None and time.monotonic() - self.sending_since > send_settings["send_timeout"]:
+            self.drop(f"a send took over {send_settings['send_timeout']}s")
+            return False
         return True
-    except Exception as e:
-        print(f"Error connecting to server: {e}")
-        return False
 
-# Listen for messages from the chat server
-async def listen_server_messages(username, reader, websocket):
-    try:
-        while True:
-            data = await reader.read(1024)
-            if not data:
-                break
-                
-            message = data.decode().strip()
-            print(f"Raw server message: {message}")
-            
-            # Handle connection message with user list specially
-            if "Connected! Users online:" in message:
-                # Parse out clean user list
-                msg_data = parse_server_message(message)
-                await websocket.send_json(msg_data)
-            # Handle special messages like stored messages or notifications
-            elif message.startswith("[Stored]"):
-                msg_data = parse_server_message(message)
-                await websocket.send_json(msg_data)
-            elif "[NOTIFICATION]" in message or "notification" in message.lower():
-                # Try to extract JSON metadata if present
-                try:
-                    metadata_start = message.find('{')
-                    metadata_end = message.rfind('}')
-                    if metadata_start > 0 and metadata_end > metadata_start:
-                        metadata_str = message[metadata_start:metadata_end+1]
-                        metadata = json.loads(metadata_str)
-                        clean_message = message[:metadata_start].strip()
-                        
-                        # Extract sender from notification format
-                        sender = "System"
-                        if "[" in clean_message and "]" in clean_message:
-                            sender = clean_message[clean_message.find("[")+1:clean_message.find("]")]
-                            clean_message = clean_message[clean_message.find("]")+1:].strip()
-                        
-                        await websocket.send_json({
-                            "type": "notification",
-                            "sender": sender,
-                            "message": clean_message,
-                            "metadata": metadata,
-                            "timestamp": datetime.now(UTC).isoformat()
-                        })
+    async def _write_loop(self):
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                while self.queue:
+                    self.sending_since = time.monotonic()
+                    if self.binary:
+                        await self.websocket.send_bytes(self.queue.popleft())
                     else:
-                        # Regular message format
-                        msg_data = parse_server_message(message)
-                        await websocket.send_json(msg_data)
-                except:
-                    # Fall back to regular message parsing
-                    msg_data = parse_server_message(message)
-                    await websocket.send_json(msg_data)
-            else:
-                # Regular chat message
-                msg_data = parse_server_message(message)
-                await websocket.send_json(msg_data)
-    except Exception as e:
-        print(f"Error in server listener for {username}: {e}")
-    finally:
-        # Clean up connection
-        if username in connected_to_server:
-            _, writer = connected_to_server[username]
+                        await self.websocket.send_text(self.queue.popleft())
+                    self.sending_since = None
+                if self.closed:
+                    break
+            if self.hang_up:
+                await self.websocket.close()
+        except Exception as e:
+            print(f"Error sending to {self.username}'s browser: {e}")
+            self.queue.clear()
+            self.end()
+
+    def drop(self, reason):
+        """Slow-browser policy: disconnect it, whatever is still queued."""
+        print(f"{self.username}'s browser is too slow ({reason}); disconnecting.")
+        self.queue.clear()
+        self.end()
+        if self._writer_task is not None and self._writer_task is not asyncio.current_task():
+            self._writer_task.cancel()  # It may be stuck in a send
+        spawn(self._close_websocket())
+
+    async def _close_websocket(self):
+        try:
+            await asyncio.wait_for(self.websocket.close(), send_settings["send_timeout"])
+        except Exception:
+            pass
+
+    def end(self, message=None, notify=True):
+        """Leave the chat; ``message`` is shown to the browser before it is disconnected.
+        ``notify`` tells the chat server, unless it ended the session itself."""
+        if self.closed:
+            return
+        if notify:
+            self.request({"type": "exit"})
+        if message is not None:
+            self.send_text(json.dumps({"type": "system", "message": message}))
+            self.hang_up = True
+        self.closed = True
+        self._ready.set()
+        sessions.pop(self.session_id, None)
+        self.upstream.sessions.pop(self.session_id, None)
+        self.logged_in = False
+
+class Upstream:
+    """A pooled connection to the chat server, multiplexing many sessions."""
+
+    def __init__(self, host, port, name):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.sessions = {}  # session id -> WebSession
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        async with self.lock:
+            if self.writer is None:
+                reader, self.writer = await open_gateway(self.host, self.port, self.name)
+                print(f"Upstream {self.name} connected to {self.host}:{self.port}")
+                spawn(self._listen(reader, self.writer))
+
+    def send(self, session_id, request):
+        if self.writer is not None:
+            self.writer.write(encode_tagged(session_id, request))
+
+    async def drain(self):
+        if self.writer is not None:
+            await self.writer.drain()
+
+    def relay(self, text, event):
+        """Pass an event for everyone (a batch of roster changes) to every logged-in
+        browser on this connection, serialized once per encoding."""
+        packed = None
+        for session in list(self.sessions.values()):
+            if session.logged_in:
+                if session.binary and packed is None:
+                    packed = codec.pack(event)
+                session.send_text(text, packed)
+
+    def control(self, event):
+        session = self.sessions.get(event.get("session"))
+        if session is None:
+            return
+        if event.get("type") == "opened":
+            session.opened()
+        elif event.get("type") == "closed":
+            session.end(event.get("message", "Disconnected by the chat server."), notify=False)
+
+    async def _listen(self, reader, writer):
+        try:
+            # Session frames are typed events already serialized for the browser: pass them through as they are
+            async for session_id, body in iter_frames(reader, FrameDecoder(tagged=True, raw=True)):
+                if session_id == CONTROL:
+                    event = json.loads(body)
+                    if event.get("type") == "presence":
+                        self.relay(body.decode(), event)
+                    else:
+                        self.control(event)
+                    continue
+                session = self.sessions.get(session_id)
+                if session is not None:
+                    session.send_text(body.decode())
+        except (ConnectionError, ProtocolError) as e:
+            print(f"Error in upstream {self.name}: {e}")
+        finally:
+            if self.writer is writer:
+                self.writer = None
             writer.close()
-            try:
-                await writer.wait_closed()
-            except:
-                pass
-            del connected_to_server[username]
+            for session in list(self.sessions.values()):
+                session.end("Lost connection to the chat server.", notify=False)
+
+class UpstreamPool:
+    """A fixed number of upstream connections to one chat server."""
+
+    def __init__(self, host, port, size=DEFAULT_UPSTREAM_CONNECTIONS):
+        self.upstreams = [Upstream(host, port, f"web-{os.getpid()}.{i}") for i in range(size)]
+
+    def least_loaded(self):
+        return min(self.upstreams, key=lambda u: len(u.sessions))
+
+def upstream_pool(host, port):
+    pool = pools.get((host, port))
+    if pool is None:
+        pool = pools[(host, port)] = UpstreamPool(host, port, upstream_connections)
+    return pool
+
+# Static files (the frontend is in a 'static' directory), loaded and compressed once at startup
+static_path = Path("static")
+assets = StaticAssets(static_path)
+
+@app.get("/static/{name:path}")
+async def get_static(name: str, request: Request):
+    return assets.response(request, name)
+
+# Serve the main HTML file
+@app.get("/")
+async def get_html(request: Request):
+    return assets.response(request, "index.html")
+
+# Log in to the chat server over a pooled upstream connection
+async def connect_to_server(username, websocket, host=server_host, port=server_port, binary=False):
+    upstream = upstream_pool(host, port).least_loaded()
+    session = WebSession(username, websocket, upstream, binary)
+    upstream.sessions[session.session_id] = session  # Counted before connecting, so a login storm spreads out
+    try:
+        await upstream.connect()
+    except OSError as e:
+        print(f"Error connecting to server: {e}")
+        upstream.sessions.pop(session.session_id, None)
+        return None
+    sessions[session.session_id] = session
+    session.start()
+    session.request({"type": "open", "username": username})
+    await upstream.drain()
+    return session
 
 # WebSocket endpoint
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    username = None
+    subprotocol = choose_subprotocol(websocket.scope.get("subprotocols", []))
+    binary = subprotocol == SUBPROTOCOL_MSGPACK
+    await websocket.accept(subprotocol=subprotocol)
+    session = None
     
     try:
         while True:
-            data = await websocket.receive_json()
+            data = await receive_event(websocket, binary)
             
             # Handle login
             if data["type"] == "login":
+                if session is not None:
+                    continue
                 username = data["username"]
-                active_connections[username] = websocket
                 
                 # Get server host and port from client if provided
                 host = data.get("server_host", server_host)
@@ -220,10 +307,10 @@ async def websocket_endpoint(websocket: WebSocket):
                 
                 print(f"Connecting user {username} to chat server at {host}:{port}")
                 
-                # Connect to chat server
-                success = await connect_to_server(username, websocket, host, port)
-                if not success:
-                    await websocket.send_json({
+                # Log in through the shared upstream connections
+                session = await connect_to_server(username, websocket, host, port, binary)
+                if session is None:
+                    await send_event(websocket, binary, {
                         "type": "system",
                         "message": f"Failed to connect to chat server at {host}:{port}"
                     })
@@ -231,78 +318,46 @@ async def websocket_endpoint(websocket: WebSocket):
             
             # Handle chat message
             elif data["type"] == "chat":
-                if username and username in connected_to_server:
-                    _, writer = connected_to_server[username]
-                    
+                if session is not None:
                     # Format message as expected by the server
                     if "recipient" in data:
-                        server_msg = f"{data['recipient']}: {data['message']}"
+                        request = {"type": "chat", "destination": data["recipient"], "message": data["message"]}
                     else:
-                        server_msg = data["message"]
+                        request = parse_v1_request(data["message"])
                     
-                    writer.write(server_msg.encode())
-                    await writer.drain()
+                    session.request(request)
+                    await session.upstream.drain()
+            
+            # Roster pages after the first one, or changes since a version, from the chat server
+            elif data["type"] == "presence":
+                if session is not None:
+                    session.request({"type": "presence", **{k: data[k] for k in ("after", "since") if data.get(k) is not None}})
+                    await session.upstream.drain()
             
             # Handle commands
             elif data["type"] == "command":
-                if username and username in connected_to_server:
-                    _, writer = connected_to_server[username]
-                    writer.write(data["command"].encode())
-                    await writer.drain()
+                if session is not None:
+                    session.request(parse_v1_request(data["command"]))
+                    await session.upstream.drain()
     
     except WebSocketDisconnect:
-        if username:
-            # Remove from active connections
-            if username in active_connections:
-                del active_connections[username]
-            
-            # Disconnect from server
-            if username in connected_to_server:
-                _, writer = connected_to_server[username]
-                try:
-                    # Try to send exit command
-                    writer.write("exit".encode())
-                    await writer.drain()
-                except:
-                    pass
-                writer.close()
-                try:
-                    await writer.wait_closed()
-                except:
-                    pass
-                del connected_to_server[username]
-            
-            # Notify other users
-            online_users = list(connected_to_server.keys())
-            for user, conn in active_connections.items():
-                await conn.send_json({
-                    "type": "user_left",
-                    "username": username,
-                    "online_users": online_users
-                })
-    
+        pass
     except Exception as e:
         print(f"WebSocket error: {e}")
-        if username:
-            if username in active_connections:
-                del active_connections[username]
-            if username in connected_to_server:
-                _, writer = connected_to_server[username]
-                writer.close()
-                try:
-                    await writer.wait_closed()
-                except:
-                    pass
-                del connected_to_server[username]
-
-def main(server_addr="localhost", server_p=5000, api_url="http://localhost:8000", host="0.0.0.0", port=8080):
-    global server_host, server_port, api_base
+    finally:
+        if session is not None:
+            session.end()
+
+def main(server_addr="localhost", server_p=5000, api_url="http://localhost:8000", host="0.0.0.0", port=8080,
+         upstreams=DEFAULT_UPSTREAM_CONNECTIONS, deflate=True):
+    global server_host, server_port, api_base, upstream_connections
     server_host = server_addr
     server_port = server_p
     api_base = api_url
+    upstream_connections = upstreams
     
     import uvicorn
-    uvicorn.run(app, host=host, port=port)
+    uvicorn.run(app, host=host, port=port, ws_per_message_deflate=deflate)
 
 def main_entry():
     """Entry point for console script."""
@@ -312,9 +367,22 @@ def main_entry():
     parser.add_argument('--server-host', default="localhost", help='Chat server host')
     parser.add_argument('--server-port', type=int, default=5000, help='Chat server port')
     parser.add_argument('--api-base', default="http://localhost:8000", help='API base URL')
+    parser.add_argument('--upstream-connections', type=int, default=DEFAULT_UPSTREAM_CONNECTIONS,
+                        help='Connections to the chat server that all web users share')
+    parser.add_argument('--send-queue-max', type=int, default=DEFAULT_SEND_QUEUE_MAX,
+                        help='Messages queued for one browser before it is disconnected as too slow')
+    parser.add_argument('--send-timeout', type=float, default=DEFAULT_SEND_TIMEOUT,
+                        help='Seconds one WebSocket send may take before the browser is disconnected')
+    parser.add_argument('--no-ws-deflate', action='store_true',
+                        help='Turn off permessage-deflate compression of WebSocket frames')
+    parser.add_argument('--dev', action='store_true',
+                        help='Reload static files when they change on disk')
     args = parser.parse_args()
+    assets.dev = args.dev
+    send_settings.update(queue_max=args.send_queue_max, send_timeout=args.send_timeout)
     
-    main(args.server_host, args.server_port, args.api_base, args.host, args.port)
+    main(args.server_host, args.server_port, args.api_base, args.host, args.port, args.upstream_connections,
+         not args.no_ws_deflate)
 
 if __name__ == "__main__":
     main_entry()
\ No newline at end of file
@@ -0,0 +1,411 @@
+"""
+Multi-process mode for the chat server (``p2p-chat-server --workers N``).
+
+N worker processes each run the normal asyncio server on the same port with
+SO_REUSEPORT, so the kernel spreads incoming connections across them. The
+parent process runs a small presence hub on a Unix socket:
+
+- the hub is the single authority for who is logged in where, so duplicate
+  usernames are rejected across workers, and it replicates presence and room
+  membership to every worker;
+- workers keep that replica locally and forward messages for users on other
+  workers directly to the owning worker over its own Unix socket, batching
+  whatever piles up into one write.
+"""
+import asyncio
+import itertools
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+
+from . import api_client
+from . import server as chat_server
+from .protocol import encode_frame, iter_frames
+
+HUB_SOCKET = "hub.sock"
+HUB_CONNECT_ATTEMPTS = 50  # Workers retry while the parent is still starting the hub
+
+
+class PeerLink:
+    """Outbound connection to another server process.
+
+    ``send`` never blocks: frames are queued and the link's task writes
+    everything queued since the last flush in one go. ``connect`` is a
+    coroutine function returning ``(reader, writer)``. With ``retry`` set the
+    link reconnects after that many seconds and sends ``greeting()`` frames
+    first on every connect; otherwise it connects once, on first use, and
+    frames it couldn't write (no connection, or it broke mid-stream) are
+    handed to ``undelivered``.
+    """
+
+    def __init__(self, name, connect, greeting=None, retry=None, undelivered=None):
+        self.name = name
+        self.connect = connect
+        self.greeting = greeting
+        self.retry = retry
+        self.undelivered = undelivered
+        self.pending = []  # Frames not yet written
+        self.connected = False
+        self._ready = asyncio.Event()
+        self._task = None
+        self.writer = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = chat_server.spawn(self._run())
+
+    def send(self, frame):
+        self.pending.append(frame)
+        self._ready.set()
+        self.start()
+
+    async def _run(self):
+        while True:
+            try:
+                reader, self.writer = await self.connect()
+            except OSError as e:
+                if self.retry is None:
+                    print(f"[LINK] Can't reach {self.name}: {e}")
+                    self._give_up(self.pending)
+                    return
+                await asyncio.sleep(self.retry)
+                continue
+
+            self.connected = True
+            if self.greeting is not None:
+                # The greeting carries current state, so anything queued while down is stale
+                self.pending = list(self.greeting())
+                self._ready.set()
+            batch = []
+            try:
+                while True:
+                    await self._ready.wait()
+                    self._ready.clear()
+                    batch, self.pending = self.pending, []
+                    if batch:
+                        if self.writer.is_closing() or reader.at_eof():  # Peers never write back, so EOF means gone
+                            raise ConnectionResetError("closed by the other end")
+                        self.writer.write(b"".join(map(encode_frame, batch)))
+                        await self.writer.drain()
+                    batch = []
+            except (OSError, ConnectionError) as e:
+                print(f"[LINK] Lost link to {self.name}: {e}")
+                if self.retry is None:
+                    self._give_up(batch + self.pending)
+            finally:
+                self.connected = False
+                self.writer = None
+            if self.retry is None:
+                return
+            await asyncio.sleep(self.retry)
+
+    def _give_up(self, frames):
+        self.pending = []
+        if self.undelivered is not None and frames:
+            self.undelivered(frames)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def store_for(usernames, event, api_base=chat_server.DEFAULT_API_BASE):
+    chat_server.spawn(chat_server.store_messages(
+        event["sender"], usernames, event["message"], api_base,
+        event.get("message_type", "chat"), event.get("metadata")))
+
+
+def store_undelivered(frames, api_base=chat_server.DEFAULT_API_BASE):
+    """Store the messages of ``deliver`` frames that never reached their worker.
+
+    The sender was told they were delivered, so they are kept like messages
+    for offline users. Broadcasts are never stored.
+    """
+    for frame in frames:
+        if frame["type"] == "deliver":
+            store_for(frame["usernames"], frame["event"], api_base)
+
+
+def deliver_forwarded(frame, api_base=chat_server.DEFAULT_API_BASE):
+    """Hand a ``deliver`` or ``broadcast`` frame from another process to local users."""
+    event = frame["event"]
+    if frame["type"] == "broadcast":
+        chat_server.fan_out(event["sender"], list(chat_server.clients), event)
+        return
+    encoded = {}
+    missed = [
+        username for username in frame["usernames"]
+        if username not in chat_server.clients
+        or not chat_server.clients[username].send_encoded(event, encoded)
+    ]
+    if missed:
+        # They left between the sender's lookup and delivery; keep the message
+        store_for(missed, event, api_base)
+
+
+class WorkerRouter:
+    """Routes messages to users held by other worker processes."""
+
+    def __init__(self, worker_id, socket_dir, api_base=chat_server.DEFAULT_API_BASE):
+        self.worker_id = worker_id
+        self.api_base = api_base
+        self.hub_path = os.path.join(socket_dir, HUB_SOCKET)
+        self.bus_path = os.path.join(socket_dir, f"worker-{worker_id}.sock")
+        self.owners = {}  # username -> worker id, replicated from the hub
+        self.peers = {}  # worker id -> bus socket path
+        self.links = {}  # worker id -> PeerLink
+        self.claims = {}  # request id -> future
+        self.claim_ids = itertools.count()
+        self.hub_writer = None
+        self._synced = None
+
+    async def start(self):
+        self._synced = asyncio.get_running_loop().create_future()
+        self.bus = await asyncio.start_unix_server(self._handle_peer, self.bus_path)
+        for _ in range(HUB_CONNECT_ATTEMPTS):
+            try:
+                reader, self.hub_writer = await asyncio.open_unix_connection(self.hub_path)
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        else:
+            raise RuntimeError(f"Worker {self.worker_id} could not reach the presence hub")
+        self.hub_task = chat_server.spawn(self._read_hub(reader))
+        self._to_hub({"type": "hello", "worker": self.worker_id, "path": self.bus_path})
+        await self._synced
+
+    def _to_hub(self, frame):
+        self.hub_writer.write(encode_frame(frame))
+
+    async def _read_hub(self, reader):
+        async for frame in iter_frames(reader):
+            kind = frame["type"]
+            if kind == "snapshot":
+                self.owners = frame["owners"]
+                for username in self.owners:
+                    chat_server.roster.join(username)
+                self.peers = {int(w): path for w, path in frame["workers"].items()}
+                chat_server.rooms.clear()
+                for room, members in frame["rooms"].items():
+                    chat_server.rooms[room] = set(members)
+                self._synced.set_result(True)
+            elif kind == "claimed":
+                future = self.claims.pop(frame["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(frame["ok"])
+            elif kind == "presence":
+                if frame["worker"] is None:
+                    self.owners.pop(frame["username"], None)
+                    chat_server.roster.leave(frame["username"])
+                else:
+                    self.owners[frame["username"]] = frame["worker"]
+                    chat_server.roster.join(frame["username"])
+            elif kind == "worker":
+                self.peers[frame["worker"]] = frame["path"]
+            elif kind == "join":
+                chat_server.join_room(frame["username"], frame["room"], propagate=False)
+            elif kind == "leave":
+                chat_server.leave_room(frame["username"], frame["room"], propagate=False)
+        print(f"[WORKER {self.worker_id}] Presence hub went away")
+
+    async def claim(self, username):
+        """Ask the hub for exclusive use of ``username``."""
+        request_id = next(self.claim_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.claims[request_id] = future
+        self._to_hub({"type": "claim", "id": request_id, "username": username})
+        await self.hub_writer.drain()
+        ok = await future
+        if ok:
+            self.owners[username] = self.worker_id
+        return ok
+
+    def release(self, username):
+        if self.owners.get(username) == self.worker_id:
+            del self.owners[username]
+        self._to_hub({"type": "release", "username": username})
+
+    def room_changed(self, op, username, room):
+        self._to_hub({"type": op, "username": username, "room": room})
+
+    def _link(self, worker):
+        link = self.links.get(worker)
+        if link is None:
+            path = self.peers[worker]
+            link = self.links[worker] = PeerLink(
+                f"worker {worker}",
+                lambda: asyncio.open_unix_connection(path),
+                undelivered=lambda frames: store_undelivered(frames, self.api_base),
+            )
+        return link
+
+    def forward(self, username, event):
+        """Send an event to a user on another worker. False if they're not online there."""
+        return not self.forward_many([username], event)
+
+    def forward_many(self, usernames, event):
+        """Forward one event to many users, one frame per owning worker.
+
+        Returns the users that aren't online on any other worker.
+        """
+        by_worker = {}
+        offline = []
+        for username in usernames:
+            worker = self.owners.get(username)
+            if worker is None or worker == self.worker_id or worker not in self.peers:
+                offline.append(username)
+            else:
+                by_worker.setdefault(worker, []).append(username)
+        for worker, targets in by_worker.items():
+            self._link(worker).send({"type": "deliver", "usernames": targets, "event": event})
+        return offline
+
+    def broadcast(self, event):
+        for worker in self.peers:
+            if worker != self.worker_id:
+                self._link(worker).send({"type": "broadcast", "event": event})
+
+    async def _handle_peer(self, reader, writer):
+        try:
+            async for frame in iter_frames(reader):
+                deliver_forwarded(frame, self.api_base)
+        except Exception as e:
+            print(f"[WORKER {self.worker_id}] Peer link error: {e}")
+        finally:
+            writer.close()
+
+    async def close(self):
+        for link in self.links.values():
+            await link.close()
+        self.bus.close()
+        if self.hub_writer is not None:
+            self.hub_writer.close()
+
+
+class PresenceHub:
+    """Authoritative username -> worker map, run by the parent process."""
+
+    def __init__(self, socket_dir):
+        self.path = os.path.join(socket_dir, HUB_SOCKET)
+        self.owners = {}  # username -> worker id
+        self.rooms = {}  # room -> set of usernames
+        self.workers = {}  # worker id -> (writer, bus path)
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self._handle_worker, self.path)
+
+    def _broadcast(self, frame, exclude=None):
+        data = encode_frame(frame)
+        for worker, (writer, _) in self.workers.items():
+            if worker != exclude:
+                writer.write(data)
+
+    async def _handle_worker(self, reader, writer):
+        worker = None
+        try:
+            async for frame in iter_frames(reader):
+                kind = frame["type"]
+                if kind == "hello":
+                    worker = frame["worker"]
+                    self.workers[worker] = (writer, frame["path"])
+                    self._broadcast({"type": "worker", "worker": worker, "path": frame["path"]}, exclude=worker)
+                    writer.write(encode_frame({
+                        "type": "snapshot",
+                        "owners": self.owners,
+                        "rooms": {room: sorted(members) for room, members in self.rooms.items()},
+                        "workers": {w: path for w, (_, path) in self.workers.items()},
+                    }))
+                elif kind == "claim":
+                    ok = frame["username"] not in self.owners
+                    if ok:
+                        self.owners[frame["username"]] = worker
+                        self._broadcast({"type": "presence", "username": frame["username"], "worker": worker}, exclude=worker)
+                    writer.write(encode_frame({"type": "claimed", "id": frame["id"], "ok": ok}))
+                elif kind == "release":
+                    if self.owners.get(frame["username"]) == worker:
+                        del self.owners[frame["username"]]
+                        self._broadcast({"type": "presence", "username": frame["username"], "worker": None}, exclude=worker)
+                elif kind in ("join", "leave"):
+                    members = self.rooms.setdefault(frame["room"], set())
+                    if kind == "join":
+                        members.add(frame["username"])
+                    else:
+                        members.discard(frame["username"])
+                        if not members:
+                            del self.rooms[frame["room"]]
+                    self._broadcast(frame, exclude=worker)
+        finally:
+            # A worker that dies takes its users with it
+            if worker is not None:
+                self.workers.pop(worker, None)
+                for username in [u for u, w in self.owners.items() if w == worker]:
+                    del self.owners[username]
+                    self._broadcast({"type": "presence", "username": username, "worker": None})
+            writer.close()
+
+
+def run_worker(worker_id, socket_dir, host, port, api_base, outbound_settings, api_settings):
+    """Entry point of one worker process."""
+    chat_server.outbound_settings.update(outbound_settings)
+    if chat_server.outbound_settings.get("spool_path"):
+        # Workers spool separately; each replays only its own file
+        chat_server.outbound_settings["spool_path"] += f".{worker_id}"
+    api_client.configure(**api_settings)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent handles Ctrl+C
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    async def serve():
+        router = chat_server.router = WorkerRouter(worker_id, socket_dir, api_base)
+        await router.start()
+        print(f"[WORKER {worker_id}] Ready (pid {os.getpid()})")
+        server_task = asyncio.create_task(chat_server.run_server(host, port, api_base, reuse_port=True))
+        # Without the hub usernames can't be checked, so stop with the parent
+        await asyncio.wait([server_task, router.hub_task], return_when=asyncio.FIRST_COMPLETED)
+        server_task.cancel()
+        await router.close()
+
+    asyncio.run(serve())
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run_workers(workers, host, port, api_base, outbound_settings=None):
+    """Start the presence hub and ``workers`` server processes sharing ``port``."""
+    outbound_settings = dict(outbound_settings or chat_server.outbound_settings)
+    socket_dir = tempfile.mkdtemp(prefix="p2p-chat-")
+    hub = PresenceHub(socket_dir)
+    processes = []
+    signal.signal(signal.SIGTERM, _interrupt)
+
+    async def supervise():
+        await hub.start()
+        for worker_id in range(workers):
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(worker_id, socket_dir, host, port, api_base,
+                      outbound_settings, dict(api_client.settings)),
+                daemon=True,
+            )
+            process.start()
+            processes.append(process)
+        print(f"Started {workers} workers on {host}:{port}")
+        while all(p.is_alive() for p in processes):
+            await asyncio.sleep(1)
+        print("A worker exited; shutting down")
+
+    try:
+        asyncio.run(supervise())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout=5)
+        shutil.rmtree(socket_dir, ignore_errors=True)
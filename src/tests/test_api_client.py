@@ -0,0 +1,104 @@
+# test_api_client.py
+import httpx
+import pytest
+
+import src.p2p_chat.api_client as api_client
+import src.p2p_chat.server as server
+from src.p2p_chat import codec
+
+needs_msgpack = pytest.mark.skipif(not codec.msgpack_available(), reason="msgpack is not installed")
+
+
+@pytest.mark.asyncio
+async def test_client_is_shared_until_closed():
+    first = api_client.get_client()
+    assert api_client.get_client() is first
+    await api_client.close_client()
+    assert first.is_closed
+    second = api_client.get_client()
+    assert second is not first
+    await api_client.close_client()
+
+
+@pytest.mark.asyncio
+async def test_server_stores_reuse_one_client(monkeypatch):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if request.url.path.endswith("/claim"):
+            return httpx.Response(200, json={"messages": [{"sender": "alice", "message": "hi"}]})
+        return httpx.Response(200, json={"status": "stored"})
+
+    pooled = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    created = []
+    monkeypatch.setattr(api_client, "build_client", lambda **kw: created.append(1) or pooled)
+
+    for i in range(5):
+        await server.store_message("alice", "bob", f"message {i}", "http://api")
+    await server.close_store_queues()  # Stores are sent in the background
+    messages = await server.get_stored_messages("bob", "http://api")
+
+    assert len(created) == 1
+    assert [r.url.path for r in requests] == ["/messages/batch", "/messages/bob/claim"]
+    assert messages[0]["message"] == "hi"
+    await api_client.close_client()
+    assert pooled.is_closed
+
+
+@needs_msgpack
+@pytest.mark.asyncio
+async def test_msgpack_is_negotiated(monkeypatch):
+    seen = []
+
+    def handler(request):
+        seen.append(request.headers["content-type"])
+        payload = codec.decode(request.content, request.headers["content-type"])
+        reply = {"status": "stored", "echo": payload["message"]}
+        if codec.MSGPACK in request.headers["accept"]:
+            return httpx.Response(200, content=codec.pack(reply), headers={"content-type": codec.MSGPACK})
+        return httpx.Response(200, json=reply)
+
+    pooled = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(api_client, "build_client", lambda **kw: pooled)
+    monkeypatch.setattr(api_client, "_msgpack_apis", set())
+
+    first = await api_client.post("http://api/messages/", {"message": "one"})
+    second = await api_client.post("http://api/messages/", {"message": "two"})
+
+    # JSON until the API has shown it speaks MessagePack
+    assert seen == [codec.JSON, codec.MSGPACK]
+    assert (first["echo"], second["echo"]) == ("one", "two")
+    await api_client.close_client()
+
+
+class MailboxUser:
+    username = "bob"
+    closed = False
+    delivering = False
+    mail_waiting = False
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, event):
+        self.sent.append(event)
+
+
+@pytest.mark.asyncio
+async def test_mailbox_errors_are_not_empty_mailboxes(monkeypatch):
+    def handler(request):
+        return httpx.Response(503, json={"detail": "storage unavailable"})
+
+    pooled = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(api_client, "build_client", lambda **kw: pooled)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        await server.get_stored_messages("bob", "http://api")
+    with pytest.raises(httpx.HTTPStatusError):
+        await server.ack_stored_messages("bob", ["1"], "http://api")
+
+    conn = MailboxUser()
+    await server.check_mailbox(conn, "http://api")
+    assert [event["message"] for event in conn.sent] == ["Your mailbox is unavailable right now; try again later."]
+    await api_client.close_client()
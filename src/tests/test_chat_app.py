@@ -1,6 +1,7 @@
 # test_chat_app.py
 import asyncio
 import pytest
+import pytest_asyncio
 from datetime import datetime, timezone
 from httpx import AsyncClient, ASGITransport
 
@@ -18,51 +19,25 @@ def event_loop():
 # Fake Database for message_api
 # ----------------------
 import src.p2p_chat.message_api as message_api
+from src.p2p_chat.storage import BatchInsertError, MemoryStorage
+from src.p2p_chat import codec
 
-class FakeCollection:
-    def __init__(self):
-        self.data = []
-
-    async def insert_one(self, document):
-        self.data.append(document)
-        class FakeInsertOneResult:
-            inserted_id = "fake_id"
-        return FakeInsertOneResult()
-
-    def find(self, query):
-        dest = query.get("destination")
-        return FakeCursor([doc for doc in self.data if doc.get("destination") == dest])
-
-    async def delete_many(self, query):
-        if query:
-            dest = query.get("destination")
-            if dest is None:
-                self.data = []
-            else:
-                self.data = [doc for doc in self.data if doc.get("destination") != dest]
-        else:
-            self.data = []
-        return None
-
-class FakeCursor:
-    def __init__(self, docs):
-        self.docs = docs
-
-    async def to_list(self, length=None):
-        return self.docs
-
-@pytest.fixture(autouse=True)
-async def fake_db(monkeypatch):
-    fake_collection = FakeCollection()
-    monkeypatch.setattr(message_api, "collection", fake_collection)
-    yield fake_collection
+needs_msgpack = pytest.mark.skipif(not codec.msgpack_available(), reason="msgpack is not installed")
+
+@pytest.fixture
+def storage():
+    yield MemoryStorage()
+
+@pytest.fixture
+def api_app(storage):
+    return message_api.create_app(storage=storage)
 
 
 # ----------------------
 # FastAPI Endpoint Tests
 # ----------------------
 @pytest.mark.asyncio
-async def test_store_message():
+async def test_store_message(api_app):
     test_message = {
         "sender": "alice",
         "destination": "bob",
@@ -71,14 +46,50 @@ async def test_store_message():
         "type": "chat",
         "metadata": {}
     }
-    transport = ASGITransport(app=message_api.app)
+    transport = ASGITransport(app=api_app)
     async with AsyncClient(transport=transport, base_url="http://test") as client:
         response = await client.post("/messages/", json=test_message)
         assert response.status_code == 200
         assert response.json() == {"status": "stored"}
 
 @pytest.mark.asyncio
-async def test_get_messages():
+async def test_single_posts_are_group_committed(storage):
+    calls = []
+    insert_many = storage.insert_many
+
+    async def counting_insert_many(documents):
+        calls.append(len(documents))
+        return await insert_many(documents)
+
+    storage.insert_many = counting_insert_many
+    app = message_api.create_app(storage=storage, group_size=4, group_delay=0.01)
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        responses = await asyncio.gather(*(
+            client.post("/messages/", json={"sender": "thermometer", "destination": f"user{i}", "message": "20°C"})
+            for i in range(10)
+        ))
+
+    assert all(r.json() == {"status": "stored"} for r in responses)
+    assert sorted(storage.mailboxes) == sorted(f"user{i}" for i in range(10))
+    assert calls == [4, 4, 2]  # Two full groups, then the timer
+
+@pytest.mark.asyncio
+async def test_group_commit_reports_each_callers_result():
+    class RejectingStorage:
+        async def insert_many(self, documents):
+            raise BatchInsertError({1: "duplicate key"}, ["a", "b", "c"])
+
+    group = message_api.GroupCommit(RejectingStorage(), max_size=3, delay=1)
+    results = await asyncio.gather(
+        *(group.insert({"message": i}) for i in range(3)), return_exceptions=True
+    )
+
+    assert results[0] == "a" and results[2] == "c"
+    assert isinstance(results[1], RuntimeError) and "duplicate key" in str(results[1])
+
+@pytest.mark.asyncio
+async def test_get_messages(api_app):
     test_message = {
         "sender": "alice",
         "destination": "bob",
@@ -87,7 +98,7 @@ async def test_get_messages():
         "type": "chat",
         "metadata": {}
     }
-    transport = ASGITransport(app=message_api.app)
+    transport = ASGITransport(app=api_app)
     async with AsyncClient(transport=transport, base_url="http://test") as client:
         post_resp = await client.post("/messages/", json=test_message)
         assert post_resp.status_code == 200
@@ -107,30 +118,152 @@ async def test_get_messages():
         assert data2["messages"] == []
 
 
+@pytest.mark.asyncio
+async def test_get_messages_pages(api_app, storage):
+    transport = ASGITransport(app=api_app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        await client.post("/messages/batch", json={"messages": [
+            {"sender": "thermometer", "destination": "bob", "message": f"reading {i}"} for i in range(7)
+        ]})
+        await client.post("/messages/", json={"sender": "alice", "destination": "carol", "message": "hi"})
+
+        pages, after = [], None
+        while True:
+            params = {"limit": 3, **({"after": after} if after else {})}
+            data = (await client.get("/messages/bob", params=params)).json()
+            pages.append([msg["message"] for msg in data["messages"]])
+            after = data["next"]
+            if after is None:
+                break
+
+    assert pages == [[f"reading {i}" for i in range(j, min(j + 3, 7))] for j in (0, 3, 6)]
+    # Each page is removed as it is returned; other mailboxes are untouched
+    assert (await storage.count("bob"), await storage.count("carol")) == (0, 1)
+
+
+@pytest.mark.asyncio
+async def test_claim_and_ack_messages(api_app, storage):
+    transport = ASGITransport(app=api_app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        await client.post("/messages/batch", json={"messages": [
+            {"sender": "thermometer", "destination": "bob", "message": f"reading {i}"} for i in range(5)
+        ]})
+
+        first = (await client.post("/messages/bob/claim", params={"limit": 3})).json()
+        assert [msg["message"] for msg in first["messages"]] == ["reading 0", "reading 1", "reading 2"]
+        assert "claim" not in first["messages"][0]
+
+        # Claimed messages are hidden from the next claim until the lease runs out
+        second = (await client.post("/messages/bob/claim", params={"limit": 3})).json()
+        assert [msg["message"] for msg in second["messages"]] == ["reading 3", "reading 4"]
+        assert (await client.post("/messages/bob/claim")).json() == {"claim": None, "messages": []}
+
+        ack = await client.post("/messages/bob/ack", json={"ids": [msg["_id"] for msg in first["messages"]]})
+        assert ack.json() == {"status": "acked", "count": 3}
+        assert (await client.get("/messages/bob/count")).json() == {"username": "bob", "count": 2}
+
+        # The unacked claim expires and its messages are offered again
+        for doc in storage.mailboxes["bob"].values():
+            doc["claimed_until"] = 0
+        again = (await client.post("/messages/bob/claim")).json()
+        assert [msg["message"] for msg in again["messages"]] == ["reading 3", "reading 4"]
+
+
+@pytest.mark.asyncio
+async def test_mailbox_summary(api_app):
+    transport = ASGITransport(app=api_app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        await client.post("/messages/batch", json={"messages": [
+            {"sender": "thermometer", "destination": "bob", "message": "21°C", "type": "notification", "timestamp": "t1"},
+            {"sender": "alice", "destination": "bob", "message": "hi", "timestamp": "t2"},
+        ]})
+        summary = (await client.get("/messages/bob/summary")).json()
+        assert summary == {"username": "bob", "total": 2, "by_sender": {"thermometer": 1, "alice": 1},
+                           "by_type": {"notification": 1, "chat": 1}, "newest": "t2"}
+        assert (await client.get("/messages/bob/count")).json()["count"] == 2  # Nothing was fetched
+
+
+@pytest.mark.asyncio
+async def test_claim_waits_for_mail(api_app):
+    transport = ASGITransport(app=api_app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        empty = await client.post("/messages/bob/claim", params={"wait": 0.05})
+        assert empty.json() == {"claim": None, "messages": []}
+
+        waiting = asyncio.create_task(client.post("/messages/bob/claim", params={"wait": 5}))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        await client.post("/messages/", json={"sender": "thermometer", "destination": "bob", "message": "21°C"})
+        claimed = (await asyncio.wait_for(waiting, 1)).json()
+        assert [msg["message"] for msg in claimed["messages"]] == ["21°C"]
+
+
+@needs_msgpack
+@pytest.mark.asyncio
+async def test_msgpack_bodies_and_replies(api_app):
+    transport = ASGITransport(app=api_app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        packed = {"Content-Type": codec.MSGPACK, "Accept": codec.MSGPACK}
+        response = await client.post("/messages/batch", headers=packed, content=codec.pack({"messages": [
+            {"sender": "thermometer", "destination": "bob", "message": "21°C", "metadata": {"reading": 21}}
+        ]}))
+        assert response.headers["content-type"] == codec.MSGPACK
+        assert codec.unpack(response.content) == {"status": "stored", "count": 1}
+
+        response = await client.get("/messages/bob", headers={"Accept": codec.MSGPACK})
+        messages = codec.unpack(response.content)["messages"]
+        assert [(msg["message"], msg["metadata"]) for msg in messages] == [("21°C", {"reading": 21})]
+
+        # Bodies are still validated, whatever the format
+        bad = await client.post("/messages/", headers=packed, content=codec.pack({"sender": "alice"}))
+        assert bad.status_code == 422
+        bad = await client.post("/messages/", content=b'{"sender": "alice"}')
+        assert bad.status_code == 422
+        assert bad.headers["content-type"] == "application/json"
+
+
+@pytest.mark.asyncio
+async def test_store_message_batch(api_app):
+    batch = {"messages": [
+        {"sender": "alice", "destination": user, "message": "Hello room!", "type": "chat", "metadata": {"room": "general"}}
+        for user in ("bob", "carol", "dave")
+    ]}
+    transport = ASGITransport(app=api_app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post("/messages/batch", json=batch)
+        assert response.json() == {"status": "stored", "count": 3}
+
+        data = (await client.get("/messages/carol")).json()
+        assert [msg["message"] for msg in data["messages"]] == ["Hello room!"]
+        assert data["messages"][0]["metadata"] == {"room": "general"}
+
+
 # ----------------------
 # Async Server Tests
 # ----------------------
 import src.p2p_chat.server as server
+from src.p2p_chat.presence import Roster
 
 # Fixture to reset global state.
 @pytest.fixture
-def reset_server_state():
+def reset_server_state(monkeypatch):
+    monkeypatch.setattr(server, "roster", Roster())
     server.clients.clear()
     yield
     server.clients.clear()
 
 
 # Updated run_server fixture that yields a tuple (server, server_task).
-@pytest.fixture
+@pytest_asyncio.fixture
 async def run_server():
-    server = await asyncio.start_server(
-        server.handle_client, server.HOST, server.PORT
+    chat_server = await asyncio.start_server(
+        server.handle_client, "127.0.0.1", 0
     )
-    server_task = asyncio.create_task(server.serve_forever())
-    yield (server, server_task)
+    server_task = asyncio.create_task(chat_server.serve_forever())
+    yield (chat_server, server_task)
     # Teardown: close the server and cancel the serve_forever task.
-    server.close()
-    await server.wait_closed()
+    chat_server.close()
+    await chat_server.wait_closed()
     server_task.cancel()
     try:
         await server_task
@@ -143,13 +276,16 @@ async def run_server():
 def fake_storage(monkeypatch):
     storage = {}
 
-    async def fake_store_message(sender, destination, message):
+    async def fake_store_message(sender, destination, message, *args, **kwargs):
         storage.setdefault(destination, []).append(message)
 
-    async def fake_get_stored_messages(username):
+    async def fake_get_stored_messages(username, *args, **kwargs):
         msgs = storage.get(username, [])
         storage[username] = []
-        return [f"[CHAT][dummy-timestamp][{username}] {msg}" for msg in msgs]
+        return [
+            {"type": "chat", "timestamp": "dummy-timestamp", "sender": username, "message": msg}
+            for msg in msgs
+        ]
 
     monkeypatch.setattr(server, "store_message", fake_store_message)
     monkeypatch.setattr(server, "get_stored_messages", fake_get_stored_messages)
@@ -159,10 +295,11 @@ def fake_storage(monkeypatch):
 @pytest.mark.asyncio
 async def test_chat_server_offline_message(run_server, fake_storage, reset_server_state):
     # Get the (server, task) tuple directly from the fixture.
-    server, _ = run_server
+    chat_server, _ = run_server
+    host, port = chat_server.sockets[0].getsockname()[:2]
 
     # --- Client 1 (Alice) connects and sends a message to offline Bob ---
-    reader1, writer1 = await asyncio.open_connection(server.HOST, server.PORT)
+    reader1, writer1 = await asyncio.open_connection(host, port)
     data = await reader1.read(1024)
     assert "Enter your username:" in data.decode()
 
@@ -185,21 +322,24 @@ async def test_chat_server_offline_message(run_server, fake_storage, reset_serve
     await writer1.wait_closed()
 
     # --- Client 2 (Bob) connects and checks for stored messages ---
-    reader2, writer2 = await asyncio.open_connection(server.HOST, server.PORT)
+    reader2, writer2 = await asyncio.open_connection(host, port)
     data = await reader2.read(1024)
     assert "Enter your username:" in data.decode()
 
     writer2.write(b"bob\n")
     await writer2.drain()
+    # Stored messages are delivered straight after the welcome line.
+    await asyncio.sleep(0.1)
     data = await reader2.read(1024)
-    assert "Connected! Users online:" in data.decode()
+    decoded = data.decode()
+    assert "Connected! Users online:" in decoded
+    assert "Hello Bob!" in decoded
 
+    # The mailbox was drained on login, so !check has nothing left to fetch.
     writer2.write(b"!check\n")
     await writer2.drain()
     await asyncio.sleep(0.1)
-    data = await reader2.read(1024)
-    decoded = data.decode()
-    assert "Hello Bob!" in decoded
+    assert fake_storage["bob"] == []
 
     writer2.write(b"exit")
     await writer2.drain()
@@ -209,20 +349,21 @@ async def test_chat_server_offline_message(run_server, fake_storage, reset_serve
 
 @pytest.mark.asyncio
 async def test_chat_server_online_message(run_server, monkeypatch, reset_server_state):
-    async def dummy_store_message(sender, destination, message):
+    async def dummy_store_message(sender, destination, message, *args, **kwargs):
         pass
 
-    async def dummy_get_stored_messages(username):
+    async def dummy_get_stored_messages(username, *args, **kwargs):
         return []
 
     monkeypatch.setattr(server, "store_message", dummy_store_message)
     monkeypatch.setattr(server, "get_stored_messages", dummy_get_stored_messages)
 
     # Get the (server, task) tuple directly from the fixture.
-    server, _ = run_server
+    chat_server, _ = run_server
+    host, port = chat_server.sockets[0].getsockname()[:2]
 
     # --- Client 1 (Alice) connects ---
-    reader1, writer1 = await asyncio.open_connection(server.HOST, server.PORT)
+    reader1, writer1 = await asyncio.open_connection(host, port)
     data = await reader1.read(1024)
     assert "Enter your username:" in data.decode()
     writer1.write(b"alice\n")
@@ -231,7 +372,7 @@ async def test_chat_server_online_message(run_server, monkeypatch, reset_server_
     assert "Connected! Users online:" in data.decode()
 
     # --- Client 2 (Bob) connects ---
-    reader2, writer2 = await asyncio.open_connection(server.HOST, server.PORT)
+    reader2, writer2 = await asyncio.open_connection(host, port)
     data = await reader2.read(1024)
     assert "Enter your username:" in data.decode()
     writer2.write(b"bob\n")
@@ -0,0 +1,167 @@
+# test_cluster.py
+import asyncio
+import socket
+import sys
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+import uvicorn
+
+import src.p2p_chat.message_api as message_api
+import src.p2p_chat.server as server
+from src.p2p_chat.presence import Roster
+from src.p2p_chat.storage import MemoryStorage
+from src.p2p_chat.cluster import ClusterRouter, parse_peer
+from src.p2p_chat.protocol import encode_frame, iter_frames, open_connection
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_line(process, text):
+    while True:
+        line = await asyncio.wait_for(process.stdout.readline(), 10)
+        assert line, f"node exited before printing {text!r}"
+        if text in line.decode():
+            return
+
+
+@pytest_asyncio.fixture
+async def message_store():
+    storage = MemoryStorage()
+    port = free_port()
+    api = uvicorn.Server(uvicorn.Config(message_api.create_app(storage=storage),
+                                        host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(api.serve())
+    while not api.started:
+        await asyncio.sleep(0.05)
+    yield f"http://127.0.0.1:{port}", storage
+    api.should_exit = True
+    await task
+
+
+@pytest_asyncio.fixture
+async def two_nodes(message_store, tmp_path):
+    """Nodes "a" and "b" as separate server processes on loopback."""
+    api_base, storage = message_store
+    chat_ports = {"a": free_port(), "b": free_port()}
+    link_ports = {"a": free_port(), "b": free_port()}
+    processes = {}
+    for node, other in (("a", "b"), ("b", "a")):
+        processes[node] = await asyncio.create_subprocess_exec(
+            sys.executable, "-u", "-m", "src.p2p_chat.server",
+            "--host", "127.0.0.1", "--port", str(chat_ports[node]), "--api-base", api_base,
+            "--node-id", node, "--cluster-listen", f"127.0.0.1:{link_ports[node]}",
+            "--peer", f"{other}=127.0.0.1:{link_ports[other]}",
+            "--spool-path", str(tmp_path / f"{node}-spool.jsonl"),
+            cwd=REPO_ROOT, stdout=asyncio.subprocess.PIPE,
+        )
+    for node, other in (("a", "b"), ("b", "a")):
+        await wait_for_line(processes[node], f"Node {other} connected")
+
+    yield chat_ports, processes, storage
+
+    for process in processes.values():
+        if process.returncode is None:
+            process.terminate()
+            await process.wait()
+
+
+async def login(port, username):
+    reader, writer = await open_connection("127.0.0.1", port, username)
+    frames = iter_frames(reader)
+    first = await asyncio.wait_for(anext(frames), 5)
+    return frames, writer, first
+
+
+async def next_frame(frames, kind):
+    async for frame in frames:
+        if frame["type"] == kind:
+            return frame
+
+
+def test_parse_peer():
+    assert parse_peer("b=10.0.0.2:5100") == ("b", ("10.0.0.2", 5100))
+    with pytest.raises(ValueError):
+        parse_peer("10.0.0.2:5100")
+
+
+@pytest.mark.asyncio
+async def test_claims_fail_closed_and_lost_nodes_leave_their_rooms(monkeypatch):
+    monkeypatch.setattr(server, "clients", {})
+    monkeypatch.setattr(server, "rooms", {"ops": {"alice"}})
+    monkeypatch.setattr(server, "roster", Roster())
+    router = ClusterRouter("a", ("127.0.0.1", 0), {"b": ("127.0.0.1", 1)})
+
+    # Node b arbitrates this name but was never reached, so the login is refused
+    username = next(name for name in ("bob", "carol", "dave", "erin", "frank") if router.registry_for(name) == "b")
+    assert not await router.claim(username)
+
+    router._learn_room("b", "ops", "bob")
+    router._learn_room("b", "ops", "alice")  # Already known here; not node b's to take away
+    router._learn_room("b", "dev", "bob")
+    assert server.rooms == {"ops": {"alice", "bob"}, "dev": {"bob"}}
+    router._forget("b")
+    assert server.rooms == {"ops": {"alice"}}
+
+
+@pytest.mark.asyncio
+async def test_live_delivery_across_nodes(two_nodes):
+    ports, _, storage = two_nodes
+    bob, bob_writer, welcome = await login(ports["b"], "bob")
+    assert welcome["type"] == "login_success"
+    await asyncio.sleep(0.2)  # Let node b's presence gossip reach node a
+
+    # bob is on node b, so the name is taken on node a too
+    _, dup_writer, refusal = await login(ports["a"], "bob")
+    assert "already taken" in refusal["message"]
+    dup_writer.close()
+
+    alice, alice_writer, welcome = await login(ports["a"], "alice")
+    assert sorted(welcome["online_users"]) == ["alice", "bob"]
+    bob_writer.write(encode_frame({"type": "join", "room": "ops"}))
+    await bob_writer.drain()
+    await asyncio.sleep(0.2)
+
+    alice_writer.write(encode_frame({"type": "chat", "destination": "bob", "message": "hello from a"}))
+    alice_writer.write(encode_frame({"type": "chat", "destination": "#ops", "message": "room from a"}))
+    await alice_writer.drain()
+
+    direct = await asyncio.wait_for(next_frame(bob, "chat"), 5)
+    assert (direct["sender"], direct["message"]) == ("alice", "hello from a")
+    published = await asyncio.wait_for(next_frame(bob, "chat"), 5)
+    assert (published["room"], published["message"]) == ("ops", "room from a")
+    notice = await asyncio.wait_for(next_frame(alice, "system"), 5)
+    assert "1 delivered, 0 saved" in notice["message"]
+    assert not storage.mailboxes  # Nothing fell back to storage
+
+    for writer in (alice_writer, bob_writer):
+        writer.close()
+
+
+@pytest.mark.asyncio
+async def test_users_on_a_lost_node_are_offline(two_nodes):
+    ports, processes, storage = two_nodes
+    _, bob_writer, _ = await login(ports["b"], "bob")
+    alice, alice_writer, _ = await login(ports["a"], "alice")
+
+    processes["b"].terminate()
+    await processes["b"].wait()
+    await asyncio.sleep(0.2)
+
+    alice_writer.write(encode_frame({"type": "chat", "destination": "bob", "message": "are you there?"}))
+    await alice_writer.drain()
+    notice = await asyncio.wait_for(next_frame(alice, "system"), 5)
+    assert "offline" in notice["message"]
+    for _ in range(100):  # Stores are written behind, so give this one a moment
+        if storage.mailboxes.get("bob"):
+            break
+        await asyncio.sleep(0.02)
+    assert [d["message"] for d in storage.mailboxes["bob"].values()] == ["are you there?"]
+    alice_writer.close()
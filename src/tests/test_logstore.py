@@ -0,0 +1,131 @@
+# test_logstore.py
+import asyncio
+import os
+
+import pytest
+
+from src.p2p_chat.logstore import LogStorage
+
+
+def readings(count, destination="bob", start=0):
+    return [
+        {"sender": "thermometer", "destination": destination, "message": f"reading {i}", "type": "notification"}
+        for i in range(start, start + count)
+    ]
+
+
+def segment_files(path):
+    return sorted(name for name in os.listdir(path) if name.endswith(".seg"))
+
+
+def disk_usage(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in segment_files(path))
+
+
+@pytest.mark.asyncio
+async def test_index_is_rebuilt_on_restart(tmp_path):
+    store = LogStorage(str(tmp_path), shards=2)
+    ids = await store.insert_many(readings(5) + readings(2, "carol"))
+    assert await store.ack("bob", ids[:2]) == 2
+    await store.claim("carol", 10, lease=30)  # Claims don't survive a restart
+    await store.close()
+
+    store = LogStorage(str(tmp_path), shards=2)
+    messages, more = await store.take("bob", 10)
+    assert [msg["message"] for msg in messages] == ["reading 2", "reading 3", "reading 4"]
+    assert not more
+    _, claimed = await store.claim("carol", 10, lease=30)
+    assert len(claimed) == 2
+    new_ids = await store.insert_many(readings(1))
+    assert int(new_ids[0]) > max(int(i) for i in ids)  # Ids keep increasing across restarts
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_expiry_survives_restart(tmp_path):
+    store = LogStorage(str(tmp_path), shards=1)
+    docs = readings(3)
+    docs[0]["expires_at"] = 100.0
+    await store.insert_many(docs)
+    await store.close()
+
+    store = LogStorage(str(tmp_path), shards=1)
+    assert await store.expire(50.0) == 0
+    assert await store.expire(150.0) == 1
+    messages, _ = await store.take("bob", 10)
+    assert [msg["message"] for msg in messages] == ["reading 1", "reading 2"]
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_summary_after_restart(tmp_path):
+    store = LogStorage(str(tmp_path), shards=1)
+    ids = await store.insert_many(readings(3))
+    await store.close()
+
+    store = LogStorage(str(tmp_path), shards=1)
+    await store.ack("bob", ids[:1])  # Before the counters are rebuilt
+    await store.insert_many(readings(1, start=3))
+    assert (await store.summary("bob"))["by_sender"] == {"thermometer": 3}
+    await store.ack("bob", ids[1:2])
+    assert (await store.summary("bob"))["total"] == 2
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_torn_tail_is_truncated(tmp_path):
+    store = LogStorage(str(tmp_path), shards=1)
+    await store.insert_many(readings(3))
+    await store.close()
+    path = tmp_path / segment_files(tmp_path)[-1]
+    size = path.stat().st_size
+    with open(path, "r+b") as f:
+        f.truncate(size - 5)  # The last record was cut off mid-write
+
+    store = LogStorage(str(tmp_path), shards=1)
+    assert await store.count("bob") == 2
+    await store.insert_many(readings(1, start=3))
+    messages, _ = await store.take("bob", 10)
+    assert [msg["message"] for msg in messages] == ["reading 0", "reading 1", "reading 3"]
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_compaction_reclaims_acked_segments(tmp_path):
+    store = LogStorage(str(tmp_path), shards=1, segment_size=1024)
+    ids = await store.insert_many(readings(60))
+    assert len(segment_files(tmp_path)) > 3
+
+    # Ack everything but the last few messages, then compact
+    await store.ack("bob", ids[:-3])
+    sealed = len(segment_files(tmp_path)) - 1
+    before = disk_usage(tmp_path)
+    assert await store.compact() == sealed
+    assert disk_usage(tmp_path) < before / 3
+    _, messages = await store.claim("bob", 10, lease=30)
+    assert [msg["message"] for msg in messages] == [f"reading {i}" for i in range(57, 60)]
+    await store.close()
+
+    # Compaction keeps what a restart needs: acked messages stay acked
+    store = LogStorage(str(tmp_path), shards=1, segment_size=1024)
+    assert await store.count("bob") == 3
+    await store.close()
+
+
+@pytest.mark.asyncio
+async def test_acks_during_compaction_are_kept(tmp_path):
+    store = LogStorage(str(tmp_path), shards=1, segment_size=1024)
+    ids = await store.insert_many(readings(60))
+    await store.ack("bob", ids[:40])
+
+    compaction = asyncio.create_task(store.compact())
+    await asyncio.sleep(0)  # Reading the first segment in a worker thread
+    await store.ack("bob", ids[40:58])
+    await compaction
+    assert await store.count("bob") == 2
+    await store.close()
+
+    store = LogStorage(str(tmp_path), shards=1, segment_size=1024)
+    messages, _ = await store.take("bob", 10)
+    assert [msg["message"] for msg in messages] == ["reading 58", "reading 59"]
+    await store.close()
@@ -0,0 +1,337 @@
+# test_openai.py
+import asyncio
+import json
+import re
+import time
+from collections import deque
+
+import pytest
+import pytest_asyncio
+
+import src.p2p_chat.openai as openai_bot
+import src.p2p_chat.ratelimit as ratelimit
+import src.p2p_chat.server as server
+from src.p2p_chat.presence import Roster
+from src.p2p_chat.protocol import encode_frame, iter_frames, open_connection
+
+LATENCY = 0.5  # Seconds the stub completions endpoint takes per call
+
+
+@pytest.mark.asyncio
+async def test_pool_keeps_each_users_order_and_caps_concurrency():
+    running = set()
+    peak = 0
+    handled = []
+
+    async def handler(user, request):
+        nonlocal peak
+        assert user not in running  # One request per user at a time
+        running.add(user)
+        peak = max(peak, len(running))
+        await asyncio.sleep(0.01)
+        running.discard(user)
+        handled.append((user, request))
+
+    pool = openai_bot.RequestPool(handler, workers=3, queue_max=10)
+    pool.start()
+    for i in range(3):
+        for user in ("alice", "bob", "carol", "dave"):
+            if user != "dave" or i == 0:
+                assert pool.submit(user, i)
+    assert not pool.submit("erin", 0)  # An 11th would be over the limit
+    assert pool.stats()["waiting"] == 10 and pool.stats()["users"] == 4
+
+    await asyncio.wait_for(pool.join(), 2)
+    await pool.close()
+    assert peak == 3
+    for user in ("alice", "bob", "carol"):
+        assert [r for u, r in handled if u == user] == [0, 1, 2]
+    assert pool.stats() == {"waiting": 0, "in_flight": 0, "users": 0, "done": 10, "workers": 3}
+
+
+class StubCompletions:
+    """A stand-in for the completions endpoint that takes LATENCY seconds to answer.
+
+    With ``limit`` it allows that many calls per ``window`` seconds, reporting
+    what is left in OpenAI's rate-limit headers and answering 429 beyond it;
+    the first ``failures`` calls get a 503.
+    """
+
+    def __init__(self, limit=None, window=1.0, failures=0):
+        self.limit = limit
+        self.window = window
+        self.failures = failures
+        self.calls = []
+        self.statuses = []
+        self.connections = 0
+        self.started = deque()  # When recent calls were let through
+        self.url = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        host, port = self.server.sockets[0].getsockname()[:2]
+        self.url = f"http://{host}:{port}/v1/chat/completions"
+
+    def reply(self, prompt):
+        now = time.monotonic()
+        while self.started and now - self.started[0] > self.window:
+            self.started.popleft()
+        headers = {}
+        if self.limit is not None:
+            reset = self.window - (now - self.started[0]) if self.started else 0
+            headers = {"x-ratelimit-limit-requests": self.limit,
+                       "x-ratelimit-remaining-requests": max(0, self.limit - len(self.started) - 1),
+                       "x-ratelimit-reset-requests": f"{int(reset * 1000)}ms"}
+            if len(self.started) >= self.limit:
+                return 429, {**headers, "retry-after-ms": int(reset * 1000) + 1}, {"error": "rate limited"}
+        if self.failures > 0:
+            self.failures -= 1
+            return 503, headers, {"error": "overloaded"}
+        self.started.append(now)
+        self.calls.append(prompt)
+        return 200, headers, {"choices": [{"message": {"content": f"re: {prompt}"}}]}
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = int(re.search(rb"content-length:\s*(\d+)", head, re.I).group(1))
+                prompt = json.loads(await reader.readexactly(length))["messages"][-1]["content"]
+                status, headers, reply = self.reply(prompt)
+                self.statuses.append(status)
+                if status == 200:
+                    await asyncio.sleep(LATENCY)
+                body = json.dumps(reply).encode()
+                head = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+                writer.write(f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n{head}"
+                             f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+@pytest_asyncio.fixture
+async def completions():
+    stub = StubCompletions()
+    await stub.start()
+    yield stub
+    stub.server.close()
+
+
+@pytest_asyncio.fixture
+async def chat_address(monkeypatch):
+    async def no_store(*args, **kwargs):
+        return True
+
+    async def no_stored_messages(username, *args, **kwargs):
+        return []
+
+    monkeypatch.setattr(server, "store_message", no_store)
+    monkeypatch.setattr(server, "get_stored_messages", no_stored_messages)
+    monkeypatch.setattr(server, "roster", Roster())
+    server.clients.clear()
+    chat_server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    yield chat_server.sockets[0].getsockname()[:2]
+    chat_server.close()
+    server.clients.clear()
+
+
+@pytest.mark.asyncio
+async def test_bot_answers_users_concurrently_in_order(chat_address, completions, monkeypatch):
+    monkeypatch.setattr(openai_bot, "OPENAI_API_KEY", "test-key")
+    host, port = chat_address
+    bot = openai_bot.OpenAIChatbot(workers=4, api_url=completions.url)
+    bot_task = asyncio.create_task(bot.run(host, port))
+    while "openai" not in server.clients:
+        await asyncio.sleep(0.01)
+
+    users = {}
+    for name in ("alice", "bob", "carol"):
+        reader, writer = await open_connection(host, port, name)
+        users[name] = (iter_frames(reader), writer)
+
+    started = time.perf_counter()
+    for name, (_, writer) in users.items():
+        writer.write(b"".join(encode_frame({"type": "chat", "destination": "openai", "message": f"{name} {i}"})
+                              for i in range(3)))
+        await writer.drain()
+
+    async def answers(frames):
+        replies = []
+        async for event in frames:
+            if event["type"] == "chat" and event["sender"] == "openai" and event["message"].startswith("re:"):
+                replies.append(event["message"])
+                if len(replies) == 3:
+                    return replies
+
+    results = await asyncio.wait_for(asyncio.gather(*(answers(frames) for frames, _ in users.values())), 10)
+    elapsed = time.perf_counter() - started
+    for name, replies in zip(users, results):
+        assert replies == [f"re: {name} {i}" for i in range(3)]
+    assert len(completions.calls) == 9
+    assert completions.connections <= 4  # Kept alive between calls
+    assert elapsed < 6 * LATENCY  # Three rounds; one at a time would take nine
+
+    alice_frames, alice_writer = users["alice"]
+    alice_writer.write(encode_frame({"type": "chat", "destination": "openai", "message": "status"}))
+    status = await asyncio.wait_for(anext(alice_frames), 2)
+    assert status["message"].startswith("0 requests in progress, 0 waiting")
+
+    for _, writer in users.values():
+        writer.close()
+    bot.running = False
+    bot.writer.close()
+    await asyncio.wait_for(bot_task, 2)
+    await bot.close()
+
+
+@pytest.mark.asyncio
+async def test_bot_only_answers_messages_sent_to_it(monkeypatch):
+    monkeypatch.setattr(openai_bot, "OPENAI_API_KEY", "test-key")
+    bot = openai_bot.OpenAIChatbot()
+    prompts = []
+    monkeypatch.setattr(bot.requests, "submit", lambda sender, content: prompts.append((sender, content)) or True)
+
+    reader = asyncio.StreamReader()
+    for destination, sender in (("TO_ALL", "alice"), ("#ops", "alice"), ("openai", "openai"), ("openai", "bob")):
+        reader.feed_data(encode_frame({"type": "chat", "sender": sender, "destination": destination,
+                                       "message": f"hi from {sender} to {destination}"}))
+    reader.feed_eof()
+    await bot.handle_incoming(reader, None)
+    assert prompts == [("bob", "hi from bob to openai")]
+    await bot.close()
+
+
+def test_rate_limit_headers():
+    assert ratelimit.parse_reset("20ms") == 0.02
+    assert ratelimit.parse_reset("6m0s") == 360
+    assert ratelimit.parse_reset("1.5") == 1.5
+    assert ratelimit.retry_after({"retry-after-ms": "250"}) == 0.25
+    assert ratelimit.retry_after({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}) is None
+
+    limiter = ratelimit.RateLimiter(max_concurrency=8)
+    limiter.in_flight = 2
+    limiter.release(429, {"retry-after": "2"})
+    assert limiter.ceiling == 4 and limiter.paused_until > time.monotonic() + 1.5
+    for _ in range(8):
+        limiter.in_flight += 1
+        limiter.release(200, {})
+    assert 5 < limiter.ceiling < 7  # Grows back about one per ceiling's worth of successes
+
+    limiter.update({"x-ratelimit-limit-requests": "60", "x-ratelimit-remaining-requests": "0",
+                    "x-ratelimit-reset-requests": "30s"})
+    assert limiter.rate == 2.0 and limiter.tokens == 0
+    assert limiter.paused_until > time.monotonic() + 29
+
+
+@pytest.mark.asyncio
+async def test_completions_follow_rate_limits_and_retry(monkeypatch):
+    monkeypatch.setattr(openai_bot, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(ratelimit, "BACKOFF_BASE", 0.05)
+    stub = StubCompletions(limit=5, window=0.5, failures=2)
+    await stub.start()
+    bot = openai_bot.OpenAIChatbot(workers=8, api_url=stub.url)
+    try:
+        replies = await asyncio.wait_for(
+            asyncio.gather(*(bot.generate_response(f"q{i}") for i in range(20))), 10)
+    finally:
+        await bot.close()
+        stub.server.close()
+    assert replies == [f"re: q{i}" for i in range(20)]
+    assert stub.statuses.count(503) == 2  # Retried
+    assert stub.statuses.count(429) <= 2  # Paced by the headers rather than by refusals
+    assert bot.limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_response_cache_lru_ttl_and_coalescing():
+    cache = openai_bot.ResponseCache(entries=2, ttl=0.2)
+    calls = []
+
+    async def generate(text):
+        calls.append(text)
+        await asyncio.sleep(0.05)
+        return f"re: {text}"
+
+    def key(text):
+        return openai_bot.ResponseCache.key("gpt-4o", "be happy", text)
+
+    assert key("Hi!") == key("  hi ") != key("hi there")
+    assert key("hi") != openai_bot.ResponseCache.key("gpt-4o", "be grumpy", "hi")
+
+    # Five identical prompts at once make one call
+    replies = await asyncio.gather(*(cache.get_or_generate(key("hi"), lambda: generate("hi")) for _ in range(5)))
+    assert replies == ["re: hi"] * 5 and calls == ["hi"]
+    assert await cache.get_or_generate(key("Hi!"), lambda: generate("Hi!")) == "re: hi"
+
+    # A failure reaches everyone waiting on it and is not cached
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise openai_bot.CompletionError("Sorry")
+
+    results = await asyncio.gather(*(cache.get_or_generate(key("boom"), fail) for _ in range(3)),
+                                   return_exceptions=True)
+    assert all(isinstance(e, openai_bot.CompletionError) for e in results)
+    assert await cache.get_or_generate(key("boom"), lambda: generate("boom")) == "re: boom"
+
+    await cache.get_or_generate(key("third"), lambda: generate("third"))  # Evicts "hi", the least recently used
+    await cache.get_or_generate(key("hi"), lambda: generate("hi"))
+    assert calls == ["hi", "boom", "third", "hi"]
+
+    await asyncio.sleep(0.25)
+    await cache.get_or_generate(key("hi"), lambda: generate("hi"))
+    assert calls[-1] == "hi" and len(calls) == 5
+    assert cache.stats() == {"hits": 1, "disk_hits": 0, "misses": 6, "coalesced": 6, "evictions": 2, "expired": 1,
+                             "entries": 2, "bytes": len("re: hi") + len("re: third")}
+
+
+@pytest.mark.asyncio
+async def test_cancelled_answer_fails_its_waiters_without_killing_workers():
+    cache = openai_bot.ResponseCache()
+    started = asyncio.Event()
+    outcomes = []
+
+    async def generate():
+        started.set()
+        await asyncio.sleep(10)
+
+    async def quick():
+        return "re: again"
+
+    async def handler(user, request):
+        try:
+            outcomes.append(await cache.get_or_generate(request, generate if request == "slow" else quick))
+        except openai_bot.CompletionError as e:
+            outcomes.append(str(e))
+
+    pool = openai_bot.RequestPool(handler, workers=1)
+    pool.start()
+    owner = asyncio.create_task(cache.get_or_generate("slow", generate))
+    await started.wait()
+    pool.submit("alice", "slow")  # Waits on the owner's call
+    await asyncio.sleep(0.01)
+    owner.cancel()
+    await asyncio.wait_for(pool.join(), 2)
+    assert outcomes == ["Sorry, I couldn't generate a response right now."]
+
+    # The only worker is still there to take the next request
+    pool.submit("alice", "fast")
+    await asyncio.wait_for(pool.join(), 2)
+    assert outcomes[-1] == "re: again"
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_response_cache_disk_tier_survives_restart(completions, tmp_path, monkeypatch):
+    monkeypatch.setattr(openai_bot, "OPENAI_API_KEY", "test-key")
+    path = str(tmp_path / "responses.db")
+    for _ in range(2):
+        bot = openai_bot.OpenAIChatbot(api_url=completions.url, cache=openai_bot.ResponseCache(path=path))
+        assert await bot.generate_response("What is P2P?") == "re: What is P2P?"
+        assert await bot.generate_response("what is p2p") == "re: What is P2P?"
+        await bot.close()
+    assert completions.calls == ["What is P2P?"]
+    assert bot.cache.stats()["disk_hits"] == 1
@@ -0,0 +1,72 @@
+# test_presence.py
+import asyncio
+import pytest
+
+from src.p2p_chat.presence import PresenceBatcher, Roster
+
+
+def test_roster_versions_and_deltas():
+    roster = Roster()
+    for user in ("carol", "alice", "bob"):
+        roster.join(user)
+    assert not roster.join("bob")
+    assert roster.version == 3
+    assert roster.text() == "alice, bob, carol"
+
+    roster.leave("alice")
+    roster.join("dave")
+    assert roster.delta(3) == {"version": 5, "joined": ["dave"], "left": ["alice"]}
+    assert roster.delta(5) == {"version": 5, "joined": [], "left": []}
+    assert roster.text() == "bob, carol, dave"
+
+
+def test_delta_cancels_flapping_users():
+    roster = Roster()
+    roster.join("alice")
+    roster.join("bob")
+    roster.leave("bob")
+    roster.leave("alice")
+    roster.join("alice")
+    assert roster.delta(1) == {"version": 5, "joined": [], "left": []}
+    assert roster.delta(0) == {"version": 5, "joined": ["alice"], "left": []}
+
+
+def test_delta_needs_snapshot_once_history_is_gone():
+    roster = Roster(history=3)
+    for i in range(5):
+        roster.join(f"user{i}")
+    assert roster.delta(1) is None
+    assert roster.delta(2)["joined"] == ["user2", "user3", "user4"]
+
+
+def test_snapshot_pages():
+    roster = Roster()
+    for i in range(25):
+        roster.join(f"user{i:02d}")
+    pages, after = [], None
+    while True:
+        page = roster.snapshot(after=after, limit=10)
+        pages.append(page["users"])
+        after = page["next"]
+        if after is None:
+            break
+    assert [len(p) for p in pages] == [10, 10, 5]
+    assert sum(pages, []) == sorted(f"user{i:02d}" for i in range(25))
+    assert page["count"] == 25 and page["version"] == 25
+
+
+@pytest.mark.asyncio
+async def test_batcher_publishes_one_delta_per_window():
+    roster = Roster()
+    published = []
+    batcher = PresenceBatcher(roster, published.append, window=0.01)
+    for i in range(100):
+        roster.join(f"user{i}")
+        batcher.changed()
+    roster.leave("user5")
+    batcher.changed()
+    await asyncio.sleep(0.05)
+
+    assert len(published) == 1
+    assert published[0]["type"] == "presence" and published[0]["version"] == 101
+    assert len(published[0]["joined"]) == 99 and published[0]["left"] == []
@@ -0,0 +1,271 @@
+# test_protocol.py
+import asyncio
+import pytest
+import pytest_asyncio
+
+import src.p2p_chat.server as server
+from src.p2p_chat.presence import Roster
+from src.p2p_chat.protocol import (
+    FrameDecoder,
+    LineDecoder,
+    ProtocolError,
+    encode_frame,
+    encode_tagged,
+    iter_frames,
+    open_connection,
+    open_gateway,
+    tag_frame,
+)
+
+
+# ----------------------
+# Frame Decoder Tests
+# ----------------------
+def test_decoder_splits_merged_frames():
+    data = b"".join(encode_frame({"type": "chat", "message": f"m{i}"}) for i in range(3))
+    frames = FrameDecoder().feed(data)
+    assert [f["message"] for f in frames] == ["m0", "m1", "m2"]
+
+
+def test_decoder_buffers_partial_frames():
+    payload = encode_frame({"type": "chat", "message": "x" * 5000})
+    decoder = FrameDecoder()
+    assert decoder.feed(payload[:3]) == []
+    assert decoder.feed(payload[3:100]) == []
+    frames = decoder.feed(payload[100:])
+    assert len(frames) == 1 and len(frames[0]["message"]) == 5000
+
+
+def test_decoder_rejects_oversized_frames():
+    decoder = FrameDecoder(max_frame_size=10)
+    with pytest.raises(ProtocolError):
+        decoder.feed(encode_frame({"message": "too long for the limit"}))
+
+
+def test_tagged_frames_carry_their_session():
+    shared = encode_frame({"type": "chat", "message": "same bytes"})
+    data = tag_frame(7, shared) + encode_tagged(9, {"type": "exit"})
+    assert FrameDecoder(tagged=True).feed(data) == [(7, {"type": "chat", "message": "same bytes"}), (9, {"type": "exit"})]
+    assert FrameDecoder(tagged=True, raw=True).feed(data) == [(7, shared[4:]), (9, b'{"type":"exit"}')]
+
+
+def test_line_decoder_buffers_partial_lines():
+    decoder = LineDecoder()
+    assert decoder.feed(b"bob: hi\n") == [{"type": "chat", "destination": "bob", "message": "hi"}]
+    assert decoder.feed(b"bob: hel") == []
+    assert decoder.feed(b"lo\r\n!check\n\nexit") == [
+        {"type": "chat", "destination": "bob", "message": "hello"},
+        {"type": "check"},
+    ]
+    assert decoder.finish() == [{"type": "exit"}]
+    assert decoder.finish() == []
+
+
+def test_line_decoder_takes_unterminated_writes_as_requests():
+    decoder = LineDecoder()
+    assert decoder.feed(b"bob: hi") == [{"type": "chat", "destination": "bob", "message": "hi"}]
+    assert decoder.feed(b"!check") == [{"type": "check"}]
+    assert decoder.finish() == []
+
+
+# ----------------------
+# v2 Server Tests
+# ----------------------
+@pytest.fixture
+def quiet_storage(monkeypatch):
+    stored = []
+
+    async def fake_store_message(sender, destination, message, *args, **kwargs):
+        stored.append((sender, destination, message))
+
+    async def fake_get_stored_messages(username, *args, **kwargs):
+        return []
+
+    monkeypatch.setattr(server, "store_message", fake_store_message)
+    monkeypatch.setattr(server, "get_stored_messages", fake_get_stored_messages)
+    monkeypatch.setattr(server, "roster", Roster())
+    server.clients.clear()
+    yield stored
+    server.clients.clear()
+
+
+@pytest_asyncio.fixture
+async def chat_address(quiet_storage):
+    chat_server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    yield chat_server.sockets[0].getsockname()[:2]
+    chat_server.close()
+    await chat_server.wait_closed()
+
+
+async def next_frame(frames, kind):
+    async for frame in frames:
+        if frame["type"] == kind:
+            return frame
+
+
+@pytest.mark.asyncio
+async def test_v2_pipelined_messages_arrive_in_order(chat_address):
+    host, port = chat_address
+    bob_reader, bob_writer = await open_connection(host, port, "bob")
+    bob_frames = iter_frames(bob_reader)
+    welcome = await next_frame(bob_frames, "login_success")
+    assert welcome["online_users"] == ["bob"]
+
+    alice_reader, alice_writer = await open_connection(host, port, "alice")
+    # Pipeline a burst of frames, including one far larger than the old 1 KB read
+    burst = [{"type": "chat", "destination": "bob", "message": f"msg {i}"} for i in range(50)]
+    burst.append({"type": "chat", "destination": "bob", "message": "y" * 4000, "metadata": {"big": True}})
+    alice_writer.write(b"".join(encode_frame(frame) for frame in burst))
+    await alice_writer.drain()
+
+    received = []
+    while len(received) < len(burst):
+        frame = await asyncio.wait_for(next_frame(bob_frames, "chat"), 2)
+        received.append(frame)
+
+    assert [f["message"] for f in received[:50]] == [f"msg {i}" for i in range(50)]
+    assert received[-1]["sender"] == "alice"
+    assert received[-1]["metadata"] == {"big": True}
+    assert len(received[-1]["message"]) == 4000
+
+    for writer in (alice_writer, bob_writer):
+        writer.write(encode_frame({"type": "exit"}))
+        writer.close()
+        await writer.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_v1_client_receives_from_v2_sender(chat_address, quiet_storage):
+    host, port = chat_address
+    v1_reader, v1_writer = await asyncio.open_connection(host, port)
+    await v1_reader.readuntil(b": ")
+    v1_writer.write(b"carol\n")
+    await v1_writer.drain()
+    assert b"Connected! Users online: carol" in await v1_reader.readline()
+
+    reader, writer = await open_connection(host, port, "dave")
+    writer.write(encode_frame({"type": "chat", "destination": "carol", "message": "hi carol"}))
+    writer.write(encode_frame({"type": "chat", "destination": "erin", "message": "for later"}))
+    await writer.drain()
+
+    line = await asyncio.wait_for(v1_reader.readline(), 2)
+    assert line.startswith(b"[dave][") and line.endswith(b"] hi carol\n")
+
+    frames = iter_frames(reader)
+    notice = await asyncio.wait_for(next_frame(frames, "system"), 2)
+    assert "offline" in notice["message"]
+    assert quiet_storage == [("dave", "erin", "for later")]
+
+    # Old clients send one message per write, with no newline
+    for text in (b"dave: one", b"dave: two"):
+        v1_writer.write(text)
+        await v1_writer.drain()
+        reply = await asyncio.wait_for(next_frame(frames, "chat"), 2)
+        assert reply["sender"] == "carol" and reply["message"] == text[6:].decode()
+
+    # Once it ends its lines, a line split across two reads is still one message
+    v1_writer.write(b"dave: ready\n")
+    await v1_writer.drain()
+    reply = await asyncio.wait_for(next_frame(frames, "chat"), 2)
+    assert reply["message"] == "ready"
+    v1_writer.write(b"dave: hel")
+    await v1_writer.drain()
+    await asyncio.sleep(0.05)
+    v1_writer.write(b"lo dave\n")
+    await v1_writer.drain()
+    reply = await asyncio.wait_for(next_frame(frames, "chat"), 2)
+    assert reply["sender"] == "carol" and reply["message"] == "hello dave"
+
+    for w in (v1_writer, writer):
+        w.close()
+        await w.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_login_does_not_wait_for_the_mailbox(chat_address, monkeypatch):
+    api_back = asyncio.Event()
+
+    async def hanging_mailbox(username, *args, **kwargs):
+        await api_back.wait()
+        return []
+
+    monkeypatch.setattr(server, "get_stored_messages", hanging_mailbox)
+    host, port = chat_address
+    reader, writer = await open_connection(host, port, "alice")
+    writer.write(encode_frame({"type": "chat", "destination": "erin", "message": "for later"}))
+    await writer.drain()
+    notice = await asyncio.wait_for(next_frame(iter_frames(reader), "system"), 2)
+    assert "offline" in notice["message"]
+
+    api_back.set()
+    writer.close()
+    await writer.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_presence_deltas_and_pages(chat_address):
+    host, port = chat_address
+    reader, writer = await open_connection(host, port, "alice")
+    frames = iter_frames(reader)
+    welcome = await next_frame(frames, "login_success")
+    assert welcome["online_users"] == ["alice"] and welcome["next"] is None
+
+    _, bob_writer = await open_connection(host, port, "bob")
+    await asyncio.sleep(0.05)
+    writer.write(encode_frame({"type": "presence", "since": welcome["presence_version"]}))
+    await writer.drain()
+    delta = await asyncio.wait_for(next_frame(frames, "presence"), 2)
+    assert delta["joined"] == ["bob"] and delta["left"] == []
+
+    writer.write(encode_frame({"type": "presence", "after": "alice"}))
+    await writer.drain()
+    page = await asyncio.wait_for(next_frame(frames, "roster"), 2)
+    assert page["users"] == ["bob"] and page["count"] == 2
+
+    for w in (writer, bob_writer):
+        w.close()
+        await w.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_gateway_multiplexes_sessions(chat_address):
+    host, port = chat_address
+    gateway_reader, gateway = await open_gateway(host, port, "web")
+    frames = iter_frames(gateway_reader, FrameDecoder(tagged=True))
+    gateway.write(encode_tagged(1, {"type": "open", "username": "alice"}))
+    gateway.write(encode_tagged(2, {"type": "open", "username": "bob"}))
+    await gateway.drain()
+    logins = [await asyncio.wait_for(anext(frames), 2) for _ in range(4)]
+    assert [(session, frame["type"]) for session, frame in logins] == [
+        (0, "opened"), (1, "login_success"), (0, "opened"), (2, "login_success")]
+    assert logins[3][1]["online_users"] == ["alice", "bob"]
+    presence = await asyncio.wait_for(anext(frames), 2)  # One batch for the whole link
+    assert presence == (0, {"type": "presence", "version": 2, "joined": ["alice", "bob"], "left": []})
+
+    reader, writer = await open_connection(host, port, "carol")
+    writer.write(encode_frame({"type": "chat", "destination": "alice", "message": "hi alice"}))
+    await writer.drain()
+    gateway.write(encode_tagged(1, {"type": "chat", "destination": "bob", "message": "hi bob"}))
+    gateway.write(encode_tagged(3, {"type": "open", "username": "bob"}))  # Taken by session 2
+    await gateway.drain()
+
+    received = {}
+    while len(received) < 3:
+        session, frame = await asyncio.wait_for(anext(frames), 2)
+        if frame["type"] != "presence":  # carol's login
+            received[frame["session"] if session == 0 else session] = frame
+    assert received[1]["message"] == "hi alice" and received[1]["sender"] == "carol"
+    assert received[2]["message"] == "hi bob" and received[2]["sender"] == "alice"
+    assert received[3]["type"] == "closed" and "taken" in received[3]["message"]
+
+    gateway.write(encode_tagged(1, {"type": "exit"}))
+    await gateway.drain()
+    await asyncio.sleep(0.05)
+    assert sorted(server.clients) == ["bob", "carol"]
+
+    gateway.close()
+    await gateway.wait_closed()
+    await asyncio.sleep(0.05)
+    assert sorted(server.clients) == ["carol"]
+    writer.close()
+    await writer.wait_closed()
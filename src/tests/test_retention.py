@@ -0,0 +1,53 @@
+# test_retention.py
+import asyncio
+
+import pytest
+
+from src.p2p_chat.retention import Retention, parse_caps, parse_duration, parse_retention
+from src.p2p_chat.storage import MemoryStorage
+
+
+def test_parse_retention():
+    assert parse_duration("90") == 90 and parse_duration("6h") == 6 * 3600 and parse_duration("1.5d") == 129600
+    assert parse_retention(["chat=30d", "notification=0"]) == {"chat": 30 * 86400}
+    with pytest.raises(ValueError):
+        parse_retention(["notification"])
+    with pytest.raises(ValueError):
+        parse_duration("soon")
+    assert parse_caps(["notification=1000", "chat=0"]) == {"notification": 1000}
+    with pytest.raises(ValueError):
+        parse_caps(["notification=lots"])
+
+
+@pytest.mark.asyncio
+async def test_stamp_trim_and_sweep():
+    storage = MemoryStorage()
+    retention = Retention(storage, {"notification": 60}, caps={"notification": 1})
+    docs = [retention.stamp({"sender": "thermometer", "destination": "bob", "message": str(i), "type": kind}, now=1000)
+            for i, kind in enumerate(["notification", "chat"] * 3)]
+    assert docs[0]["expires_at"] == 1060 and "expires_at" not in docs[1]
+
+    await storage.insert_many(docs)
+    retention.touch([("bob", "notification"), ("bob", "chat")])
+    retention.touch([("bob", "notification")])  # One trim per pass however often a mailbox is touched
+    await asyncio.sleep(0)
+    assert retention.trimmer is None
+    # Only notifications are capped; chat is never dropped
+    assert [doc["message"] for doc in storage.mailboxes["bob"].values()] == ["1", "3", "4", "5"]
+
+    assert await retention.sweep(now=1061) == 1
+    assert [doc["message"] for doc in storage.mailboxes["bob"].values()] == ["1", "3", "5"]
+
+
+@pytest.mark.asyncio
+async def test_nothing_is_dropped_by_default():
+    storage = MemoryStorage()
+    retention = Retention(storage)
+    doc = retention.stamp({"sender": "thermometer", "destination": "bob", "message": "20°C", "type": "notification"})
+    assert "expires_at" not in doc
+    await storage.insert_many([doc] * 3)
+    retention.touch([("bob", "notification")])
+    assert retention.trimmer is None and not retention.dirty
+    retention.start()
+    assert retention.sweeper is None
+    assert await storage.count("bob") == 3
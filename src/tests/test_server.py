@@ -0,0 +1,402 @@
+# test_server.py
+import asyncio
+import json
+import socket
+import pytest
+import pytest_asyncio
+import uvicorn
+
+import src.p2p_chat.message_api as message_api
+
+import src.p2p_chat.server as server
+from src.p2p_chat.protocol import FrameDecoder
+from src.p2p_chat.presence import Roster
+from src.p2p_chat.storage import MemoryStorage
+
+
+# ----------------------
+# Fakes
+# ----------------------
+class StalledTransport:
+    def __init__(self):
+        self.aborted = False
+
+    def abort(self):
+        self.aborted = True
+
+
+class StalledWriter:
+    """A writer whose peer never reads: drain() blocks until released."""
+
+    def __init__(self):
+        self.chunks = []
+        self.transport = StalledTransport()
+        self.unblocked = asyncio.Event()
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    async def drain(self):
+        await self.unblocked.wait()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+class BrokenWriter(StalledWriter):
+    """A writer whose socket fails on the first write."""
+
+    async def drain(self):
+        raise ConnectionResetError("peer went away")
+
+
+@pytest.fixture
+def outbound(monkeypatch):
+    settings = dict(server.outbound_settings)
+    monkeypatch.setattr(server, "outbound_settings", settings)
+    monkeypatch.setattr(server, "roster", Roster())
+    settings.update(queue_max=50, high_watermark=10, low_watermark=2, slow_consumer_timeout=60)
+    server.clients.clear()
+    yield settings
+    server.clients.clear()
+
+
+def chat(i):
+    return {"type": "chat", "sender": "alice", "timestamp": "t", "message": f"m{i}"}
+
+
+# ----------------------
+# Outbound Queue Tests
+# ----------------------
+@pytest.mark.asyncio
+async def test_stalled_consumer_does_not_block_sender(outbound):
+    writer = StalledWriter()
+    conn = server.ClientConnection("bob", None, writer, version=2)
+    server.clients["bob"] = conn
+    conn.start()
+    conn.send(chat("first"))
+    await asyncio.sleep(0)  # The writer task is now stuck in drain()
+
+    # None of these sends wait on bob's socket
+    for i in range(20):
+        assert conn.send(chat(i))
+
+    assert conn.depth == 20
+    assert conn.lagging_since is not None
+    assert server.queue_stats()[0] == {
+        "username": "bob", "depth": 20, "bytes": conn.queued_bytes, "lagging": True, "evicted": 0
+    }
+
+    # Once bob reads again the backlog is flushed in coalesced writes
+    writer.unblocked.set()
+    for _ in range(10):
+        await asyncio.sleep(0)
+    assert conn.depth == 0
+    assert conn.lagging_since is None
+    assert len(writer.chunks) < 20
+    await conn.close()
+
+
+@pytest.mark.asyncio
+async def test_drop_policy_disconnects_at_hard_cap(outbound):
+    writer = StalledWriter()
+    conn = server.ClientConnection("bob", None, writer, version=2)
+    conn.start()
+
+    accepted = [conn.send(chat(i)) for i in range(outbound["queue_max"])]
+    assert all(accepted[:-1]) and accepted[-1] is False
+    assert writer.transport.aborted
+    assert conn.closed and conn.depth == 0
+
+
+@pytest.mark.asyncio
+async def test_spill_policy_stores_backlog(outbound, monkeypatch):
+    outbound["slow_consumer_policy"] = "spill"
+    stored = []
+
+    async def fake_store_message(sender, destination, message, *args, **kwargs):
+        stored.append((sender, destination, message))
+
+    monkeypatch.setattr(server, "store_message", fake_store_message)
+    writer = StalledWriter()
+    conn = server.ClientConnection("bob", None, writer, version=2)
+    conn.start()
+    await asyncio.sleep(0)
+
+    for i in range(outbound["queue_max"]):
+        assert conn.send(chat(i))
+    await asyncio.sleep(0.01)
+
+    assert not conn.closed
+    assert conn.evicted >= outbound["queue_max"] - 1
+    assert len(stored) == conn.evicted
+    assert all(dest == "bob" for _, dest, _ in stored)
+    writer.unblocked.set()
+    await conn.close()
+
+
+@pytest.mark.asyncio
+async def test_spill_policy_keeps_control_frames(outbound, monkeypatch):
+    outbound["slow_consumer_policy"] = "spill"
+    stored = []
+
+    async def fake_store_message(sender, destination, message, *args, **kwargs):
+        stored.append(message)
+
+    monkeypatch.setattr(server, "store_message", fake_store_message)
+    writer = StalledWriter()
+    conn = server.ClientConnection("bob", None, writer, version=2)
+    conn.start()
+    conn.send(chat("first"))
+    await asyncio.sleep(0)  # Stuck writing "first"
+
+    page = asyncio.get_running_loop().create_future()
+    conn.send_raw(b"stored page", None, page)
+    conn.send({"type": "presence", "version": 2, "joined": ["carol"], "left": []})
+    for i in range(outbound["queue_max"] - 2):  # Reaches the hard cap
+        conn.send(chat(i))
+    await asyncio.sleep(0.01)
+
+    assert page.done() and page.result() is False  # Not written, so never acked
+    assert len(stored) == conn.evicted - 1
+    assert [event["type"] for _, event, _ in conn.queue] == ["presence", "system"]
+
+    writer.unblocked.set()
+    await conn.close()
+    frames = FrameDecoder().feed(b"".join(writer.chunks))
+    assert [f["type"] for f in frames] == ["chat", "presence", "system"]
+
+
+# ----------------------
+# Room Tests
+# ----------------------
+class RecordingWriter(StalledWriter):
+    def __init__(self):
+        super().__init__()
+        self.unblocked.set()
+
+
+@pytest.fixture
+def room_state(outbound):
+    server.rooms.clear()
+    yield
+    server.rooms.clear()
+
+
+@pytest.mark.asyncio
+async def test_publish_serializes_once_and_bulk_stores_offline(room_state, monkeypatch):
+    bulk_calls = []
+
+    async def fake_store_messages(sender, destinations, message, *args, **kwargs):
+        bulk_calls.append((sender, sorted(destinations), message))
+
+    monkeypatch.setattr(server, "store_messages", fake_store_messages)
+
+    conns = {}
+    for name in ("alice", "bob", "carol"):
+        conns[name] = server.ClientConnection(name, None, RecordingWriter(), version=2)
+        server.clients[name] = conns[name]
+        conns[name].start()
+    for name in ("alice", "bob", "carol", "dave", "erin"):
+        server.join_room(name, "general")
+
+    await server.handle_request(conns["alice"], {"type": "chat", "destination": "#general", "message": "hi all"})
+    await asyncio.sleep(0)
+
+    bob_bytes, carol_bytes = conns["bob"].writer.chunks[-1], conns["carol"].writer.chunks[-1]
+    assert bob_bytes is carol_bytes  # Same encoded object queued for both
+    assert bulk_calls == [("alice", ["dave", "erin"], "hi all")]
+    assert b"Published to #general: 2 delivered, 2 saved." in conns["alice"].writer.chunks[-1]
+
+    server.leave_room("dave", "general")
+    server.leave_room("erin", "general")
+    assert server.rooms["general"] == {"alice", "bob", "carol"}
+
+
+@pytest.mark.asyncio
+async def test_to_all_broadcasts_to_online_users(room_state, monkeypatch):
+    async def fail_store(*args, **kwargs):
+        raise AssertionError("broadcasts are never stored")
+
+    monkeypatch.setattr(server, "store_message", fail_store)
+    monkeypatch.setattr(server, "store_messages", fail_store)
+
+    conns = [server.ClientConnection(name, None, RecordingWriter(), version=v) for name, v in (("bot", 2), ("x", 1), ("y", 2))]
+    for conn in conns:
+        server.clients[conn.username] = conn
+        conn.start()
+
+    await server.handle_request(conns[0], {"type": "chat", "destination": "TO_ALL", "message": "online!"})
+    await asyncio.sleep(0)
+
+    assert conns[0].writer.chunks == []
+    assert conns[1].writer.chunks[-1].startswith(b"[bot][")
+    assert b'"message":"online!"' in conns[2].writer.chunks[-1]
+
+
+# ----------------------
+# Mailbox Delivery Tests
+# ----------------------
+@pytest.mark.asyncio
+async def test_mailbox_is_streamed_in_pages(outbound, monkeypatch):
+    mailbox = [
+        {"_id": f"{i:06d}", "sender": "thermometer", "timestamp": "t", "message": f"reading {i}", "type": "notification"}
+        for i in range(1100)
+    ]
+    writer = StalledWriter()
+    conn = server.ClientConnection("bob", None, writer, version=2)
+    acked = []
+
+    async def fake_get_stored_messages(username, api_base, limit=server.MAILBOX_PAGE_SIZE):
+        # The previous page was written and acked before the next claim
+        assert conn.depth == 0
+        start = len(acked)
+        return mailbox[start:start + limit]
+
+    async def fake_ack_stored_messages(username, ids, api_base):
+        acked.extend(ids)
+
+    monkeypatch.setattr(server, "get_stored_messages", fake_get_stored_messages)
+    monkeypatch.setattr(server, "ack_stored_messages", fake_ack_stored_messages)
+    conn.start()
+    delivery = asyncio.create_task(server.deliver_stored_messages(conn))
+    await asyncio.sleep(0.01)
+    assert acked == []  # Stalled client: nothing acked, the second page waits
+    assert len(writer.chunks) == 1
+
+    writer.unblocked.set()
+    await asyncio.wait_for(delivery, 1)
+    assert acked == [msg["_id"] for msg in mailbox]
+    assert len(writer.chunks) == 3  # One coalesced write per page
+    frames = FrameDecoder().feed(b"".join(writer.chunks))
+    assert [f["message"] for f in frames] == [f"reading {i}" for i in range(1100)]
+    await conn.close()
+
+
+@pytest.mark.asyncio
+async def test_unflushed_page_is_not_acked(outbound, monkeypatch):
+    acked = []
+
+    async def fake_get_stored_messages(username, *args, **kwargs):
+        return [{"_id": "1", "sender": "alice", "timestamp": "t", "message": "hi"}]
+
+    async def fake_ack_stored_messages(username, ids, api_base):
+        acked.extend(ids)
+
+    monkeypatch.setattr(server, "get_stored_messages", fake_get_stored_messages)
+    monkeypatch.setattr(server, "ack_stored_messages", fake_ack_stored_messages)
+    conn = server.ClientConnection("bob", None, BrokenWriter(), version=2)
+    conn.start()
+    await asyncio.wait_for(server.deliver_stored_messages(conn), 1)
+    assert conn.closed
+    assert acked == []  # Left to the lease so the page is offered again
+
+
+@pytest.mark.asyncio
+async def test_spilled_page_is_not_acked(outbound, monkeypatch):
+    outbound["slow_consumer_policy"] = "spill"
+    acked = []
+    claims = []
+
+    async def fake_get_stored_messages(username, *args, **kwargs):
+        claims.append(username)
+        return [{"_id": str(i), "sender": "alice", "timestamp": "t", "message": f"stored {i}"} for i in range(3)]
+
+    async def fake_ack_stored_messages(username, ids, api_base):
+        acked.extend(ids)
+
+    async def fake_store_message(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(server, "get_stored_messages", fake_get_stored_messages)
+    monkeypatch.setattr(server, "ack_stored_messages", fake_ack_stored_messages)
+    monkeypatch.setattr(server, "store_message", fake_store_message)
+    writer = StalledWriter()
+    conn = server.ClientConnection("bob", None, writer, version=2)
+    conn.start()
+    conn.send(chat("first"))
+    await asyncio.sleep(0)  # Stuck writing "first"
+
+    delivery = asyncio.create_task(server.deliver_stored_messages(conn))
+    await asyncio.sleep(0.01)  # The page is queued behind it
+    for i in range(outbound["queue_max"]):
+        conn.send(chat(i))
+    await asyncio.wait_for(delivery, 1)
+    assert not conn.closed and claims == ["bob"]
+    assert acked == []  # Spilled before it was written, so the lease brings it back
+
+    writer.unblocked.set()
+    await conn.close()
+    assert not any(b"stored" in chunk for chunk in writer.chunks)
+
+
+@pytest_asyncio.fixture
+async def message_store():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    storage = MemoryStorage()
+    api = uvicorn.Server(uvicorn.Config(message_api.create_app(storage=storage),
+                                        host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(api.serve())
+    while not api.started:
+        await asyncio.sleep(0.05)
+    yield f"http://127.0.0.1:{port}", storage
+    api.should_exit = True
+    await task
+
+
+@pytest.mark.asyncio
+async def test_stored_mail_is_pushed_to_online_users(outbound, message_store):
+    api_base, storage = message_store
+    writer = RecordingWriter()
+    conn = server.ClientConnection("bob", None, writer, version=2, api_base=api_base)
+    server.clients["bob"] = conn
+    conn.start()
+    watcher = asyncio.create_task(server.watch_mailboxes(api_base))
+    try:
+        await asyncio.sleep(0.2)  # Subscribed to the API's event stream
+        # A service posts straight to the API for a user who is online
+        await server.store_message("thermometer", "bob", "21°C", api_base)
+        await server.store_message("thermometer", "carol", "22°C", api_base)
+        for _ in range(50):
+            if writer.chunks:
+                break
+            await asyncio.sleep(0.02)
+        assert [f["message"] for f in FrameDecoder().feed(b"".join(writer.chunks))] == ["21°C"]
+        await asyncio.sleep(0.05)
+        assert await storage.count("bob") == 0  # Delivered and acked
+        assert await storage.count("carol") == 1  # Offline: left for login
+    finally:
+        watcher.cancel()
+        await conn.close()
+
+
+@pytest.mark.asyncio
+async def test_chat_keeps_flowing_while_the_api_is_down(outbound, tmp_path):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        api_base = f"http://127.0.0.1:{s.getsockname()[1]}"  # Nothing listens here
+    outbound["spool_path"] = str(tmp_path / "spool.jsonl")
+    alice = server.ClientConnection("alice", None, RecordingWriter(), version=2, api_base=api_base)
+    bob = server.ClientConnection("bob", None, RecordingWriter(), version=2, api_base=api_base)
+    for conn in (alice, bob):
+        server.clients[conn.username] = conn
+        conn.start()
+    try:
+        started = asyncio.get_running_loop().time()
+        for i in range(20):
+            await server.handle_request(alice, {"type": "chat", "destination": "carol", "message": f"later {i}"}, api_base)
+            await server.handle_request(alice, {"type": "chat", "destination": "bob", "message": f"now {i}"}, api_base)
+        assert asyncio.get_running_loop().time() - started < 0.5
+        await asyncio.sleep(0.05)
+        assert [f["message"] for f in FrameDecoder().feed(b"".join(bob.writer.chunks))] == [f"now {i}" for i in range(20)]
+    finally:
+        await server.close_store_queues()
+        for conn in (alice, bob):
+            await conn.close()
+    spooled = (tmp_path / "spool.jsonl").read_text().splitlines()
+    assert [json.loads(line)["message"] for line in spooled] == [f"later {i}" for i in range(20)]
@@ -0,0 +1,150 @@
+# test_spool.py
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+import src.p2p_chat.api_client as api_client
+import src.p2p_chat.spool as spool
+from src.p2p_chat.spool import StoreQueue
+
+
+class FlakyAPI:
+    """A Message API that can be taken down and brought back."""
+
+    def __init__(self):
+        self.up = True
+        self.status = 200
+        self.garbled = False  # Answer with a body that isn't JSON
+        self.stored = []
+
+    def handler(self, request):
+        if not self.up:
+            raise httpx.ConnectError("connection refused", request=request)
+        if self.status != 200:
+            return httpx.Response(self.status, json={"detail": "nope"})
+        if self.garbled:
+            return httpx.Response(200, content=b"<html>", headers={"content-type": "application/json"})
+        self.stored.extend(m["message"] for m in json.loads(request.content)["messages"])
+        return httpx.Response(200, json={"status": "stored"})
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = FlakyAPI()
+    pooled = httpx.AsyncClient(transport=httpx.MockTransport(api.handler))
+    monkeypatch.setattr(api_client, "build_client", lambda **kw: pooled)
+    monkeypatch.setattr(spool, "RETRY_DELAY", 0.01)
+    yield api
+
+
+def doc(i):
+    return {"sender": "alice", "destination": "bob", "message": f"m{i}", "timestamp": "t", "type": "chat"}
+
+
+async def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_outage_spools_and_replays_in_order(api, tmp_path):
+    path = tmp_path / "spool.jsonl"
+    queue = StoreQueue("http://api", str(path), batch_size=4)
+    queue.start()
+
+    api.up = False
+    started = time.perf_counter()
+    for i in range(10):
+        queue.put([doc(i)])
+    assert time.perf_counter() - started < 0.05  # Nothing waits on the API
+    await wait_for(lambda: queue.spooling)
+    for i in range(10, 20):
+        queue.put([doc(i)])
+    assert not queue.pending
+    assert len(path.read_text().splitlines()) == 20
+
+    api.up = True
+    await wait_for(lambda: not queue.spooling)
+    assert api.stored == [f"m{i}" for i in range(20)]
+    assert not path.exists()
+
+    queue.put([doc(20)])
+    await wait_for(lambda: len(api.stored) == 21)
+    await queue.close()
+    await api_client.close_client()
+
+
+@pytest.mark.asyncio
+async def test_spool_left_by_a_crash_is_replayed(api, tmp_path):
+    path = tmp_path / "spool.jsonl"
+    path.write_text("".join(json.dumps(doc(i)) + "\n" for i in range(5)))
+    (tmp_path / "spool.jsonl.offset").write_text(str(len(path.read_bytes().splitlines(True)[0])))
+
+    queue = StoreQueue("http://api", str(path))
+    queue.start()
+    await wait_for(lambda: not queue.spooling)
+    assert api.stored == ["m1", "m2", "m3", "m4"]  # m0 was sent before the crash
+    assert not (tmp_path / "spool.jsonl.offset").exists()
+    await queue.close()
+    await api_client.close_client()
+
+
+@pytest.mark.asyncio
+async def test_close_spools_what_the_api_never_took(api, tmp_path):
+    path = tmp_path / "spool.jsonl"
+    api.up = False
+    queue = StoreQueue("http://api", str(path))
+    queue.put([doc(0), doc(1)])
+    await queue.close()
+    assert [json.loads(line)["message"] for line in path.read_text().splitlines()] == ["m0", "m1"]
+    await api_client.close_client()
+
+
+@pytest.mark.asyncio
+async def test_rejected_batches_are_dropped(api, tmp_path):
+    api.status = 422
+    queue = StoreQueue("http://api", str(tmp_path / "spool.jsonl"))
+    queue.start()
+    queue.put([doc(0)])
+    await wait_for(lambda: queue.dropped == 1)
+    assert not queue.spooling
+    await queue.close()
+    await api_client.close_client()
+
+
+@pytest.mark.asyncio
+async def test_unexpected_errors_do_not_stop_the_writer(api, tmp_path):
+    api.garbled = True
+    queue = StoreQueue("http://api", str(tmp_path / "spool.jsonl"))
+    queue.start()
+    queue.put([doc(0), doc(1)])
+    await wait_for(lambda: queue.spooling)
+    assert not queue.task.done()
+
+    api.garbled = False
+    await wait_for(lambda: not queue.spooling)
+    assert api.stored == ["m0", "m1"]
+    await queue.close()
+    await api_client.close_client()
+
+
+@pytest.mark.asyncio
+async def test_memory_only_queue_is_bounded(api):
+    api.up = False
+    queue = StoreQueue("http://api", None, memory_limit=3)
+    queue.start()
+    queue.put([doc(0), doc(1)])
+    queue.put([doc(2), doc(3), doc(4)])
+    await asyncio.sleep(0.05)  # At least one failed attempt
+    assert len(queue.pending) == 3 and queue.overflowed == 2
+
+    api.up = True
+    await wait_for(lambda: not queue.pending)
+    assert api.stored == ["m2", "m3", "m4"]
+    await queue.close()
+    await api_client.close_client()
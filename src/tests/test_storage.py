@@ -0,0 +1,291 @@
+# test_storage.py
+import sqlite3
+import time
+
+import pytest
+import pytest_asyncio
+
+from src.p2p_chat.logstore import LogStorage
+import src.p2p_chat.storage as storage_module
+from src.p2p_chat.storage import MemoryStorage, MongoStorage, SQLiteStorage, open_storage
+
+
+# ----------------------
+# Fake Motor collection for MongoStorage
+# ----------------------
+def matches(doc, query):
+    """Enough of Mongo's query language for MongoStorage."""
+    for key, cond in query.items():
+        value = doc
+        for part in key.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        if isinstance(cond, dict):
+            if "$gt" in cond and not (value is not None and value > cond["$gt"]):
+                return False
+            if "$lt" in cond and not (value is not None and value < cond["$lt"]):
+                return False
+            if "$lte" in cond and not (value is not None and value <= cond["$lte"]):
+                return False
+            if "$in" in cond and value not in cond["$in"]:
+                return False
+            if "$not" in cond and matches(doc, {key: cond["$not"]}):
+                return False
+        elif value != cond:
+            return False
+    return True
+
+class FakeCollection:
+    def __init__(self):
+        self.data = []
+        self.inserted = 0
+
+    async def insert_many(self, documents, ordered=True):
+        for document in documents:
+            # Like Motor, assign an increasing _id to the inserted document in place
+            document.setdefault("_id", f"fake_id_{self.inserted:08d}")
+            self.inserted += 1
+            self.data.append(document)
+
+    def find(self, query, projection=None):
+        hidden = {key for key, shown in (projection or {}).items() if not shown}
+        return FakeCursor([
+            {key: value for key, value in doc.items() if key not in hidden}
+            for doc in self.data if matches(doc, query)
+        ])
+
+    async def delete_many(self, query):
+        kept = [doc for doc in self.data if not matches(doc, query)]
+        class FakeDeleteResult:
+            deleted_count = len(self.data) - len(kept)
+        self.data = kept
+        return FakeDeleteResult()
+
+    async def update_many(self, query, update):
+        for doc in self.data:
+            if matches(doc, query):
+                doc.update(update["$set"])
+
+    async def update_one(self, query, update, upsert=False):
+        doc = next((doc for doc in self.data if matches(doc, query)), None)
+        if doc is None:
+            if not upsert:
+                return
+            doc = dict(query)
+            self.data.append(doc)
+        for key, amount in update.get("$inc", {}).items():
+            doc[key] = doc.get(key, 0) + amount
+        for key, value in update.get("$max", {}).items():
+            if doc.get(key) is None or value > doc[key]:
+                doc[key] = value
+
+    async def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            await self.update_one(request._filter, request._doc, upsert=request._upsert)
+
+    async def count_documents(self, query):
+        return sum(matches(doc, query) for doc in self.data)
+
+    async def create_index(self, keys, **kwargs):
+        pass
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction=1):
+        self.docs = sorted(self.docs, key=lambda doc: doc[key], reverse=direction < 0)
+        return self
+
+    def skip(self, count):
+        self.docs = self.docs[count:]
+        return self
+
+    def limit(self, count):
+        self.docs = self.docs[:count]
+        return self
+
+    async def to_list(self, length=None):
+        return self.docs[:length]
+
+
+@pytest_asyncio.fixture(params=["mongo", "sqlite", "log", "memory"])
+async def storage(request, tmp_path):
+    if request.param == "mongo":
+        engine = MongoStorage(FakeCollection(), FakeCollection())
+    elif request.param == "sqlite":
+        engine = SQLiteStorage(str(tmp_path / "messages.db"))
+    elif request.param == "log":
+        engine = LogStorage(str(tmp_path / "log"))
+    else:
+        engine = MemoryStorage()
+    await engine.setup()
+    yield engine
+    await engine.close()
+
+
+def readings(count, destination="bob"):
+    return [
+        {"sender": "thermometer", "destination": destination, "message": f"reading {i}",
+         "timestamp": "t", "type": "notification", "metadata": {"reading": i}}
+        for i in range(count)
+    ]
+
+
+# ----------------------
+# Engine Tests
+# ----------------------
+@pytest.mark.asyncio
+async def test_insert_and_take_pages(storage):
+    ids = await storage.insert_many(readings(5) + readings(1, "carol"))
+    assert len(set(ids)) == 6 and all(isinstance(i, str) for i in ids)
+
+    first, more = await storage.take("bob", 3)
+    assert more and [msg["message"] for msg in first] == ["reading 0", "reading 1", "reading 2"]
+    assert first[0]["metadata"] == {"reading": 0} and first[0]["destination"] == "bob"
+    rest, more = await storage.take("bob", 3, after=first[-1]["_id"])
+    assert not more and [msg["message"] for msg in rest] == ["reading 3", "reading 4"]
+
+    assert await storage.count("bob") == 0
+    assert await storage.count("carol") == 1
+
+
+@pytest.mark.asyncio
+async def test_claim_lease_and_ack(storage):
+    await storage.insert_many(readings(5))
+
+    claim, first = await storage.claim("bob", 3, lease=30, now=100)
+    assert claim and [msg["message"] for msg in first] == ["reading 0", "reading 1", "reading 2"]
+    assert "claimed_until" not in first[0]
+    _, second = await storage.claim("bob", 3, lease=30, now=110)
+    assert [msg["message"] for msg in second] == ["reading 3", "reading 4"]
+    assert await storage.claim("bob", 3, lease=30, now=120) == (None, [])
+    assert await storage.take("bob", 10, now=120) == ([], False)  # Claimed messages are hidden from GET too
+
+    assert await storage.ack("bob", [msg["_id"] for msg in first]) == 3
+    assert await storage.ack("carol", [msg["_id"] for msg in second]) == 0  # Only the owner's mailbox
+    assert await storage.count("bob") == 2
+
+    # Once the lease runs out the unacked messages are offered again
+    _, again = await storage.claim("bob", 3, lease=30, now=141)
+    assert [msg["message"] for msg in again] == ["reading 3", "reading 4"]
+
+
+@pytest.mark.asyncio
+async def test_trim_drops_oldest(storage):
+    await storage.insert_many(readings(5))
+    assert await storage.trim("bob", 2) == 3
+    assert await storage.trim("bob", 2) == 0
+    messages, _ = await storage.take("bob", 10)
+    assert [msg["message"] for msg in messages] == ["reading 3", "reading 4"]
+
+
+@pytest.mark.asyncio
+async def test_trim_by_type_leaves_other_types(storage):
+    docs = readings(5)
+    for i in (1, 2):
+        docs[i]["type"] = "chat"
+    await storage.insert_many(docs)
+    assert await storage.trim("bob", 1, "notification") == 2
+    assert await storage.trim("bob", 1, "notification") == 0
+    messages, _ = await storage.take("bob", 10)
+    assert [msg["message"] for msg in messages] == ["reading 1", "reading 2", "reading 4"]
+
+
+@pytest.mark.asyncio
+async def test_coalesced_readings_replace_older_ones(storage):
+    def temperature(value, sender="thermometer"):
+        return {"sender": sender, "destination": "bob", "message": f"{value}°C", "timestamp": "t",
+                "type": "notification", "metadata": {"coalesce": "temperature"}}
+
+    await storage.insert_many([temperature(20), temperature(21), temperature(30, "oven")])
+    await storage.insert_many(readings(1))
+    assert await storage.count("bob") == 3
+
+    # A claimed reading is already on its way, so it is left alone
+    _, claimed = await storage.claim("bob", 1, lease=30, now=time.time())
+    assert [msg["message"] for msg in claimed] == ["21°C"]
+    await storage.insert_many([temperature(22)])
+    await storage.insert_many([temperature(23)])
+    messages, _ = await storage.take("bob", 10, now=time.time() + 60)
+    assert [msg["message"] for msg in messages] == ["21°C", "30°C", "reading 0", "23°C"]
+
+
+@pytest.mark.asyncio
+async def test_expire(storage):
+    docs = readings(3)
+    docs[0]["expires_at"], docs[1]["expires_at"] = 100.0, 200.0
+    await storage.insert_many(docs)
+    assert await storage.expire(150.0) == 1
+    messages, _ = await storage.take("bob", 10)
+    assert [msg["message"] for msg in messages] == ["reading 1", "reading 2"]
+    assert "expires_at" not in messages[0]
+
+
+@pytest.mark.asyncio
+async def test_mongo_deletes_in_batches(monkeypatch):
+    monkeypatch.setattr(storage_module, "DELETE_BATCH", 2)
+    engine = MongoStorage(FakeCollection(), FakeCollection())
+    docs = readings(5)
+    for doc in docs:
+        doc["expires_at"] = 100.0
+    await engine.insert_many(docs)
+    assert await engine.expire(150.0) == 5
+    assert await engine.count("bob") == 0
+    assert (await engine.summary("bob"))["total"] == 0
+
+
+@pytest.mark.asyncio
+async def test_summary_follows_inserts_and_deletes(storage):
+    assert await storage.summary("bob") == {"total": 0, "by_sender": {}, "by_type": {}, "newest": None}
+    docs = readings(3)
+    for i, doc in enumerate(docs):
+        doc["timestamp"] = f"2025-01-01T00:00:0{i}"
+    docs.append({"sender": "alice", "destination": "bob", "message": "hi", "timestamp": "2025-01-01T00:00:09",
+                 "type": "chat", "metadata": {}})
+    await storage.insert_many(docs + readings(2, "carol"))
+    assert await storage.summary("bob") == {
+        "total": 4, "by_sender": {"thermometer": 3, "alice": 1}, "by_type": {"notification": 3, "chat": 1},
+        "newest": "2025-01-01T00:00:09",
+    }
+
+    _, claimed = await storage.claim("bob", 2, lease=30, now=time.time())
+    assert (await storage.summary("bob"))["total"] == 4  # Claimed is still unread
+    await storage.ack("bob", [msg["_id"] for msg in claimed])
+    await storage.take("bob", 1)
+    summary = await storage.summary("bob")
+    assert (summary["total"], summary["by_sender"], summary["by_type"]) == (1, {"alice": 1}, {"chat": 1})
+    await storage.trim("bob", 0)
+    assert (await storage.summary("bob"))["total"] == 0
+    assert (await storage.summary("carol"))["by_sender"] == {"thermometer": 2}
+
+
+@pytest.mark.asyncio
+async def test_sqlite_counts_untyped_messages_in_one_row(tmp_path):
+    path = str(tmp_path / "messages.db")
+    # A database left by a version whose summaries had a nullable type, with the duplicate rows it made
+    db = sqlite3.connect(path)
+    db.executescript(storage_module.SCHEMA)
+    db.execute("CREATE TABLE summaries (destination TEXT NOT NULL, sender TEXT NOT NULL, type TEXT, "
+               "count INTEGER NOT NULL, newest TEXT, PRIMARY KEY (destination, sender, type))")
+    for i in range(2):
+        db.execute("INSERT INTO messages (destination, sender, message) VALUES ('bob', 'alice', ?)", (str(i),))
+        db.execute("INSERT INTO summaries VALUES ('bob', 'alice', NULL, 1, NULL)")
+    db.commit()
+    db.close()
+
+    engine = SQLiteStorage(path)
+    engine.db.execute("INSERT INTO messages (destination, sender, message) VALUES ('bob', 'alice', '2')")
+    engine.db.commit()
+    assert engine.db.execute("SELECT COUNT(*) FROM summaries").fetchone()[0] == 1
+    assert (await engine.summary("bob"))["by_type"] == {None: 3}
+    await engine.ack("bob", ["1", "2"])
+    assert (await engine.summary("bob"))["by_type"] == {None: 1}
+    await engine.close()
+
+
+def test_open_storage(tmp_path):
+    assert isinstance(open_storage("memory"), MemoryStorage)
+    assert isinstance(open_storage("sqlite", sqlite_path=str(tmp_path / "m.db")), SQLiteStorage)
+    assert isinstance(open_storage("log", log_dir=str(tmp_path / "log")), LogStorage)
+    with pytest.raises(ValueError):
+        open_storage("redis")
@@ -0,0 +1,285 @@
+# test_websocket_adapter.py
+import asyncio
+import json
+
+import pytest
+import pytest_asyncio
+from fastapi import WebSocketDisconnect
+from httpx import ASGITransport, AsyncClient
+
+import src.p2p_chat.codec as codec
+import src.p2p_chat.server as server
+import src.p2p_chat.websocket_adapter as adapter
+from src.p2p_chat.presence import Roster
+from src.p2p_chat.protocol import encode_frame, open_connection
+from src.p2p_chat.static_assets import StaticAssets
+
+needs_msgpack = pytest.mark.skipif(not codec.msgpack_available(), reason="msgpack is not installed")
+
+
+class FakeWebSocket:
+    """A browser: feed it requests, read back what the adapter sent."""
+
+    def __init__(self, subprotocols=()):
+        self.scope = {"subprotocols": list(subprotocols)}
+        self.subprotocol = None
+        self.inbox = asyncio.Queue()
+        self.received = []
+        self.binary_frames = 0
+        self.closed = False
+
+    async def accept(self, subprotocol=None):
+        self.subprotocol = subprotocol
+
+    async def receive_json(self):
+        data = await self.inbox.get()
+        if data is None:
+            raise WebSocketDisconnect()
+        return data
+
+    async def receive_bytes(self):
+        return codec.pack(await self.receive_json())
+
+    async def send_json(self, data):
+        self.received.append(data)
+
+    async def send_text(self, text):
+        self.received.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        self.binary_frames += 1
+        self.received.append(codec.unpack(data))
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest_asyncio.fixture
+async def chat_address(monkeypatch):
+    async def no_stored_messages(username, *args, **kwargs):
+        return []
+
+    monkeypatch.setattr(server, "get_stored_messages", no_stored_messages)
+    monkeypatch.setattr(server, "roster", Roster())
+    monkeypatch.setattr(adapter, "pools", {})
+    monkeypatch.setattr(adapter, "upstream_connections", 2)
+    server.clients.clear()
+    chat_server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    yield chat_server.sockets[0].getsockname()[:2]
+    chat_server.close()
+    server.clients.clear()
+
+
+async def wait_for(condition, timeout=2):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    assert condition()
+
+
+@pytest.mark.asyncio
+async def test_web_users_share_pooled_upstreams(chat_address):
+    host, port = chat_address
+    browsers = [FakeWebSocket() for _ in range(30)]
+    endpoints = [asyncio.create_task(adapter.websocket_endpoint(ws)) for ws in browsers]
+    for i, ws in enumerate(browsers):
+        ws.inbox.put_nowait({"type": "login", "username": f"user{i}", "server_host": host, "server_port": port})
+    await wait_for(lambda: len(server.clients) == 30)
+    await wait_for(lambda: all(any(e["type"] == "login_success" for e in ws.received) for ws in browsers))
+
+    upstreams = adapter.pools[(host, port)].upstreams
+    assert len(upstreams) == 2 and all(u.writer is not None for u in upstreams)
+    assert sorted(len(u.sessions) for u in upstreams) == [15, 15]
+
+    browsers[0].inbox.put_nowait({"type": "chat", "recipient": "user29", "message": "hello"})
+    await wait_for(lambda: any(e.get("message") == "hello" for e in browsers[29].received))
+    chat = next(e for e in browsers[29].received if e.get("message") == "hello")
+    assert chat["type"] == "chat" and chat["sender"] == "user0"
+    assert sum(e["type"] == "login_success" for e in browsers[29].received) == 1
+
+    # A second browser can't take a name that is in use
+    duplicate = FakeWebSocket()
+    endpoints.append(asyncio.create_task(adapter.websocket_endpoint(duplicate)))
+    duplicate.inbox.put_nowait({"type": "login", "username": "user1", "server_host": host, "server_port": port})
+    await wait_for(lambda: duplicate.closed)
+    assert "already taken" in duplicate.received[-1]["message"]
+
+    browsers[0].inbox.put_nowait(None)
+    await wait_for(lambda: "user0" not in server.clients)
+
+    for ws in browsers[1:] + [duplicate]:
+        ws.inbox.put_nowait(None)
+    await asyncio.gather(*endpoints)
+    await wait_for(lambda: not server.clients)
+    for upstream in upstreams:
+        upstream.writer.close()
+
+
+@needs_msgpack
+@pytest.mark.asyncio
+async def test_browsers_negotiate_msgpack_frames(chat_address):
+    host, port = chat_address
+    packed = FakeWebSocket([adapter.SUBPROTOCOL_MSGPACK, adapter.SUBPROTOCOL_JSON])
+    text = FakeWebSocket([adapter.SUBPROTOCOL_JSON])
+    endpoints = [asyncio.create_task(adapter.websocket_endpoint(ws)) for ws in (packed, text)]
+    for name, ws in (("packed", packed), ("text", text)):
+        ws.inbox.put_nowait({"type": "login", "username": name, "server_host": host, "server_port": port})
+    await wait_for(lambda: any(e["type"] == "presence" and "text" in e["joined"] for e in packed.received))
+    assert packed.subprotocol == adapter.SUBPROTOCOL_MSGPACK
+    assert text.subprotocol == adapter.SUBPROTOCOL_JSON
+    assert adapter.choose_subprotocol([adapter.SUBPROTOCOL_JSON, adapter.SUBPROTOCOL_MSGPACK]) == adapter.SUBPROTOCOL_JSON
+    assert adapter.choose_subprotocol(["chat"]) is None  # Old pages offer nothing and get JSON text
+
+    text.inbox.put_nowait({"type": "chat", "recipient": "packed", "message": "reading"})
+    packed.inbox.put_nowait({"type": "chat", "recipient": "text", "message": "thanks"})
+    await wait_for(lambda: any(e.get("message") == "reading" for e in packed.received))
+    await wait_for(lambda: any(e.get("message") == "thanks" for e in text.received))
+    assert packed.binary_frames == len(packed.received)  # Everything, login_success included
+    assert text.binary_frames == 0
+
+    for ws in (packed, text):
+        ws.inbox.put_nowait(None)
+    await asyncio.gather(*endpoints)
+    for upstream in adapter.pools[(host, port)].upstreams:
+        upstream.writer.close()
+
+
+@pytest.mark.asyncio
+async def test_browsers_see_every_chat_server_user(chat_address):
+    host, port = chat_address
+    _, cli_writer = await open_connection(host, port, "cli")
+    await wait_for(lambda: "cli" in server.clients)
+
+    browser = FakeWebSocket()
+    endpoint = asyncio.create_task(adapter.websocket_endpoint(browser))
+    browser.inbox.put_nowait({"type": "login", "username": "web", "server_host": host, "server_port": port})
+    await wait_for(lambda: any(e["type"] == "login_success" for e in browser.received))
+    welcome = next(e for e in browser.received if e["type"] == "login_success")
+    assert welcome["online_users"] == ["cli", "web"]
+
+    # Users who log in to the chat server directly show up in the next presence batch
+    _, bot_writer = await open_connection(host, port, "bot")
+    await wait_for(lambda: any(e["type"] == "presence" and "bot" in e["joined"] for e in browser.received))
+    cli_writer.write(encode_frame({"type": "exit"}))
+    await wait_for(lambda: any(e["type"] == "presence" and "cli" in e["left"] for e in browser.received))
+
+    browser.inbox.put_nowait({"type": "presence", "after": "bot"})
+    await wait_for(lambda: any(e["type"] == "roster" for e in browser.received))
+    page = next(e for e in browser.received if e["type"] == "roster")
+    assert page["users"] == ["web"] and page["count"] == 2
+
+    browser.inbox.put_nowait(None)
+    await endpoint
+    for writer in (cli_writer, bot_writer):
+        writer.close()
+    for upstream in adapter.pools[(host, port)].upstreams:
+        if upstream.writer is not None:
+            upstream.writer.close()
+
+
+class StuckWebSocket(FakeWebSocket):
+    """A browser whose connection stopped moving: sends never finish."""
+
+    async def send_text(self, text):
+        await asyncio.Event().wait()
+
+
+@pytest.mark.asyncio
+async def test_slow_browser_is_dropped_without_stalling_others(chat_address, monkeypatch):
+    monkeypatch.setitem(adapter.send_settings, "send_timeout", 0.2)
+    host, port = chat_address
+    stuck = StuckWebSocket()
+    endpoints = [asyncio.create_task(adapter.websocket_endpoint(stuck))]
+    stuck.inbox.put_nowait({"type": "login", "username": "stuck", "server_host": host, "server_port": port})
+    await wait_for(lambda: "stuck" in server.clients)
+
+    # Logins and presence for everyone else go on while its queue fills
+    browsers = [FakeWebSocket() for _ in range(10)]
+    for i, ws in enumerate(browsers):
+        endpoints.append(asyncio.create_task(adapter.websocket_endpoint(ws)))
+        ws.inbox.put_nowait({"type": "login", "username": f"user{i}", "server_host": host, "server_port": port})
+    await wait_for(lambda: all(any(e["type"] == "login_success" for e in ws.received) for ws in browsers))
+    browsers[0].inbox.put_nowait({"type": "chat", "recipient": "stuck", "message": "are you there?"})
+    await asyncio.sleep(0.3)
+    browsers[0].inbox.put_nowait({"type": "chat", "recipient": "stuck", "message": "hello?"})
+    for i in range(25):
+        browsers[0].inbox.put_nowait({"type": "chat", "recipient": "user1", "message": f"m{i}"})
+    await wait_for(lambda: "stuck" not in server.clients)
+    await wait_for(lambda: [e["message"] for e in browsers[1].received if e["type"] == "chat"] == [f"m{i}" for i in range(25)])
+    await wait_for(lambda: stuck.closed)
+
+    for ws in [stuck] + browsers:
+        ws.inbox.put_nowait(None)
+    await asyncio.gather(*endpoints)
+    await wait_for(lambda: not server.clients)
+    for upstream in adapter.pools[(host, port)].upstreams:
+        upstream.writer.close()
+
+
+class IdleUpstream:
+    def __init__(self):
+        self.sessions = {}
+        self.sent = []
+
+    def send(self, session_id, request):
+        self.sent.append(request)
+
+
+@pytest.mark.asyncio
+async def test_browser_queue_is_bounded(monkeypatch):
+    monkeypatch.setitem(adapter.send_settings, "queue_max", 20)
+    upstream = IdleUpstream()
+    session = adapter.WebSession("slowpoke", StuckWebSocket(), upstream)
+    session.start()
+    accepted = [session.send_text(f"message {i}") for i in range(30)]
+    assert accepted.count(True) == 19  # The 20th fills the queue and drops the browser
+    assert session.closed and not session.queue
+    assert upstream.sent == [{"type": "exit"}]
+
+
+@pytest.fixture
+def static_dir(tmp_path, monkeypatch):
+    (tmp_path / "index.html").write_text("<html>" + "hello chat " * 200 + "</html>")
+    (tmp_path / "app.js").write_text("console.log('hi');")
+    monkeypatch.setattr(adapter, "assets", StaticAssets(tmp_path))
+    return tmp_path
+
+
+@pytest.mark.asyncio
+async def test_static_files_are_compressed_and_revalidated(static_dir):
+    async with AsyncClient(transport=ASGITransport(app=adapter.app), base_url="http://web") as client:
+        page = await client.get("/", headers={"Accept-Encoding": "gzip"})
+        assert page.status_code == 200
+        assert page.headers["content-encoding"] == "gzip"
+        assert int(page.headers["content-length"]) < 2000  # 2,013 bytes uncompressed
+        assert page.text.startswith("<html>hello chat")
+        assert page.headers["cache-control"] == "no-cache"
+
+        again = await client.get("/", headers={"If-None-Match": page.headers["etag"]})
+        assert again.status_code == 304
+        assert again.content == b""
+
+        plain = await client.get("/", headers={"Accept-Encoding": "identity"})
+        assert "content-encoding" not in plain.headers
+        assert plain.headers["etag"] == page.headers["etag"]
+
+        small = await client.get("/static/app.js", headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in small.headers  # Not worth compressing
+        assert small.headers["content-type"].startswith("text/javascript")
+        assert (await client.get("/static/missing.css")).status_code == 404
+        assert (await client.get("/static/../index.html")).status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_dev_mode_reloads_changed_files(static_dir):
+    async with AsyncClient(transport=ASGITransport(app=adapter.app), base_url="http://web") as client:
+        before = await client.get("/")
+        (static_dir / "index.html").write_text("<html>edited</html>")
+        assert (await client.get("/")).text == before.text  # Cached until told to watch
+
+        adapter.assets.dev = True
+        after = await client.get("/", headers={"If-None-Match": before.headers["etag"]})
+        assert after.status_code == 200
+        assert after.text == "<html>edited</html>"
+        assert after.headers["etag"] != before.headers["etag"]
@@ -0,0 +1,198 @@
+# test_workers.py
+import asyncio
+import pytest
+import pytest_asyncio
+
+import src.p2p_chat.server as server
+from src.p2p_chat.presence import Roster
+from src.p2p_chat.protocol import FrameDecoder, encode_frame, iter_frames, open_connection
+from src.p2p_chat.workers import PeerLink, PresenceHub, WorkerRouter
+
+
+class FakeWorker:
+    """Stands in for a second worker process: talks to the hub and collects
+    whatever other workers forward to its bus socket."""
+
+    def __init__(self, socket_dir, worker_id=1):
+        self.worker_id = worker_id
+        self.bus_path = f"{socket_dir}/worker-{worker_id}.sock"
+        self.forwarded = asyncio.Queue()
+
+    async def start(self, hub_path):
+        self.bus = await asyncio.start_unix_server(self._collect, self.bus_path)
+        self.reader, self.writer = await asyncio.open_unix_connection(hub_path)
+        self.hub_frames = iter_frames(self.reader, FrameDecoder())
+        await self.to_hub({"type": "hello", "worker": self.worker_id, "path": self.bus_path})
+        assert (await self.next_from_hub())["type"] == "snapshot"
+
+    async def _collect(self, reader, writer):
+        async for frame in iter_frames(reader):
+            await self.forwarded.put(frame)
+
+    async def to_hub(self, frame):
+        self.writer.write(encode_frame(frame))
+        await self.writer.drain()
+
+    async def next_from_hub(self):
+        """Next hub frame, skipping announcements of other workers starting."""
+        while True:
+            frame = await asyncio.wait_for(anext(self.hub_frames), 2)
+            if frame["type"] != "worker":
+                return frame
+
+    async def close(self):
+        self.writer.close()
+        self.bus.close()
+
+
+@pytest_asyncio.fixture
+async def cluster(tmp_path, monkeypatch):
+    """This process plays worker 0; a FakeWorker plays worker 1."""
+    async def fake_store_message(sender, destination, message, *args, **kwargs):
+        stored.append((sender, destination, message))
+
+    async def fake_store_messages(sender, destinations, message, *args, **kwargs):
+        stored.extend((sender, d, message) for d in destinations)
+
+    async def fake_get_stored_messages(username, *args, **kwargs):
+        return []
+
+    stored = []
+    monkeypatch.setattr(server, "store_message", fake_store_message)
+    monkeypatch.setattr(server, "store_messages", fake_store_messages)
+    monkeypatch.setattr(server, "get_stored_messages", fake_get_stored_messages)
+    monkeypatch.setattr(server, "roster", Roster())
+    server.clients.clear()
+    server.rooms.clear()
+
+    hub = PresenceHub(str(tmp_path))
+    await hub.start()
+    other = FakeWorker(str(tmp_path))
+    await other.start(hub.path)
+    router = WorkerRouter(0, str(tmp_path))
+    monkeypatch.setattr(server, "router", router)
+    await router.start()
+    chat_server = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+
+    yield chat_server.sockets[0].getsockname()[:2], other, stored
+
+    chat_server.close()
+    await router.close()
+    await other.close()
+    hub.server.close()
+    server.clients.clear()
+    server.rooms.clear()
+
+
+async def next_frame(frames, kind):
+    async for frame in frames:
+        if frame["type"] == kind:
+            return frame
+
+
+@pytest.mark.asyncio
+async def test_username_claims_are_exclusive_across_workers(cluster):
+    (host, port), other, _ = cluster
+    await other.to_hub({"type": "claim", "id": 1, "username": "bob"})
+    assert await other.next_from_hub() == {"type": "claimed", "id": 1, "ok": True}
+
+    # bob is already logged in on worker 1, so worker 0 must refuse him
+    reader, writer = await open_connection(host, port, "bob")
+    refusal = await asyncio.wait_for(next_frame(iter_frames(reader), "system"), 2)
+    assert "already taken" in refusal["message"]
+    writer.close()
+
+    # alice logs in here; worker 1 hears about it and can't claim her name
+    reader, writer = await open_connection(host, port, "alice")
+    welcome = await asyncio.wait_for(next_frame(iter_frames(reader), "login_success"), 2)
+    assert sorted(welcome["online_users"]) == ["alice", "bob"]
+    assert await other.next_from_hub() == {"type": "presence", "username": "alice", "worker": 0}
+    await other.to_hub({"type": "claim", "id": 2, "username": "alice"})
+    assert await other.next_from_hub() == {"type": "claimed", "id": 2, "ok": False}
+    writer.close()
+
+
+@pytest.mark.asyncio
+async def test_messages_are_forwarded_to_the_owning_worker(cluster):
+    (host, port), other, stored = cluster
+    await other.to_hub({"type": "claim", "id": 1, "username": "bob"})
+    await other.to_hub({"type": "join", "username": "bob", "room": "ops"})
+    await other.next_from_hub()
+
+    reader, writer = await open_connection(host, port, "alice")
+    frames = iter_frames(reader)
+    await asyncio.wait_for(next_frame(frames, "login_success"), 2)
+    writer.write(encode_frame({"type": "join", "room": "ops"}))
+    writer.write(encode_frame({"type": "chat", "destination": "bob", "message": "direct"}))
+    writer.write(encode_frame({"type": "chat", "destination": "#ops", "message": "to the room"}))
+    writer.write(encode_frame({"type": "chat", "destination": "carol", "message": "later"}))
+    await writer.drain()
+
+    direct = await asyncio.wait_for(other.forwarded.get(), 2)
+    assert direct["type"] == "deliver" and direct["usernames"] == ["bob"]
+    assert direct["event"]["sender"] == "alice" and direct["event"]["message"] == "direct"
+    published = await asyncio.wait_for(other.forwarded.get(), 2)
+    assert published["usernames"] == ["bob"] and published["event"]["room"] == "ops"
+
+    # Forwarded users count as delivered; only users offline everywhere are stored
+    notice = await asyncio.wait_for(next_frame(frames, "system"), 2)
+    assert "Joined #ops (2 members)" in notice["message"]
+    notice = await asyncio.wait_for(next_frame(frames, "system"), 2)
+    assert "1 delivered, 0 saved" in notice["message"]
+    notice = await asyncio.wait_for(next_frame(frames, "system"), 2)
+    assert "offline" in notice["message"]
+    assert stored == [("alice", "carol", "later")]
+    writer.close()
+
+
+@pytest.mark.asyncio
+async def test_messages_for_an_unreachable_worker_are_stored(cluster):
+    (host, port), other, stored = cluster
+    await other.to_hub({"type": "claim", "id": 1, "username": "bob"})
+    await other.next_from_hub()
+    other.bus.close()  # Worker 1 stops taking forwarded messages
+    await other.bus.wait_closed()
+
+    reader, writer = await open_connection(host, port, "alice")
+    frames = iter_frames(reader)
+    await asyncio.wait_for(next_frame(frames, "login_success"), 2)
+    writer.write(encode_frame({"type": "chat", "destination": "bob", "message": "direct"}))
+    await writer.drain()
+
+    for _ in range(100):
+        if stored:
+            break
+        await asyncio.sleep(0.01)
+    assert stored == [("alice", "bob", "direct")]
+    writer.close()
+
+
+@pytest.mark.asyncio
+async def test_link_hands_back_frames_when_the_peer_drops():
+    received = []
+    dropped = asyncio.Event()
+
+    async def peer(reader, writer):
+        received.append(await anext(iter_frames(reader)))
+        writer.transport.abort()  # Dies mid-stream
+        dropped.set()
+
+    peer_server = await asyncio.start_server(peer, "127.0.0.1", 0)
+    host, port = peer_server.sockets[0].getsockname()[:2]
+    undelivered = []
+    link = PeerLink("peer", lambda: asyncio.open_connection(host, port), undelivered=undelivered.extend)
+    frames = [{"type": "deliver", "usernames": ["bob"], "event": {"message": str(i)}} for i in range(3)]
+
+    link.send(frames[0])
+    await asyncio.wait_for(dropped.wait(), 2)
+    await asyncio.sleep(0.05)  # The reset reaches the link
+    link.send(frames[1])
+    link.send(frames[2])
+    for _ in range(100):
+        if undelivered:
+            break
+        await asyncio.sleep(0.01)
+    assert received == frames[:1]
+    assert undelivered == frames[1:]
+    await link.close()
+    peer_server.close()